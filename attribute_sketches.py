@@ -0,0 +1,152 @@
+import hashlib
+import math
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+# Bounds of the precision of `HyperLogLog`, the sketches take from 16 bytes to 256 KB
+MIN_PRECISION = 4
+MAX_PRECISION = 18
+DEFAULT_MAX_PAIRS = 1024
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(
+        hashlib.blake2b(value.encode("UTF-8", errors="surrogatepass"), digest_size=8).digest(), "little"
+    )
+
+
+class HyperLogLog:
+    """Estimator of the number of distinct strings added to it, in `2 ** precision` registers of one byte.
+
+    The standard error of `estimate` is about `1.04 / sqrt(2 ** precision)` (1.6% with the default precision), and two
+    sketches of the same precision are merged with `update`, as if all their strings had been added to one of them.
+    """
+
+    def __init__(self, precision: int = 12, registers: Optional[np.ndarray] = None):
+        if not MIN_PRECISION <= precision <= MAX_PRECISION:
+            raise ValueError(
+                f"You have requested an invalid precision ({precision}). Valid precisions are between {MIN_PRECISION} "
+                f"and {MAX_PRECISION}."
+            )
+        self.precision = precision
+        self.registers = registers if registers is not None else np.zeros(2 ** precision, dtype=np.uint8)
+
+    def add(self, value: str):
+        hash_value = _hash(value)
+        num_rank_bits = 64 - self.precision
+        register_idx = hash_value >> num_rank_bits
+        # Position of the first 1 bit of the rest of the hash
+        rank = num_rank_bits - (hash_value & ((1 << num_rank_bits) - 1)).bit_length() + 1
+        if rank > self.registers[register_idx]:
+            self.registers[register_idx] = rank
+
+    def update(self, other: "HyperLogLog"):
+        if other.precision != self.precision:
+            raise ValueError(
+                f"You have requested to merge sketches of different precisions ({self.precision} and "
+                f"{other.precision})."
+            )
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def estimate(self) -> float:
+        num_registers = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / num_registers)
+        raw_estimate = alpha * num_registers ** 2 / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+        num_empty_registers = int(np.count_nonzero(self.registers == 0))
+        if raw_estimate <= 2.5 * num_registers and num_empty_registers > 0:
+            # Linear counting is more accurate for the small cardinalities
+            return num_registers * math.log(num_registers / num_empty_registers)
+        return float(raw_estimate)
+
+
+class AttributeSketches:
+    """`HyperLogLog` sketches of the distinct values of each (tag, attribute) pair seen in the documents.
+
+    They are filled during the extraction (see `get_clean_text_and_metadata`) with the elements of the cleaned tree,
+    with their tag and their attributes as in the document (before the folding of the consecutive tags), the ones
+    that `attrs_to_keep` selects, and only for the attributes of `attrs` if it's given. The memory used is
+    `2 ** precision` bytes by pair and at most `max_pairs` pairs are sketched: the values of the next pairs are only
+    counted in `num_ignored_values`, and the sketches of `update` which don't fit are only counted in
+    `num_dropped_sketches`. The sketches of several workers or shards are merged with `update`. They can be shared by
+    the threads of a process.
+    """
+
+    def __init__(self, attrs: Optional[List[str]] = None, precision: int = 12, max_pairs: int = DEFAULT_MAX_PAIRS):
+        self.attrs = attrs
+        self.precision = precision
+        self.max_pairs = max_pairs
+        self.num_ignored_values = 0
+        self.num_dropped_sketches = 0
+        self.sketches: Dict[Tuple[str, str], HyperLogLog] = {}
+        self._lock = threading.Lock()
+        # Raises on an invalid precision
+        HyperLogLog(precision)
+
+    def __len__(self):
+        return len(self.sketches)
+
+    def _get_sketch(self, tag: str, attr: str) -> Optional[HyperLogLog]:
+        sketch = self.sketches.get((tag, attr))
+        if sketch is None:
+            if len(self.sketches) >= self.max_pairs:
+                return None
+            sketch = self.sketches[(tag, attr)] = HyperLogLog(self.precision)
+        return sketch
+
+    def add(self, tag: str, attrib):
+        with self._lock:
+            for attr, value in attrib.items():
+                if self.attrs is None or attr in self.attrs:
+                    sketch = self._get_sketch(tag, attr)
+                    if sketch is not None:
+                        sketch.add(value)
+                    else:
+                        self.num_ignored_values += 1
+
+    def update(self, other: "AttributeSketches"):
+        with self._lock:
+            for (tag, attr), sketch in other.sketches.items():
+                own_sketch = self._get_sketch(tag, attr)
+                if own_sketch is not None:
+                    own_sketch.update(sketch)
+                else:
+                    self.num_dropped_sketches += 1
+            self.num_ignored_values += other.num_ignored_values
+            self.num_dropped_sketches += other.num_dropped_sketches
+
+    def estimates(self) -> Dict[Tuple[str, str], float]:
+        """Estimated number of distinct values by (tag, attribute)"""
+        return {pair: sketch.estimate() for pair, sketch in self.sketches.items()}
+
+    def save(self, path):
+        pairs = sorted(self.sketches)
+        registers = [self.sketches[pair].registers for pair in pairs]
+        np.savez(
+            path,
+            precision=np.array(self.precision),
+            max_pairs=np.array(self.max_pairs),
+            num_ignored_values=np.array(self.num_ignored_values),
+            num_dropped_sketches=np.array(self.num_dropped_sketches),
+            attrs=np.array(self.attrs if self.attrs is not None else [], dtype=str),
+            has_attrs=np.array(self.attrs is not None),
+            tags=np.array([tag for tag, _ in pairs], dtype=str),
+            pair_attrs=np.array([attr for _, attr in pairs], dtype=str),
+            registers=np.stack(registers) if registers else np.zeros((0, 2 ** self.precision), dtype=np.uint8),
+        )
+
+    @classmethod
+    def load(cls, path) -> "AttributeSketches":
+        with np.load(path) as arrays:
+            attribute_sketches = cls(
+                attrs=arrays["attrs"].tolist() if arrays["has_attrs"] else None,
+                precision=int(arrays["precision"]),
+                max_pairs=int(arrays["max_pairs"]),
+            )
+            attribute_sketches.num_ignored_values = int(arrays["num_ignored_values"])
+            attribute_sketches.num_dropped_sketches = int(arrays["num_dropped_sketches"])
+            pairs = zip(arrays["tags"].tolist(), arrays["pair_attrs"].tolist())
+            for (tag, attr), registers in zip(pairs, arrays["registers"]):
+                attribute_sketches.sketches[(tag, attr)] = HyperLogLog(attribute_sketches.precision, registers.copy())
+        return attribute_sketches
@@ -0,0 +1,72 @@
+"""Compare the extraction time of the tree and of the events engines.
+
+Usage: python benchmarks/benchmark_event_engine.py [--shard_path nq-train-00.jsonl.gz] [--num_documents 200]
+Without `--shard_path`, the Wikipedia page of the tests is used. The documents which the events engine can't handle
+are extracted by the tree engine, they are counted as fallbacks.
+"""
+import argparse
+import gzip
+import json
+import sys
+import time
+
+sys.path.append(".")  # It's not very nice, we need to create a module
+from html_parser import TextAndMetadataCleaner, get_clean_text_and_metadata
+from parse_scripts.parse_natural_questions_Toy_v2 import get_cleaner_config
+
+
+def load_documents(shard_path, num_documents):
+    if shard_path is None:
+        with open("parse_scripts/data_test/raw_wiki_page.txt", "r") as f:
+            return [f.read()] * num_documents
+    doc_htmls = []
+    with gzip.open(shard_path) as fi:
+        for line in fi:
+            doc_htmls.append(json.loads(line)["document_html"])
+            if len(doc_htmls) >= num_documents:
+                break
+    return doc_htmls
+
+
+def run(doc_htmls, engine):
+    start = time.perf_counter()
+    results = []
+    for doc_html in doc_htmls:
+        try:
+            results.append(get_clean_text_and_metadata(doc_html, engine=engine, **get_cleaner_config()))
+        except Exception as error:
+            results.append(repr(error))
+    return time.perf_counter() - start, results
+
+
+def count_fallbacks(doc_htmls):
+    num_fallbacks = 0
+    for doc_html in doc_htmls:
+        cleaner = TextAndMetadataCleaner(doc_html, start_parsing_at_tag="body", engine="events", **get_cleaner_config())
+        try:
+            cleaner._apply_events()
+        except Exception:
+            num_fallbacks += 1
+    return num_fallbacks
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shard_path", dest="shard_path", default=None)
+    parser.add_argument("--num_documents", dest="num_documents", type=int, default=200)
+    args = parser.parse_args()
+
+    doc_htmls = load_documents(args.shard_path, args.num_documents)
+    num_bytes = sum(len(doc_html.encode("UTF-8")) for doc_html in doc_htmls)
+    print(f"{len(doc_htmls)} documents, {num_bytes / 2 ** 20:.1f} MB of HTML")
+
+    tree_time, tree_results = run(doc_htmls, "tree")
+    events_time, events_results = run(doc_htmls, "events")
+    num_differences = sum(
+        tree_result != events_result for tree_result, events_result in zip(tree_results, events_results)
+    )
+    print(f"tree: {len(doc_htmls) / tree_time:.1f} docs/s, events: {len(doc_htmls) / events_time:.1f} docs/s")
+    print(
+        f"speedup: {tree_time / events_time:.2f}, fallbacks: {count_fallbacks(doc_htmls)}, "
+        f"differences: {num_differences}"
+    )
@@ -0,0 +1,74 @@
+"""Compare the time spent to clean the trees by the tree and by the flat engines.
+
+Usage: python benchmarks/benchmark_flat_tree.py [--shard_path nq-train-00.jsonl.gz] [--num_documents 200]
+Without `--shard_path`, the Wikipedia page of the tests is used, along with a deeply nested document: the tree engine
+serializes the text of each sub-tree, so its cost grows with the depth of the elements.
+"""
+import argparse
+import gzip
+import json
+import sys
+import time
+
+sys.path.append(".")  # It's not very nice, we need to create a module
+from html_parser import TagToRemoveWithContent, TextAndMetadataCleaner
+from parse_scripts.parse_natural_questions_Toy_v2 import get_cleaner_config
+
+CLEANER_CONFIG = {
+    **get_cleaner_config(),
+    "tags_to_remove_with_content": get_cleaner_config()["tags_to_remove_with_content"]
+    + [
+        TagToRemoveWithContent(tag="li", content_max_char_length=3),
+        TagToRemoveWithContent(tag="table", content_max_char_length=200, method="bottom-up"),
+    ],
+}
+
+
+def load_documents(shard_path, num_documents):
+    if shard_path is None:
+        with open("parse_scripts/data_test/raw_wiki_page.txt", "r") as f:
+            wiki_html = f.read()
+        nested_html = "<html><body>" + "<div><span>text</span> tail " * 400 + "</div>" * 400 + "</body></html>"
+        return {"wiki page": [wiki_html] * num_documents, "nested divs": [nested_html] * num_documents}
+    doc_htmls = []
+    with gzip.open(shard_path) as fi:
+        for line in fi:
+            doc_htmls.append(json.loads(line)["document_html"])
+            if len(doc_htmls) >= num_documents:
+                break
+    return {shard_path: doc_htmls}
+
+
+def run(doc_htmls, engine):
+    """Cleaning time and extraction results, the documents are parsed and minified beforehand"""
+    prepared_documents = []
+    for doc_html in doc_htmls:
+        cleaner = TextAndMetadataCleaner(doc_html, start_parsing_at_tag="body", engine=engine, **CLEANER_CONFIG)
+        prepared_documents.append((cleaner, cleaner.prepare()))
+
+    cleaning_time = 0.0
+    results = []
+    for cleaner, prepared_document in prepared_documents:
+        start = time.perf_counter()
+        root = cleaner.clean(prepared_document)
+        cleaning_time += time.perf_counter() - start
+        results.append(cleaner.extract(root) if not isinstance(root, tuple) else root)
+    return cleaning_time, results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shard_path", dest="shard_path", default=None)
+    parser.add_argument("--num_documents", dest="num_documents", type=int, default=200)
+    args = parser.parse_args()
+
+    for name, doc_htmls in load_documents(args.shard_path, args.num_documents).items():
+        tree_time, tree_results = run(doc_htmls, "tree")
+        flat_time, flat_results = run(doc_htmls, "flat")
+        num_differences = sum(
+            tree_result != flat_result for tree_result, flat_result in zip(tree_results, flat_results)
+        )
+        print(
+            f"{name}: tree: {len(doc_htmls) / tree_time:.1f} docs/s, flat: {len(doc_htmls) / flat_time:.1f} docs/s, "
+            f"speedup: {tree_time / flat_time:.2f}, differences: {num_differences}"
+        )
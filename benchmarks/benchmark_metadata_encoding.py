@@ -0,0 +1,98 @@
+"""Compare the size and the speed of the JSONL and the binary encodings of the metadata.
+
+Usage: python benchmarks/benchmark_metadata_encoding.py [--shard_path nq-train-00.jsonl.gz] [--num_documents 100]
+Without `--shard_path`, the Wikipedia page of the tests is used.
+"""
+import argparse
+import gzip
+import io
+import json
+import sys
+import time
+import zlib
+
+sys.path.append(".")  # It's not very nice, we need to create a module
+from html_parser import HtmlTag, Metadata, StringVocabulary, get_clean_text_and_metadata
+from metadata_encoder import (
+    MetadataBinaryDecoder,
+    MetadataBinaryEncoder,
+    MetadataJsonEncoder,
+    iter_records,
+    write_record,
+)
+
+
+def load_documents(shard_path, num_documents):
+    if shard_path is None:
+        with open("parse_scripts/data_test/raw_wiki_page.txt", "r") as f:
+            doc_htmls = [f.read()]
+    else:
+        doc_htmls = []
+        with gzip.open(shard_path) as fi:
+            for line in fi:
+                doc_htmls.append(json.loads(line)["document_html"])
+                if len(doc_htmls) >= num_documents:
+                    break
+    return [get_clean_text_and_metadata(doc_html) for doc_html in doc_htmls]
+
+
+def decode_json_line(line):
+    json_example = json.loads(line)
+    metadata = []
+    for metadata_dict in json_example["metadata"]:
+        value = HtmlTag(**metadata_dict.pop("value"))
+        metadata.append(Metadata(value=value, **metadata_dict))
+    return json_example["text"], metadata
+
+
+def benchmark(documents, num_repeats):
+    json_encoder = MetadataJsonEncoder(schema="dataclass")
+    start = time.perf_counter()
+    for _ in range(num_repeats):
+        json_output = b"".join(json_encoder.encode(plain_text, metadata) for plain_text, metadata in documents)
+    json_encode_time = (time.perf_counter() - start) / num_repeats
+
+    start = time.perf_counter()
+    for _ in range(num_repeats):
+        for line in io.BytesIO(json_output):
+            decode_json_line(line)
+    json_decode_time = (time.perf_counter() - start) / num_repeats
+
+    start = time.perf_counter()
+    for _ in range(num_repeats):
+        binary_encoder = MetadataBinaryEncoder(StringVocabulary(intern_attr_values=True))
+        fp = io.BytesIO()
+        for plain_text, metadata in documents:
+            write_record(fp, binary_encoder.encode(plain_text, metadata))
+        binary_output = fp.getvalue()
+    binary_encode_time = (time.perf_counter() - start) / num_repeats
+
+    start = time.perf_counter()
+    for _ in range(num_repeats):
+        decoder = MetadataBinaryDecoder()
+        for record in iter_records(io.BytesIO(binary_output)):
+            decoder.decode(record)
+    binary_decode_time = (time.perf_counter() - start) / num_repeats
+
+    text_size = sum(len(plain_text.encode("UTF-8", errors="surrogatepass")) for plain_text, _ in documents)
+    num_metadata = sum(len(metadata) for _, metadata in documents)
+    print(f"{len(documents)} documents, {num_metadata} metadata, {text_size} bytes of text")
+    print(f"{'format':<8} {'size':>12} {'gzip size':>12} {'encode (s)':>12} {'decode (s)':>12}")
+    for name, output, encode_time, decode_time in [
+        ("jsonl", json_output, json_encode_time, json_decode_time),
+        ("binary", binary_output, binary_encode_time, binary_decode_time),
+    ]:
+        print(
+            f"{name:<8} {len(output):>12} {len(zlib.compress(output, 6)):>12} "
+            f"{encode_time:>12.4f} {decode_time:>12.4f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shard_path", dest="shard_path", default=None)
+    parser.add_argument("--num_documents", dest="num_documents", type=int, default=100)
+    parser.add_argument("--num_repeats", dest="num_repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    benchmark(load_documents(args.shard_path, args.num_documents), args.num_repeats)
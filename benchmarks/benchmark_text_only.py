@@ -0,0 +1,73 @@
+"""Compare the extraction of the text and the metadata with the extraction of the text only.
+
+Usage: python benchmarks/benchmark_text_only.py [--shard_path nq-train-00.jsonl.gz] [--num_documents 200]
+Without `--shard_path`, the Wikipedia page of the tests is used. The time of the extraction step alone (once the tree
+is cleaned) is given too, it's the only step which differs.
+"""
+import argparse
+import gzip
+import json
+import sys
+import time
+
+sys.path.append(".")  # It's not very nice, we need to create a module
+from html_parser import TextAndMetadataCleaner, get_clean_text, get_clean_text_and_metadata
+from parse_scripts.parse_natural_questions_Toy_v2 import get_cleaner_config
+
+
+def load_documents(shard_path, num_documents):
+    if shard_path is None:
+        with open("parse_scripts/data_test/raw_wiki_page.txt", "r") as f:
+            return [f.read()] * num_documents
+    doc_htmls = []
+    with gzip.open(shard_path) as fi:
+        for line in fi:
+            doc_htmls.append(json.loads(line)["document_html"])
+            if len(doc_htmls) >= num_documents:
+                break
+    return doc_htmls
+
+
+def time_calls(function, items):
+    start = time.perf_counter()
+    results = [function(item) for item in items]
+    return time.perf_counter() - start, results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shard_path", dest="shard_path", default=None)
+    parser.add_argument("--num_documents", dest="num_documents", type=int, default=200)
+    args = parser.parse_args()
+
+    doc_htmls = load_documents(args.shard_path, args.num_documents)
+    num_bytes = sum(len(doc_html.encode("UTF-8")) for doc_html in doc_htmls)
+    print(f"{len(doc_htmls)} documents, {num_bytes / 2 ** 20:.1f} MB of HTML")
+
+    full_time, full_results = time_calls(
+        lambda doc_html: get_clean_text_and_metadata(doc_html, **get_cleaner_config()), doc_htmls
+    )
+    text_time, text_results = time_calls(lambda doc_html: get_clean_text(doc_html, **get_cleaner_config()), doc_htmls)
+    num_differences = sum(full_result[0] != text for full_result, text in zip(full_results, text_results))
+    print(
+        f"whole document: text and metadata: {len(doc_htmls) / full_time:.1f} docs/s, text only: "
+        f"{len(doc_htmls) / text_time:.1f} docs/s, speedup: {full_time / text_time:.2f}, "
+        f"differences: {num_differences}"
+    )
+
+    cleaned_trees = []
+    for doc_html in doc_htmls:
+        cleaner = TextAndMetadataCleaner(doc_html, start_parsing_at_tag="body", **get_cleaner_config())
+        root = cleaner.clean(cleaner.prepare())
+        if not isinstance(root, tuple):
+            cleaned_trees.append((cleaner, root))
+    extract_time, _ = time_calls(
+        lambda cleaner_and_root: cleaner_and_root[0].extract(cleaner_and_root[1]), cleaned_trees
+    )
+    extract_text_time, _ = time_calls(
+        lambda cleaner_and_root: cleaner_and_root[0].extract_text(cleaner_and_root[1]), cleaned_trees
+    )
+    print(
+        f"extraction step: text and metadata: {len(cleaned_trees) / extract_time:.1f} docs/s, text only: "
+        f"{len(cleaned_trees) / extract_text_time:.1f} docs/s, speedup: {extract_time / extract_text_time:.2f}"
+    )
@@ -0,0 +1,90 @@
+"""Compare the scaling of the extraction with a pool of threads and with a pool of processes.
+
+Usage: python benchmarks/benchmark_thread_scaling.py [--shard_path nq-train-00.jsonl.gz] [--num_documents 200]
+    [--num_workers 1 2 4 8]
+Without `--shard_path`, the Wikipedia page of the tests is used. Run it with a stock and with a free-threaded
+interpreter (e.g. `python3.13t`): the threads only scale with the GIL while lxml parses the documents.
+"""
+import argparse
+import gzip
+import json
+import multiprocessing
+import sys
+import time
+
+sys.path.append(".")  # It's not very nice, we need to create a module
+from html_parser import HtmlExtractor, TagToRemoveWithContent
+
+EXTRACTOR = HtmlExtractor(
+    tags_to_remove_with_content=[
+        TagToRemoveWithContent(tag="script"),
+        TagToRemoveWithContent(tag="style"),
+        TagToRemoveWithContent(tag="header"),
+        TagToRemoveWithContent(tag="iframe"),
+        TagToRemoveWithContent(tag="footer"),
+        TagToRemoveWithContent(tag="form"),
+    ],
+    consecutive_tags_to_fold=["div"],
+)
+
+
+def load_documents(shard_path, num_documents):
+    if shard_path is None:
+        with open("parse_scripts/data_test/raw_wiki_page.txt", "r") as f:
+            return [f.read()] * num_documents
+    doc_htmls = []
+    with gzip.open(shard_path) as fi:
+        for line in fi:
+            doc_htmls.append(json.loads(line)["document_html"])
+            if len(doc_htmls) >= num_documents:
+                break
+    return doc_htmls
+
+
+def is_gil_enabled():
+    # `sys._is_gil_enabled` only exists from Python 3.13
+    return sys._is_gil_enabled() if hasattr(sys, "_is_gil_enabled") else True
+
+
+def run_threads(doc_htmls, num_workers):
+    start = time.perf_counter()
+    for _ in EXTRACTOR.map(doc_htmls, num_threads=num_workers):
+        pass
+    return time.perf_counter() - start
+
+
+def run_processes(doc_htmls, num_workers):
+    start = time.perf_counter()
+    # The documents and the results are pickled between the processes
+    with multiprocessing.get_context("spawn").Pool(num_workers) as pool:
+        for _ in pool.imap(EXTRACTOR, doc_htmls, chunksize=4):
+            pass
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shard_path", dest="shard_path", default=None)
+    parser.add_argument("--num_documents", dest="num_documents", type=int, default=200)
+    parser.add_argument("--num_workers", dest="num_workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    doc_htmls = load_documents(args.shard_path, args.num_documents)
+    num_bytes = sum(len(doc_html.encode("UTF-8")) for doc_html in doc_htmls)
+    print(f"Python {sys.version.split()[0]}, GIL enabled: {is_gil_enabled()}, {multiprocessing.cpu_count()} CPUs")
+    print(f"{len(doc_htmls)} documents, {num_bytes / 2 ** 20:.1f} MB of HTML")
+
+    sequential_time = None
+    print(f"{'workers':>8} {'threads (docs/s)':>17} {'speedup':>8} {'processes (docs/s)':>19} {'speedup':>8}")
+    for num_workers in args.num_workers:
+        thread_time = run_threads(doc_htmls, num_workers)
+        process_time = run_processes(doc_htmls, num_workers)
+        if sequential_time is None:
+            start = time.perf_counter()
+            for doc_html in doc_htmls:
+                EXTRACTOR(doc_html)
+            sequential_time = time.perf_counter() - start
+        print(
+            f"{num_workers:>8} {len(doc_htmls) / thread_time:>17.1f} {sequential_time / thread_time:>8.2f} "
+            f"{len(doc_htmls) / process_time:>19.1f} {sequential_time / process_time:>8.2f}"
+        )
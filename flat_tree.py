@@ -0,0 +1,214 @@
+from bisect import bisect_left
+
+import numpy as np
+from lxml import etree
+
+
+class FlatTree:
+    """Elements of an lxml tree in document order, as parallel integer arrays.
+
+    The element `i` has the tag `tags[tag_ids[i]]`, the parent `parents[i]`, the first child `first_children[i]` and
+    the next sibling `next_siblings[i]` (-1 if none). Its sub-tree is made of the elements `i` to
+    `subtree_ends[i] - 1`. The texts and the tails of the elements are laid out in document order in a single buffer
+    (which is never built): the text of the element starts at `text_starts[i]` and its tail at `tail_starts[i]`.
+    """
+
+    def __init__(self, root):
+        self.elements = []
+        self.tags = []
+        self._tag_ids = {}
+        # The comments and the processing instructions are not reported by `iterwalk`, nor their tails
+        self.has_special_nodes = bool(root.xpath("boolean(//comment() | //processing-instruction())"))
+
+        parents = []
+        depths = []
+        tag_ids = []
+        text_starts = []
+        tail_starts = []
+        subtree_ends = []
+        stack = []
+        num_chars = 0
+        for event, element in etree.iterwalk(root, events=("start", "end")):
+            if event == "start":
+                element_idx = len(self.elements)
+                self.elements.append(element)
+                parents.append(stack[-1] if stack else -1)
+                depths.append(len(stack))
+                tag_ids.append(self.get_tag_id(element.tag))
+                text_starts.append(num_chars)
+                tail_starts.append(0)
+                subtree_ends.append(0)
+                if element.text:
+                    num_chars += len(element.text)
+                stack.append(element_idx)
+            else:
+                element_idx = stack.pop()
+                tail_starts[element_idx] = num_chars
+                subtree_ends[element_idx] = len(self.elements)
+                if element.tail and stack:
+                    num_chars += len(element.tail)
+
+        self.parents = np.array(parents, dtype=np.int64)
+        self.depths = np.array(depths, dtype=np.int64)
+        self.tag_ids = np.array(tag_ids, dtype=np.int64)
+        self.text_starts = np.array(text_starts, dtype=np.int64)
+        self.tail_starts = np.array(tail_starts, dtype=np.int64)
+        self.subtree_ends = np.array(subtree_ends, dtype=np.int64)
+
+        self.num_children = np.bincount(self.parents[1:], minlength=len(self)) if len(self) else np.zeros(0, int)
+        # In document order, the first child of an element comes right after it and the next sibling right after
+        # its sub-tree
+        element_idxs = np.arange(len(self))
+        self.first_children = np.where(self.num_children > 0, element_idxs + 1, -1)
+        parent_ends = self.subtree_ends[np.maximum(self.parents, 0)]
+        self.next_siblings = np.where((self.parents >= 0) & (self.subtree_ends < parent_ends), self.subtree_ends, -1)
+
+    def __len__(self):
+        return len(self.elements)
+
+    def get_tag_id(self, tag) -> int:
+        if tag not in self._tag_ids:
+            self._tag_ids[tag] = len(self.tags)
+            self.tags.append(tag)
+        return self._tag_ids[tag]
+
+    def lookup(self, values_by_tag: dict, default, dtype=None) -> np.ndarray:
+        """Array of the values of the tags, by tag id, to map an array of tag ids in a single operation"""
+        return np.array([values_by_tag.get(tag, default) for tag in self.tags], dtype=dtype)
+
+    def subtree_text_lengths(self) -> np.ndarray:
+        """Length of the text of the sub-tree of each element, without its tail (as `etree.tostring(method="text")`)"""
+        return self.tail_starts - self.text_starts
+
+    def inside_subtrees(self, mask: np.ndarray) -> np.ndarray:
+        """Whether each element is in the sub-tree of an element of `mask`, this element excluded"""
+        element_idxs = np.flatnonzero(mask)
+        starts = np.bincount(element_idxs + 1, minlength=len(self) + 1)
+        ends = np.bincount(self.subtree_ends[element_idxs], minlength=len(self) + 1)
+        return np.cumsum(starts - ends)[: len(self)] > 0
+
+
+def _receiving_text_length(previous, parent) -> int:
+    """Length of the texts which receive the tail of an element of `parent` removed after `previous`"""
+    if previous is not None:
+        return len(previous.text or "") + len(previous.tail or "")
+    return len(parent.text or "") if parent is not None else 0
+
+
+def clean_flat_tree(root, tag_filter, consecutive_tag_cleaner, remove_element) -> bool:
+    """Clean `root` in place exactly as `TextAndMetadataCleaner._clean_etree` does, with the decisions computed on
+    the arrays of a `FlatTree` instead of serializing the text of each sub-tree twice.
+
+    The folding of the consecutive tags and the top-down removals are decided depth by depth for all the elements at
+    once. The elements are then folded and removed (by `remove_element`) in the same order as by `_clean_etree`; the
+    length of the content of an element with a bottom-up rule is its original length minus the content of the
+    elements removed inside it, corrected by the separators added when their tails are merged. Returns False,
+    without modifying the tree, when it has nodes or tags that the arrays can't represent.
+    """
+    flat_tree = FlatTree(root)
+    fake_tags = [
+        consecutive_tag_cleaner.fake_tag_block,
+        consecutive_tag_cleaner.fake_tag_inline,
+        consecutive_tag_cleaner.fake_tag_basic,
+    ]
+    if (
+        flat_tree.has_special_nodes
+        or set(fake_tags) & set(flat_tree.tags)
+        or set(fake_tags) & set(consecutive_tag_cleaner.consecutive_tags_to_fold)
+        or root.xpath("boolean(//@previous_tag)")
+    ):
+        return False
+    for tag in fake_tags:
+        flat_tree.get_tag_id(tag)
+
+    # Rules by tag id
+    fold_tags = flat_tree.lookup({tag: True for tag in consecutive_tag_cleaner.consecutive_tags_to_fold}, False)
+    is_fake = flat_tree.lookup({tag: True for tag in fake_tags}, False)
+    fake_tag_of = np.array(
+        [flat_tree.get_tag_id(consecutive_tag_cleaner.get_fake_tag(tag)) for tag in list(flat_tree.tags)]
+    )
+    rules = tag_filter.tags_to_remove_with_content
+    is_bottom_up = flat_tree.lookup({tag: rule.method != "top-down" for tag, rule in rules.items()}, False)
+    top_down_rules = {tag: rule for tag, rule in rules.items() if rule.method == "top-down"}
+    bottom_up_rules = {tag: rule for tag, rule in rules.items() if rule.method == "bottom-up"}
+    # A tag without a rule gets an empty range of lengths
+    top_down_min = flat_tree.lookup({tag: rule.content_min_char_length for tag, rule in top_down_rules.items()}, 1)
+    top_down_max = flat_tree.lookup({tag: rule.content_max_char_length for tag, rule in top_down_rules.items()}, 0)
+    bottom_up_min = flat_tree.lookup({tag: rule.content_min_char_length for tag, rule in bottom_up_rules.items()}, 1)
+    bottom_up_max = flat_tree.lookup({tag: rule.content_max_char_length for tag, rule in bottom_up_rules.items()}, 0)
+    is_exception = flat_tree.lookup({tag: True for tag in tag_filter.tags_exceptions_with_content}, False)
+
+    # An element absorbs its single child according to its own tag once it's folded in its parent, so the decisions
+    # are only computed again under the elements whose tag changed
+    tag_ids = flat_tree.tag_ids.copy()
+    previous_tag_ids = np.full(len(flat_tree), -1)
+    folds = np.zeros(len(flat_tree), dtype=bool)
+    has_single_child = flat_tree.num_children == 1
+    single_parents = np.flatnonzero(has_single_child)
+    while len(single_parents):
+        children = flat_tree.first_children[single_parents]
+        parent_tag_ids = tag_ids[single_parents]
+        child_tag_ids = flat_tree.tag_ids[children]
+        parent_folds = (fold_tags[parent_tag_ids] & (child_tag_ids == parent_tag_ids)) | (
+            is_fake[parent_tag_ids] & (previous_tag_ids[single_parents] == child_tag_ids)
+        )
+        folds[single_parents] = parent_folds
+        new_tag_ids = np.where(parent_folds, fake_tag_of[parent_tag_ids], child_tag_ids)
+        new_previous_tag_ids = np.where(parent_folds, parent_tag_ids, -1)
+        changed = (tag_ids[children] != new_tag_ids) | (previous_tag_ids[children] != new_previous_tag_ids)
+        tag_ids[children] = new_tag_ids
+        previous_tag_ids[children] = new_previous_tag_ids
+        single_parents = children[changed & has_single_child[children]]
+
+    # Nothing has been removed yet from the sub-tree of an element when it's reached, and the elements inside a removed
+    # sub-tree are never reached
+    lengths = flat_tree.subtree_text_lengths()
+    removed_top_down = ~is_bottom_up[tag_ids] & (
+        ((top_down_min[tag_ids] <= lengths) & (lengths <= top_down_max[tag_ids]))
+        | (
+            ~is_exception[tag_ids]
+            & (tag_filter.txt_min_chr_len_with_content <= lengths)
+            & (lengths <= tag_filter.txt_max_chr_len_with_content)
+        )
+    )
+    visited = ~flat_tree.inside_subtrees(removed_top_down)
+    removed_top_down &= visited
+    folds &= visited
+
+    for element_idx in np.flatnonzero(folds):
+        consecutive_tag_cleaner(flat_tree.elements[element_idx])
+
+    # The top-down removals happen when the element is reached and the bottom-up ones once its sub-tree is done
+    top_down_idxs = np.flatnonzero(removed_top_down)
+    bottom_up_idxs = np.flatnonzero(visited & ~removed_top_down & (bottom_up_min[tag_ids] <= bottom_up_max[tag_ids]))
+    event_idxs = np.concatenate([top_down_idxs, bottom_up_idxs])
+    event_order = np.lexsort(
+        (
+            np.concatenate([np.zeros(len(top_down_idxs)), -flat_tree.depths[bottom_up_idxs]]),
+            np.concatenate([np.zeros(len(top_down_idxs)), np.ones(len(bottom_up_idxs))]),
+            np.concatenate([top_down_idxs, flat_tree.subtree_ends[bottom_up_idxs] - 1]),
+        )
+    )
+    is_top_down_event = np.concatenate([np.ones(len(top_down_idxs), bool), np.zeros(len(bottom_up_idxs), bool)])
+
+    # Outermost removed elements so far (in document order) and how much each one shortened the text around it
+    removed_idxs = []
+    removed_lengths = {}
+    for event_idx in event_order:
+        element_idx = int(event_idxs[event_idx])
+        subtree_end = int(flat_tree.subtree_ends[element_idx])
+        start = bisect_left(removed_idxs, element_idx)
+        end = bisect_left(removed_idxs, subtree_end)
+        if not is_top_down_event[event_idx]:
+            length = lengths[element_idx] - sum(removed_lengths[idx] for idx in removed_idxs[start:end])
+            if not bottom_up_min[tag_ids[element_idx]] <= length <= bottom_up_max[tag_ids[element_idx]]:
+                continue
+
+        element = flat_tree.elements[element_idx]
+        previous, parent = element.getprevious(), element.getparent()
+        text_length = _receiving_text_length(previous, parent) + len(element.tail or "")
+        remove_element(element)
+        separator_length = _receiving_text_length(previous, parent) - text_length
+        removed_idxs[start:end] = [element_idx]
+        removed_lengths[element_idx] = lengths[element_idx] - separator_length
+    return True
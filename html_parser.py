@@ -1,14 +1,35 @@
+import dataclasses
+import hashlib
 import pprint
 import re
+import threading
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
 from dataclasses import dataclass
+from html import escape
 from html.entities import name2codepoint
 from html.parser import HTMLParser
-from typing import DefaultDict, List, Optional, Tuple
+from typing import DefaultDict, Dict, Iterable, Iterator, List, Optional, Tuple
 
 import htmlmin
 from lxml import etree
 from lxml.html import fromstring
 
+from attribute_sketches import AttributeSketches
+from flat_tree import clean_flat_tree
+
+# The events engine replays private parts of htmlmin, checked against these versions only
+SUPPORTED_HTMLMIN_VERSIONS = ["0.1.12"]
+try:
+    from htmlmin.escape import CHARS_TO_QUOTE_RE
+    from htmlmin.parser import HTML_SPACE_RE, TAG_SETS
+except ImportError:
+    CHARS_TO_QUOTE_RE = HTML_SPACE_RE = TAG_SETS = None
+
+# To bump each time the output of the parser changes, it invalidates the cached results
+__version__ = "0.2.0"
+
 FAKE_TAG_BLOCK = "fake_tag_block"
 FAKE_TAG_INLINE = "fake_tag_inline"
 FAKE_TAG_BASIC = "fake_tag_basic"
@@ -90,6 +111,59 @@ PRE_TAG = "pre"
 PLAIN_TEXT_SEPARATOR = " "
 BLOCK_CONTENT_SEPARATOR = "\n"
 
+LIMIT_POLICIES = ["skip", "truncate", "text-only"]
+
+# "tree" cleans a tree of the minified body, "events" extracts directly from the parsing events when the config allows
+# it (see `TextAndMetadataCleaner.supports_event_engine`) and falls back to "tree" otherwise, "flat" cleans the same
+# tree with decisions computed on arrays (see `flat_tree.clean_flat_tree`)
+ENGINES = ["tree", "events", "flat"]
+FAKE_TAGS = [FAKE_TAG_BLOCK, FAKE_TAG_INLINE, FAKE_TAG_BASIC]
+# Tags whose content htmlmin leaves untouched, as the content of the tags with a `pre` attribute
+HTMLMIN_PRE_TAGS = {"pre", "textarea", "script", "style"}
+# Character references in an attribute value which htmlmin unescapes again
+HTMLMIN_UNESCAPED_REFERENCE_RE = re.compile(r"&(?:#|[A-Za-z][A-Za-z0-9]*;)")
+# Tags whose content libxml2 doesn't parse, their text is escaped by the serialization of the body
+HTML_ESCAPED_TEXT_TAGS = {"iframe", "xmp", "noembed", "noframes"}
+# Tags serialized by lxml without a closing tag, <li> too when it's empty
+HTML_EMPTY_TAGS = {
+    "area",
+    "base",
+    "basefont",
+    "br",
+    "col",
+    "frame",
+    "hr",
+    "img",
+    "input",
+    "isindex",
+    "link",
+    "meta",
+    "param",
+}
+# The comments that htmlmin keeps, they end up in the tree cleaned by the tree engine
+HTMLMIN_KEPT_COMMENTS_RE = re.compile(r"^(?:!|\[if\s)")
+# Attributes given their name as value by libxml2 when they have no value in the minified HTML
+HTML_BOOLEAN_ATTRIBUTES = {
+    "checked",
+    "compact",
+    "declare",
+    "defer",
+    "disabled",
+    "ismap",
+    "multiple",
+    "nohref",
+    "noresize",
+    "noshade",
+    "nowrap",
+    "readonly",
+    "selected",
+}
+BODY_START_TAG_RE = re.compile(r"<body[\s/>]", re.IGNORECASE)
+# The documents for which `lxml.html.fromstring` returns the whole document
+FULL_HTML_DOCUMENT_RE = re.compile(r"^\s*<(?:html|!doctype)", re.IGNORECASE)
+# Same characters as `str.isspace`
+WHITESPACES_RE = re.compile(r"\s+")
+
 
 @dataclass
 class TagToRemove:
@@ -121,32 +195,163 @@ class Metadata:
     relative_end_pos: Optional[int] = None
     key: str = "html"
     type: str = "local"
+    # Offsets in the UTF-8 encoded text, only set when the extraction tracks them
+    byte_start_idx: Optional[int] = None
+    byte_end_idx: Optional[int] = None
+
+
+@dataclass
+class DocumentLimits:
+    max_input_bytes: float = float("inf")
+    max_elements: float = float("inf")
+    max_depth: float = float("inf")
+    max_metadata: float = float("inf")
+    input_bytes_policy: str = "truncate"  # or "skip" or "text-only"
+    elements_policy: str = "text-only"
+    depth_policy: str = "truncate"
+    metadata_policy: str = "truncate"
+
+
+@dataclass
+class LimitDecision:
+    limit: str
+    value: int
+    max_value: float
+    policy: str
+
+
+@dataclass
+class DocumentStats:
+    """Structural statistics of a document, collected while it's cleaned and extracted.
+
+    The elements are the ones of the cleaned tree (the folded elements have a fake tag), whether their metadata is kept
+    or not. The depth of its root (<html>) is 0. The statistics of several documents can be summed with `update`.
+    """
+
+    # Number of elements, by tag
+    tag_counts: Dict[str, int] = dataclasses.field(default_factory=dict)
+    # Sum of the lengths of the text of the elements, by tag
+    text_lengths: Dict[str, int] = dataclasses.field(default_factory=dict)
+    # Number of void elements (without content nor closing tag, as <br>), by tag
+    void_element_counts: Dict[str, int] = dataclasses.field(default_factory=dict)
+    # Number of elements by depth
+    depth_histogram: List[int] = dataclasses.field(default_factory=list)
+    # Number of elements removed with their content by the cleaning, by tag
+    removed_with_content_counts: Dict[str, int] = dataclasses.field(default_factory=dict)
+    # Number of elements whose metadata was dropped (`tags_to_remove_alone`, `txt_*_chr_len_alone`), by tag
+    dropped_alone_counts: Dict[str, int] = dataclasses.field(default_factory=dict)
+
+    def add_element(self, tag: str, depth: int, text_length: int):
+        self.tag_counts[tag] = self.tag_counts.get(tag, 0) + 1
+        self.text_lengths[tag] = self.text_lengths.get(tag, 0) + text_length
+        if tag in HTML_EMPTY_TAGS:
+            self.void_element_counts[tag] = self.void_element_counts.get(tag, 0) + 1
+        if depth >= len(self.depth_histogram):
+            self.depth_histogram.extend([0] * (depth + 1 - len(self.depth_histogram)))
+        self.depth_histogram[depth] += 1
+
+    def update(self, other: "DocumentStats"):
+        for field in [
+            "tag_counts",
+            "text_lengths",
+            "void_element_counts",
+            "removed_with_content_counts",
+            "dropped_alone_counts",
+        ]:
+            counts = getattr(self, field)
+            for tag, count in getattr(other, field).items():
+                counts[tag] = counts.get(tag, 0) + count
+        if len(other.depth_histogram) > len(self.depth_histogram):
+            self.depth_histogram.extend([0] * (len(other.depth_histogram) - len(self.depth_histogram)))
+        for depth, count in enumerate(other.depth_histogram):
+            self.depth_histogram[depth] += count
+
+
+class StringVocabulary:
+    """Interning table of the tag names and attribute keys (and optionally values) seen by a worker.
+
+    Equal strings are replaced by a single shared object, and each distinct string gets a stable integer ID (its
+    position in `strings`) that the output writers can use instead of the string. The attribute values are only
+    interned if `intern_attr_values` is set and if they are at most `max_value_length` characters long, so that the
+    table doesn't grow with unique values (texts, urls, ...). A vocabulary can be shared by threads.
+    """
+
+    def __init__(self, intern_attr_values: bool = False, max_value_length: int = 64):
+        self.intern_attr_values = intern_attr_values
+        self.max_value_length = max_value_length
+        self.strings = []
+        self._ids = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.strings)
+
+    def __contains__(self, string):
+        return string in self._ids
+
+    def intern(self, string: str) -> str:
+        string_id = self._ids.get(string)
+        if string_id is None:
+            with self._lock:
+                string_id = self._ids.get(string)
+                if string_id is None:
+                    string_id = len(self.strings)
+                    # The string is added before its ID so that the readers without the lock never miss it
+                    self.strings.append(string)
+                    self._ids[string] = string_id
+        return self.strings[string_id]
+
+    def intern_value(self, value: str) -> str:
+        if not self.intern_attr_values or len(value) > self.max_value_length:
+            return value
+        return self.intern(value)
+
+    def get_id(self, string: str) -> int:
+        self.intern(string)
+        return self._ids[string]
+
+    def get_string(self, string_id: int) -> str:
+        return self.strings[string_id]
 
 
 class AttributeCleaner:
-    def __init__(self, attrs_to_keep: Optional[List[str]]):
+    def __init__(self, attrs_to_keep: Optional[List[str]], vocabulary: Optional[StringVocabulary] = None):
         self.attrs_to_keep = attrs_to_keep
+        self.vocabulary = vocabulary
 
     def _test(self, attr):
         return self.attrs_to_keep is None or attr in self.attrs_to_keep
 
+    def select(self, attrs) -> dict:
+        """Kept attributes and their values, not interned"""
+        return {attr: value for attr, value in dict(attrs).items() if self._test(attr)}
+
     def __call__(self, attrs: List[Tuple[str]]):
         if isinstance(attrs, list):
             attrbs = [attr for attr, value in attrs if self._test(attr)]
             values = [value for attr, value in attrs if self._test(attr)]
-            return {
-                "attrs": attrbs,
-                "values": values,
-            }
         else:
             attrs = dict(attrs)
 
             attrbs = [attr for attr, value in attrs.items() if self._test(attr)]
             values = [value for attr, value in attrs.items() if self._test(attr)]
-            return {
-                "attrs": attrbs,
-                "values": values,
-            }
+
+        if self.vocabulary is not None:
+            attrbs = [self.vocabulary.intern(attr) for attr in attrbs]
+            values = [self.vocabulary.intern_value(value) for value in values]
+        return {
+            "attrs": attrbs,
+            "values": values,
+        }
 
 
 class TagFilter:
@@ -281,25 +486,26 @@ class ConsecutiveTagCleaner:
         self.attrib_separator = " "
         self.block_elements = block_elements
 
+    def folds(self, tag, attrib, child_tag):
+        """Whether an element with a single child of tag `child_tag` absorbs this child"""
+        return (tag in self.consecutive_tags_to_fold and child_tag == tag) or (
+            tag in FAKE_TAGS
+            and "previous_tag" in attrib
+            and child_tag == attrib["previous_tag"]
+        )
+
+    def get_fake_tag(self, tag):
+        """Tag given to the child absorbed by an element of tag `tag`, it keeps the spacing of the text"""
+        if tag in self.block_elements:
+            return self.fake_tag_block
+        elif tag in INLINE_ELEMENTS_SPACING:
+            return self.fake_tag_inline
+        return self.fake_tag_basic
+
     def __call__(self, root):
         tag = root.tag
-        if (
-            tag in self.consecutive_tags_to_fold
-            and len(root) == 1
-            and root[0].tag == tag
-        ) or (
-            tag in [FAKE_TAG_BLOCK, FAKE_TAG_INLINE, FAKE_TAG_BASIC]
-            and len(root) == 1
-            and "previous_tag" in root.attrib
-            and root[0].tag == root.attrib["previous_tag"]
-        ):  # has 1 child
-
-            if tag in self.block_elements:
-                root[0].tag = self.fake_tag_block
-            elif tag in INLINE_ELEMENTS_SPACING:
-                root[0].tag = self.fake_tag_inline
-            else:
-                root[0].tag = self.fake_tag
+        if len(root) == 1 and self.folds(tag, root.attrib, root[0].tag):  # has 1 child
+            root[0].tag = self.get_fake_tag(tag)
 
             parent_root = root
             while parent_root.tag in [FAKE_TAG_BLOCK, FAKE_TAG_INLINE, FAKE_TAG_BASIC]:
@@ -313,12 +519,205 @@ class ConsecutiveTagCleaner:
             root[0].attrib["previous_tag"] = tag
 
 
+@dataclass
+class PreparedDocument:
+    limit_decisions: List[LimitDecision]
+    # Minified HTML of the selected root, ready to be cleaned, or directly its tree
+    html_str: Optional[str] = None
+    root: Optional[etree._Element] = None
+    # The root was wrapped in a <html> tag which must not be part of the metadata
+    wrapped_in_html: bool = False
+    # Set when a limit was exceeded, along with the root to use for the text-only fallback
+    degrade_policy: Optional[str] = None
+    degraded_root: Optional[etree._Element] = None
+
+
+def _utf8_length(text: str) -> int:
+    return len(text.encode("UTF-8", errors="surrogatepass"))
+
+
+def parse_html_eliding(html_str, tags_to_elide):
+    """`lxml.html.fromstring`, except that the elements of `tags_to_elide` are emptied right after the parsing.
+
+    The emptied elements (no children, text or attributes, the tail is kept) are lighter to select, serialize and
+    minify in the next steps.
+    """
+    root = fromstring(html_str)
+    if tags_to_elide:
+        # Emptying an element while iterating would stop the iteration at its first child
+        for element in list(root.iter(*tags_to_elide)):
+            element.clear(keep_tail=True)
+    return root
+
+
+def _first_whitespace(match):
+    whitespace = match.group()[0]
+    return PLAIN_TEXT_SEPARATOR if whitespace in "\r\n" else whitespace
+
+
+def _collapse_whitespaces(text: str, previous_char: str) -> str:
+    """`text` as appended after `previous_char` outside of a <pre>: the non-breaking spaces become spaces and each run
+    of whitespaces is reduced to its first character (a space for a line break), or removed after a whitespace or at
+    the start of the text"""
+    text = WHITESPACES_RE.sub(_first_whitespace, text.replace("\u00a0", " "))
+    if text[:1].isspace() and (not previous_char or previous_char.isspace()):
+        return text[1:]
+    return text
+
+
+def _add_text_chunk(chunks: List[str], tag, new_text, block_elements: set, inline_elements: set):
+    """`TextAndMetadataCleaner._add_text` for a text made of non-empty `chunks`"""
+    last_char = chunks[-1][-1] if chunks else ""
+    if tag in block_elements:
+        if last_char == PLAIN_TEXT_SEPARATOR:
+            chunks[-1] = chunks[-1][:-1] + BLOCK_CONTENT_SEPARATOR
+            last_char = BLOCK_CONTENT_SEPARATOR
+        elif last_char and last_char != BLOCK_CONTENT_SEPARATOR:
+            chunks.append(BLOCK_CONTENT_SEPARATOR)
+            last_char = BLOCK_CONTENT_SEPARATOR
+    elif tag in inline_elements:
+        if last_char and last_char != PLAIN_TEXT_SEPARATOR and last_char != BLOCK_CONTENT_SEPARATOR:
+            chunks.append(PLAIN_TEXT_SEPARATOR)
+            last_char = PLAIN_TEXT_SEPARATOR
+
+    if new_text:
+        chunk = new_text if tag == PRE_TAG else _collapse_whitespaces(new_text, last_char)
+        if chunk:
+            chunks.append(chunk)
+
+
 def remove_keeping_tail(element):
     """Safe the tail text and then delete the element"""
     _preserve_tail_before_delete(element)
     element.getparent().remove(element)
 
 
+@dataclass
+class SubtreeCacheEntry:
+    tag: str
+    # Last character of the text before the sub-tree, once the sub-tree has been processed (it can be replaced by a
+    # block separator)
+    previous_char: str
+    text: str
+    # (char_start_offset, relative_start_pos, char_end_offset, relative_end_pos, tag, attrs, byte_start_offset,
+    # byte_end_offset) of the kept metadata, the offsets are relative to the start of the sub-tree text
+    metadata: list
+    # Number of metadata (kept or dropped) which start or end at each offset
+    num_metadata_by_offset: Counter
+    text_num_bytes: int
+
+    def size(self):
+        return len(self.text) + SubtreeCache.METADATA_SIZE_IN_CHARS * len(self.metadata)
+
+
+class SubtreeCache:
+    """LRU cache of the text and metadata extracted from sub-trees, keyed by a structural hash of the sub-tree.
+
+    It is meant to be shared between the documents of a corpus which repeat the same blocks (navboxes, sidebars,
+    reference templates, ...). Only the sub-trees with at least `min_elements` elements, and whose tag is in `tags` if
+    set, are cached. The memory is bounded by `max_chars`, where a metadata counts as `METADATA_SIZE_IN_CHARS`
+    characters. A cache can be shared by threads.
+    """
+
+    METADATA_SIZE_IN_CHARS = 64
+
+    def __init__(self, max_chars: int = 50_000_000, min_elements: int = 8, tags: Optional[List[str]] = None):
+        self.max_chars = max_chars
+        self.min_elements = min_elements
+        self.tags = set(tags) if tags is not None else None
+        self.hits = Counter()
+        self.misses = Counter()
+        self.num_evictions = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def is_eligible(self, tag: str, num_elements: int):
+        return num_elements >= self.min_elements and (self.tags is None or tag in self.tags)
+
+    def get(self, key, tag: str) -> Optional[SubtreeCacheEntry]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses[tag] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits[tag] += 1
+            return entry
+
+    def put(self, key, entry: SubtreeCacheEntry):
+        with self._lock:
+            if key in self._entries or entry.size() > self.max_chars:
+                return
+            self._entries[key] = entry
+            self._size += entry.size()
+            while self._size > self.max_chars:
+                _, evicted_entry = self._entries.popitem(last=False)
+                self._size -= evicted_entry.size()
+                self.num_evictions += 1
+
+    def stats(self) -> dict:
+        stats_by_tag = {}
+        for tag in sorted(set(self.hits) | set(self.misses)):
+            num_lookups = self.hits[tag] + self.misses[tag]
+            stats_by_tag[tag] = {
+                "hits": self.hits[tag],
+                "misses": self.misses[tag],
+                "hit_rate": self.hits[tag] / num_lookups,
+            }
+        num_hits = sum(self.hits.values())
+        num_lookups = num_hits + sum(self.misses.values())
+        return {
+            "hit_rate": num_hits / num_lookups if num_lookups else 0.0,
+            "num_entries": len(self._entries),
+            "size_chars": self._size,
+            "num_evictions": self.num_evictions,
+            "by_tag": stats_by_tag,
+        }
+
+
+def _iter_elements_with_depth(root, max_depth=float("inf")):
+    """Iterate over the elements of the tree in document order without recursion, the root is at depth 1"""
+    stack = [(root, 1)]
+    while stack:
+        node, depth = stack.pop()
+        yield node, depth
+        if depth < max_depth:
+            stack.extend(
+                (child, depth + 1) for child in reversed(node) if isinstance(child.tag, str)
+            )
+
+
+def truncate_depth(root, max_depth):
+    """Flatten the elements nested deeper than max_depth into their ancestor at max_depth, keeping their text"""
+    nodes_to_flatten = [
+        node
+        for node, depth in _iter_elements_with_depth(root, max_depth=max_depth)
+        if depth == max_depth and len(node)
+    ]
+    for node in nodes_to_flatten:
+        etree.strip_tags(node, "*")
+
+
+def truncate_elements(root, max_elements):
+    """Remove (with their tail) the elements coming after the first max_elements ones in document order"""
+    elements = [node for node, _ in _iter_elements_with_depth(root)]
+    kept_elements = set(elements[: max(int(max_elements), 1)])
+    for node in elements[max(int(max_elements), 1) :]:
+        parent = node.getparent()
+        if parent in kept_elements:
+            parent.remove(node)
+
+
 def _preserve_tail_before_delete(node):
     if node.tail:  # preserve the tail
         previous = node.getprevious()
@@ -379,8 +778,23 @@ class TextAndMetadataCleaner:
         txt_max_chr_len_with_content: float = -float("inf"),
         txt_min_chr_len_with_content: float = -float("inf"),
         tags_exceptions_to_txt_max_min_chr_len_with_content: List[str] = None,
+        document_limits: Optional[DocumentLimits] = None,
+        subtree_cache: Optional[SubtreeCache] = None,
+        vocabulary: Optional[StringVocabulary] = None,
+        track_byte_offsets: bool = False,
+        engine: str = "tree",
+        stats: Optional[DocumentStats] = None,
+        attribute_sketches: Optional[AttributeSketches] = None,
     ):
+        if engine not in ENGINES:
+            raise ValueError(f"You have requested an invalid engine ({engine}). Valid engines are {ENGINES}.")
+        self.engine = engine
+        self.stats = stats
+        self.attribute_sketches = attribute_sketches
         self.html_str = html_str
+        self.track_byte_offsets = track_byte_offsets
+        self.subtree_cache = subtree_cache
+        self.vocabulary = vocabulary
         self.tags_to_remove_with_content = tags_to_remove_with_content
         self.tags_to_remove_alone = tags_to_remove_alone
         self.attrs_to_keep = attrs_to_keep
@@ -412,7 +826,7 @@ class TextAndMetadataCleaner:
             consecutive_tags_to_fold=consecutive_tags_to_fold,
         )
 
-        self.attribute_cleaner = AttributeCleaner(attrs_to_keep=attrs_to_keep)
+        self.attribute_cleaner = AttributeCleaner(attrs_to_keep=attrs_to_keep, vocabulary=vocabulary)
         self.tag_filter = TagFilter(
             txt_max_chr_len_alone=txt_max_chr_len_alone,
             txt_min_chr_len_alone=txt_min_chr_len_alone,
@@ -424,20 +838,66 @@ class TextAndMetadataCleaner:
             tags_to_remove_with_content=tags_to_remove_with_content,
         )
 
+        self.document_limits = document_limits
+        if self.document_limits is not None:
+            for limit in ["input_bytes", "elements", "depth", "metadata"]:
+                policy = getattr(self.document_limits, f"{limit}_policy")
+                if policy not in LIMIT_POLICIES:
+                    raise ValueError(
+                        f"You have requested the policy '{policy}' when the {limit} limit is exceeded. Valid "
+                        f"policies are {LIMIT_POLICIES}."
+                    )
+        self.limit_decisions = []
+        self.tags_to_elide = self._get_tags_to_elide()
+        # Tags dropped from the metadata of the current document only, the config of the cleaner is never modified
+        self._tags_to_drop_alone = set()
+        # Tag and attributes of the elements before the cleaning, for the attribute sketches
+        self._original_attributes = {}
+
     def apply(self):
+        # The events engine doesn't see the elements removed with their content, nor fills the attribute sketches
+        use_events = self.engine == "events" and self.stats is None and self.attribute_sketches is None
+        if use_events and self.supports_event_engine():
+            try:
+                return self._apply_events()
+            except (_UnsupportedByEventEngine, etree.LxmlError):
+                # The tree engine gives the result, or raises the same error as without the event engine
+                pass
+        prepared_document = self.prepare()
+        root = self.clean(prepared_document)
+        if not isinstance(root, etree._Element):
+            # Degraded output
+            return root
+        return self.extract(root)
+
+    def prepare(self) -> "PreparedDocument":
+        """Parse the document, select the root and minify it: the part of the work shared by the cleaner configs
+        with the same `start_parsing_at_tag` and the same tree limits (see `get_prepare_key`)"""
         html_str = self.html_str
+        limit_decisions = []
+        self.limit_decisions = limit_decisions
+
+        # Traitement n°0: check the size of the raw document before doing anything costly
+        html_str, degrade_policy = self._enforce_input_bytes_limit(html_str)
+        if degrade_policy == "skip":
+            return PreparedDocument(limit_decisions=limit_decisions, degrade_policy=degrade_policy)
+
         # Traitement n°1: start the parsing at a special tags (mostly tested with <body>)
+        wrapped_in_html = False
         if self.start_parsing_at_tag is not None:
-            root = fromstring(html_str)
+            root = parse_html_eliding(html_str, self.tags_to_elide)
             find = etree.XPath(f"//{self.start_parsing_at_tag}")
             new_etree = find(root)[0]
+            degrade_policy = degrade_policy or self._enforce_tree_limits(new_etree)
+            if degrade_policy is not None:
+                return PreparedDocument(
+                    limit_decisions=limit_decisions, degrade_policy=degrade_policy, degraded_root=new_etree
+                )
             html_str = etree.tostring(
                 new_etree, method="html", encoding="UTF-8", pretty_print=False
             ).decode("UTF-8")
             if not html_str.startswith("<html>"):
-                self.tag_filter.tags_to_remove_alone.update(
-                    {"html": TagToRemove("html")}
-                )
+                wrapped_in_html = True
 
                 # need to re-add html tag otherwise the fromstring` do something strange
                 html_str = f"<html>{html_str}</html>"
@@ -445,28 +905,312 @@ class TextAndMetadataCleaner:
         # Traitement n°2: [all treatments impacting the chr_idx] we removes sub-trees from the HTML + we minify the html
         html_str = htmlmin.minify(html_str, remove_comments=True, keep_pre=True)
 
-        new_etree = fromstring(html_str)
-
-        self._clean_etree(new_etree)
-
-        html_str = etree.tostring(
-            new_etree, method="html", encoding="UTF-8", pretty_print=False
-        ).decode("UTF-8")
-        html_str = htmlmin.minify(html_str, keep_pre=True)
+        if self.start_parsing_at_tag is None:
+            new_etree = parse_html_eliding(html_str, self.tags_to_elide)
+            degrade_policy = degrade_policy or self._enforce_tree_limits(new_etree)
+            if degrade_policy is not None:
+                return PreparedDocument(
+                    limit_decisions=limit_decisions, degrade_policy=degrade_policy, degraded_root=new_etree
+                )
+            return PreparedDocument(limit_decisions=limit_decisions, root=new_etree)
+
+        return PreparedDocument(limit_decisions=limit_decisions, html_str=html_str, wrapped_in_html=wrapped_in_html)
+
+    def clean(self, prepared_document: "PreparedDocument", copy_tree: bool = False):
+        """Returns the cleaned tree of a prepared document, or the degraded output if a limit was exceeded.
+
+        `copy_tree` must be set when the prepared document is shared, so that its tree (if any) is not modified.
+        """
+        degraded_output = self.start_from(prepared_document, copy_tree=copy_tree)
+        if degraded_output is not None:
+            return degraded_output
+        return self.clean_tree(prepared_document, copy_tree=copy_tree)
+
+    def start_from(self, prepared_document: "PreparedDocument", copy_tree: bool = False):
+        """Set the state of the cleaner for a prepared document, returns the degraded output if a limit was hit"""
+        self.limit_decisions = list(prepared_document.limit_decisions)
+        self._tags_to_drop_alone = set()
+        if prepared_document.degrade_policy is not None:
+            if prepared_document.degrade_policy == "skip":
+                return "", []
+            degraded_root = prepared_document.degraded_root
+            return self._get_degraded_output(
+                prepared_document.degrade_policy, deepcopy(degraded_root) if copy_tree else degraded_root
+            )
+
+        if prepared_document.wrapped_in_html:
+            self._tags_to_drop_alone = {"html"}
+        return None
+
+    def clean_tree(self, prepared_document: "PreparedDocument", copy_tree: bool = False):
+        if prepared_document.root is None:
+            new_etree = fromstring(prepared_document.html_str)
+        else:
+            new_etree = deepcopy(prepared_document.root) if copy_tree else prepared_document.root
+        if self.attribute_sketches is not None:
+            # The folding of the consecutive tags renames the elements and merges their attributes
+            self._original_attributes = {element: (element.tag, dict(element.attrib)) for element in new_etree.iter()}
+        if self.engine != "flat" or not clean_flat_tree(
+            new_etree, self.tag_filter, self.consecutive_tag_cleaner, self._remove_with_content
+        ):
+            self._clean_etree(new_etree)
+        return new_etree
 
+    def extract(self, new_etree):
+        """Separate the text from the metadata of a cleaned tree, the tree is left untouched"""
         # Traitement n°3: we separate the text from the list of metadata json that we keep
+        self._reset_extraction()
+        # The elements of the sub-trees taken from the cache are not visited
+        if self.subtree_cache is not None and self.stats is None and self.attribute_sketches is None:
+            self._compute_subtree_keys(new_etree, self._get_extraction_config_key())
+
+        plain_text = self._get_text_and_metadata(new_etree)
+        self._subtree_keys = {}
+        self._original_attributes = {}
+        return self._finish_extraction(plain_text)
+
+    def apply_text(self) -> str:
+        """Text of `apply`, without building the metadata. The metadata limit of `document_limits` is not enforced."""
+        prepared_document = self.prepare()
+        root = self.clean(prepared_document)
+        if not isinstance(root, etree._Element):
+            # Degraded output
+            return root[0]
+        return self.extract_text(root)
+
+    def extract_text(self, new_etree) -> str:
+        """Text of `extract` for a cleaned tree: the same spacing, but only the chunks of text are allocated"""
+        chunks = []
+        self._get_text(new_etree, chunks, set(self.block_elements), set(INLINE_ELEMENTS_SPACING))
+        return "".join(chunks)
+
+    def _get_text(self, root, chunks, block_elements, inline_elements):
+        tag = root.tag
+        if self.convert_br_tag_to_breaking_line and tag == "br":
+            chunks.append("\n")
+        _add_text_chunk(chunks, tag, root.text, block_elements, inline_elements)
+        for child in root:
+            self._get_text(child, chunks, block_elements, inline_elements)
+        _add_text_chunk(chunks, tag, root.tail, block_elements, inline_elements)
+
+    def _apply_events(self):
+        """Same result as `apply`, computed from the events of the parsing of the document, without building an lxml
+        tree nor minifying it. Raises `_UnsupportedByEventEngine` on the documents which can only be handled by
+        `apply`.
+        """
+        self.limit_decisions = []
+        html_str, degrade_policy = self._enforce_input_bytes_limit(self.html_str)
+        if degrade_policy is not None or not isinstance(html_str, str) or not FULL_HTML_DOCUMENT_RE.match(html_str):
+            raise _UnsupportedByEventEngine()
+        if len(BODY_START_TAG_RE.findall(html_str)) > 1:
+            # libxml2 merges the attributes of the extra <body> tags in the first one, without any event
+            raise _UnsupportedByEventEngine()
+
+        self._reset_extraction()
+        # The body is wrapped in a <html> tag by the tree engine
+        self._tags_to_drop_alone = {"html"}
+        plain_text = etree.fromstring(html_str, etree.HTMLParser(target=_EventExtractionTarget(self)))
+        return self._finish_extraction(plain_text)
+
+    def _reset_extraction(self):
         self.metadata = []
         self._current_char_idx = 0
+        self._current_byte_idx = 0
         self._current_num_metadata_by_idx = DefaultDict(lambda: 0)
         self.text = ""
         self.last_tag = None
+        self._depth = 0
+        self._subtree_keys = {}
+        if self.subtree_cache is not None:
+            # Position (char idx) of the start and the end of each metadata, kept or dropped
+            self._metadata_positions = []
+
+    def supports_event_engine(self):
+        """Whether the config only needs the parsing events: no decision depends on the length of a content or on the
+        size of the tree, so the elements can be handled as soon as they are parsed. The installed htmlmin must also be
+        one of `SUPPORTED_HTMLMIN_VERSIONS`, whose minification the events engine reproduces."""
+        if htmlmin.__version__ not in SUPPORTED_HTMLMIN_VERSIONS or TAG_SETS is None:
+            return False
+        if self.start_parsing_at_tag != "body":
+            return False
+        if self.document_limits is not None and (
+            self.document_limits.max_elements != float("inf") or self.document_limits.max_depth != float("inf")
+        ):
+            return False
+        tag_filter = self.tag_filter
+        if tag_filter.txt_max_chr_len_with_content >= max(tag_filter.txt_min_chr_len_with_content, 0):
+            return False
+        for tag_to_remove in tag_filter.tags_to_remove_with_content.values():
+            if tag_to_remove.content_min_char_length > 0 or tag_to_remove.content_max_char_length != float("inf"):
+                return False
+        special_tags = {"html", "body"} | set(FAKE_TAGS)
+        # A folded <pre> would lose its whitespaces
+        return not (
+            special_tags & set(tag_filter.tags_to_remove_with_content)
+            or (special_tags | {PRE_TAG}) & set(self.consecutive_tag_cleaner.consecutive_tags_to_fold)
+        )
 
-        plain_text = self._get_text_and_metadata(new_etree)
+    def _finish_extraction(self, plain_text):
+        degrade_policy = self._enforce_metadata_limit()
+        if degrade_policy == "skip":
+            return "", []
+        elif degrade_policy == "text-only":
+            return plain_text, []
 
         self._clean_relative_pos(self.metadata)
 
         return plain_text, self.metadata
 
+    def get_prepare_key(self):
+        """Cleaners with the same key produce the same `PreparedDocument` for a document"""
+        tree_limits = None
+        if self.document_limits is not None:
+            tree_limits = dataclasses.replace(
+                self.document_limits, max_metadata=float("inf"), metadata_policy="truncate"
+            )
+        return repr((self.start_parsing_at_tag, tree_limits, sorted(self.tags_to_elide)))
+
+    def get_clean_key(self):
+        """Cleaners with the same key produce the same cleaned tree from a `PreparedDocument`"""
+        return repr(
+            (
+                self.get_prepare_key(),
+                self.block_elements,
+                self.consecutive_tag_cleaner.consecutive_tags_to_fold,
+                sorted(self.tag_filter.tags_to_remove_with_content.items()),
+                self.tag_filter.txt_max_chr_len_with_content,
+                self.tag_filter.txt_min_chr_len_with_content,
+                self.tag_filter.tags_exceptions_with_content,
+            )
+        )
+
+    def _get_tags_to_elide(self):
+        """Tags which are always removed with their content, whatever the document: they can be emptied while parsing.
+
+        It is only the case if no decision depends on the content of these tags: the length of the text of their
+        ancestors, the tree limits (their elements count) and the folding of consecutive tags (which can rename them).
+        """
+        tag_filter = self.tag_filter
+        if tag_filter.txt_max_chr_len_with_content >= max(tag_filter.txt_min_chr_len_with_content, 0):
+            return set()
+        if self.document_limits is not None and (
+            self.document_limits.max_elements != float("inf") or self.document_limits.max_depth != float("inf")
+        ):
+            return set()
+        tags_to_elide = set()
+        for tag, tag_to_remove in tag_filter.tags_to_remove_with_content.items():
+            if tag_to_remove.content_min_char_length > 0 or tag_to_remove.content_max_char_length != float("inf"):
+                if tag_to_remove.method == "top-down":
+                    # Its decision depends on the text of the elements inside it, which must stay
+                    return set()
+                continue
+            tags_to_elide.add(tag)
+        return tags_to_elide - set(self.consecutive_tag_cleaner.consecutive_tags_to_fold) - {
+            "html",
+            "body",
+            self.start_parsing_at_tag,
+        }
+
+    def _enforce_input_bytes_limit(self, html_str):
+        if self.document_limits is None or self.document_limits.max_input_bytes == float("inf"):
+            return html_str, None
+
+        html_bytes = html_str if isinstance(html_str, bytes) else html_str.encode("UTF-8")
+        if len(html_bytes) <= self.document_limits.max_input_bytes:
+            return html_str, None
+
+        policy = self.document_limits.input_bytes_policy
+        self.limit_decisions.append(
+            LimitDecision(
+                limit="input_bytes",
+                value=len(html_bytes),
+                max_value=self.document_limits.max_input_bytes,
+                policy=policy,
+            )
+        )
+        if policy == "truncate":
+            # lxml is tolerant enough to parse the unclosed tags left by the truncation
+            html_str = html_bytes[: int(self.document_limits.max_input_bytes)].decode("UTF-8", errors="ignore")
+            return html_str, None
+        return html_str, policy
+
+    def _enforce_tree_limits(self, root):
+        if self.document_limits is None or (
+            self.document_limits.max_depth == float("inf")
+            and self.document_limits.max_elements == float("inf")
+        ):
+            return None
+
+        num_elements = 0
+        max_depth = 0
+        for _, depth in _iter_elements_with_depth(root):
+            num_elements += 1
+            max_depth = max(max_depth, depth)
+
+        if max_depth > self.document_limits.max_depth:
+            policy = self.document_limits.depth_policy
+            self.limit_decisions.append(
+                LimitDecision(
+                    limit="depth",
+                    value=max_depth,
+                    max_value=self.document_limits.max_depth,
+                    policy=policy,
+                )
+            )
+            if policy != "truncate":
+                return policy
+            truncate_depth(root, self.document_limits.max_depth)
+            num_elements = sum(1 for _ in _iter_elements_with_depth(root))
+
+        if num_elements > self.document_limits.max_elements:
+            policy = self.document_limits.elements_policy
+            self.limit_decisions.append(
+                LimitDecision(
+                    limit="elements",
+                    value=num_elements,
+                    max_value=self.document_limits.max_elements,
+                    policy=policy,
+                )
+            )
+            if policy != "truncate":
+                return policy
+            truncate_elements(root, self.document_limits.max_elements)
+        return None
+
+    def _enforce_metadata_limit(self):
+        if self.document_limits is None or len(self.metadata) <= self.document_limits.max_metadata:
+            return None
+
+        policy = self.document_limits.metadata_policy
+        self.limit_decisions.append(
+            LimitDecision(
+                limit="metadata",
+                value=len(self.metadata),
+                max_value=self.document_limits.max_metadata,
+                policy=policy,
+            )
+        )
+        if policy != "truncate":
+            return policy
+
+        # We keep the metadata which open first in the text, as if the document had been truncated
+        kept_metadata = sorted(
+            self.metadata,
+            key=lambda metadata_node: (metadata_node.char_start_idx, metadata_node.relative_start_pos),
+        )[: int(self.document_limits.max_metadata)]
+        kept_metadata_ids = {id(metadata_node) for metadata_node in kept_metadata}
+        self.metadata = [metadata_node for metadata_node in self.metadata if id(metadata_node) in kept_metadata_ids]
+        return None
+
+    def _get_degraded_output(self, policy, root):
+        if policy == "skip":
+            return "", []
+
+        # Text-only fallback: the tree is cleaned as usual (the rules of `tag_filter` decide which elements are removed
+        # with their content), but only its text is extracted
+        self._clean_etree(root)
+        return self.extract_text(root), []
+
     def _br_conversion(self, tag):
         if tag == "br":
             self.text += "\n"
@@ -502,24 +1246,15 @@ class TextAndMetadataCleaner:
         if new_text:
             self._append_text_content(new_text)
 
+        if self.track_byte_offsets:
+            self._current_byte_idx += _utf8_length(self.text[self._current_char_idx :])
         self._current_char_idx = len(self.text)
 
     def _append_text_content(self, txt):
         if self.current_tag == PRE_TAG:
             self.text += txt
         else:
-            txt = txt.replace("\u00a0", " ")
-
-            c = " "
-            if len(self.text) > 0:
-                c = self.text[-1]
-            for i in range(len(txt)):
-                c2 = txt[i]
-                if c2 == "\r" or c2 == "\n":
-                    c2 = " "
-                if not c.isspace() or not c2.isspace():
-                    self.text += c2
-                c = c2
+            self.text += _collapse_whitespaces(txt, self.text[-1:])
 
     def _append_block_separator(self, sb):
         length = len(sb)
@@ -546,39 +1281,186 @@ class TextAndMetadataCleaner:
         return sb
 
     def _get_text_and_metadata(self, root):
+        subtree_key = self._subtree_keys.get(root)
+        if subtree_key is None:
+            self._get_subtree_text_and_metadata(root)
+        else:
+            # The text added by a sub-tree depends on the last character of the text before it
+            subtree_key = (subtree_key, self.text[-1:])
+            subtree_cache_entry = self.subtree_cache.get(subtree_key, tag=root.tag)
+            if subtree_cache_entry is None:
+                subtree_cache_entry = self._record_subtree_text_and_metadata(root)
+                self.subtree_cache.put(subtree_key, subtree_cache_entry)
+            else:
+                self._splice_subtree_text_and_metadata(subtree_cache_entry)
+            self.current_tag = root.tag
+
+        self._add_text(root.tag, root.tail)
+
+        return self.text
+
+    def _get_subtree_text_and_metadata(self, root):
         self.current_tag = root.tag
 
         metadata_node = Metadata(
             char_start_idx=self._current_char_idx,
+            byte_start_idx=self._current_byte_idx if self.track_byte_offsets else None,
             relative_start_pos=self._current_num_metadata_by_idx[
                 self._current_char_idx
             ],
-            value=HtmlTag(tag=root.tag, attrs=self.attribute_cleaner(root.attrib)),
+            value=HtmlTag(
+                tag=self.vocabulary.intern(root.tag) if self.vocabulary is not None else root.tag,
+                attrs=self.attribute_cleaner(root.attrib),
+            ),
         )
 
         self._current_num_metadata_by_idx[self._current_char_idx] += 1
+        if self.subtree_cache is not None:
+            self._metadata_positions.append(self._current_char_idx)
 
         if self.convert_br_tag_to_breaking_line:
             self._br_conversion(root.tag)
 
         self._add_text(root.tag, root.text)
+        self._depth += 1
         for idx, child in enumerate(root):
             _ = self._get_text_and_metadata(child)
+        self._depth -= 1
 
         self.current_tag = root.tag
 
         metadata_node.char_end_idx = self._current_char_idx
+        if self.track_byte_offsets:
+            metadata_node.byte_end_idx = self._current_byte_idx
         metadata_node.relative_end_pos = self._current_num_metadata_by_idx[
             self._current_char_idx
         ]
         self._current_num_metadata_by_idx[self._current_char_idx] += 1
-
-        self._add_text(root.tag, root.tail)
-
+        if self.subtree_cache is not None:
+            self._metadata_positions.append(self._current_char_idx)
+
+        if self.stats is not None:
+            self.stats.add_element(
+                root.tag, self._depth, metadata_node.char_end_idx - metadata_node.char_start_idx
+            )
+        if self.attribute_sketches is not None:
+            tag, attrib = self._original_attributes.get(root, (root.tag, root.attrib))
+            if tag not in FAKE_TAGS:
+                self.attribute_sketches.add(tag, self.attribute_cleaner.select(attrib))
+
+        if metadata_node.value.tag in self._tags_to_drop_alone:
+            return
         if not self.tag_filter.drop_tag(metadata_node=metadata_node):
             self.metadata.append(metadata_node)
+        elif self.stats is not None:
+            self.stats.dropped_alone_counts[root.tag] = self.stats.dropped_alone_counts.get(root.tag, 0) + 1
+
+    def _get_extraction_config_key(self):
+        # Everything, apart from the sub-tree itself and the text before it, which changes the extraction result
+        return repr(
+            (
+                self.attribute_cleaner.attrs_to_keep,
+                self.convert_br_tag_to_breaking_line,
+                sorted(self.tag_filter.tags_to_remove_alone.items()),
+                sorted(self._tags_to_drop_alone),
+                self.tag_filter.txt_max_chr_len_alone,
+                self.tag_filter.txt_min_chr_len_alone,
+                self.tag_filter.tags_exceptions_alone,
+                self.track_byte_offsets,
+            )
+        )
 
-        return self.text
+    def _compute_subtree_keys(self, root, config_key):
+        """Compute bottom-up a structural hash of the sub-trees which can be cached"""
+        digest = hashlib.blake2b(config_key.encode("UTF-8"), digest_size=16)
+        digest.update(repr((root.tag, list(root.attrib.items()), root.text)).encode("UTF-8", errors="surrogatepass"))
+        num_elements = 1
+        for child in root:
+            child_digest, child_num_elements = self._compute_subtree_keys(child, config_key)
+            digest.update(child_digest)
+            digest.update(repr(child.tail).encode("UTF-8", errors="surrogatepass"))
+            num_elements += child_num_elements
+        digest = digest.digest()
+        if self.subtree_cache.is_eligible(root.tag, num_elements):
+            self._subtree_keys[root] = digest
+        return digest, num_elements
+
+    def _record_subtree_text_and_metadata(self, root):
+        start_idx = self._current_char_idx
+        start_byte_idx = self._current_byte_idx
+        num_metadata_at_start_idx = self._current_num_metadata_by_idx[start_idx]
+        num_metadata_before = len(self.metadata)
+        num_positions_before = len(self._metadata_positions)
+
+        self._get_subtree_text_and_metadata(root)
+
+        def relative_pos(char_idx, pos):
+            return pos - num_metadata_at_start_idx if char_idx == start_idx else pos
+
+        def byte_offset(byte_idx):
+            return byte_idx - start_byte_idx if byte_idx is not None else None
+
+        return SubtreeCacheEntry(
+            tag=root.tag,
+            previous_char=self.text[start_idx - 1] if start_idx > 0 else "",
+            text=self.text[start_idx:],
+            metadata=[
+                (
+                    metadata_node.char_start_idx - start_idx,
+                    relative_pos(metadata_node.char_start_idx, metadata_node.relative_start_pos),
+                    metadata_node.char_end_idx - start_idx,
+                    relative_pos(metadata_node.char_end_idx, metadata_node.relative_end_pos),
+                    metadata_node.value.tag,
+                    metadata_node.value.attrs,
+                    byte_offset(metadata_node.byte_start_idx),
+                    byte_offset(metadata_node.byte_end_idx),
+                )
+                for metadata_node in self.metadata[num_metadata_before:]
+            ],
+            num_metadata_by_offset=Counter(
+                char_idx - start_idx for char_idx in self._metadata_positions[num_positions_before:]
+            ),
+            text_num_bytes=self._current_byte_idx - start_byte_idx,
+        )
+
+    def _splice_subtree_text_and_metadata(self, subtree_cache_entry):
+        start_idx = self._current_char_idx
+        start_byte_idx = self._current_byte_idx
+        num_metadata_at_start_idx = self._current_num_metadata_by_idx[start_idx]
+
+        if subtree_cache_entry.previous_char and self.text[-1] != subtree_cache_entry.previous_char:
+            self.text = self.text[:-1] + subtree_cache_entry.previous_char
+        self.text += subtree_cache_entry.text
+
+        for (
+            char_start_offset,
+            relative_start_pos,
+            char_end_offset,
+            relative_end_pos,
+            tag,
+            attrs,
+            byte_start_offset,
+            byte_end_offset,
+        ) in subtree_cache_entry.metadata:
+            self.metadata.append(
+                Metadata(
+                    char_start_idx=start_idx + char_start_offset,
+                    relative_start_pos=relative_start_pos
+                    + (num_metadata_at_start_idx if char_start_offset == 0 else 0),
+                    value=HtmlTag(tag=tag, attrs={"attrs": list(attrs["attrs"]), "values": list(attrs["values"])}),
+                    char_end_idx=start_idx + char_end_offset,
+                    relative_end_pos=relative_end_pos + (num_metadata_at_start_idx if char_end_offset == 0 else 0),
+                    byte_start_idx=start_byte_idx + byte_start_offset if byte_start_offset is not None else None,
+                    byte_end_idx=start_byte_idx + byte_end_offset if byte_end_offset is not None else None,
+                )
+            )
+
+        for offset, num_metadata in subtree_cache_entry.num_metadata_by_offset.items():
+            self._current_num_metadata_by_idx[start_idx + offset] += num_metadata
+            self._metadata_positions.extend([start_idx + offset] * num_metadata)
+
+        self._current_char_idx = len(self.text)
+        self._current_byte_idx += subtree_cache_entry.text_num_bytes
 
     def _clean_etree(
         self,
@@ -592,7 +1474,7 @@ class TextAndMetadataCleaner:
         ).decode("UTF-8")
         text = plain_text[: -len(root.tail)] if root.tail else plain_text
         if self.tag_filter.drop_tag_and_content_top_down(tag=root.tag, text=text):
-            remove_keeping_tail(root)
+            self._remove_with_content(root)
             return
 
         for idx, child in enumerate(root):
@@ -604,7 +1486,407 @@ class TextAndMetadataCleaner:
         ).decode("UTF-8")
         text = plain_text[: -len(root.tail)] if root.tail else plain_text
         if self.tag_filter.drop_tag_and_content_bottom_up(tag=root.tag, text=text):
-            remove_keeping_tail(root)
+            self._remove_with_content(root)
+
+    def _remove_with_content(self, element):
+        if self.stats is not None:
+            removed_counts = self.stats.removed_with_content_counts
+            removed_counts[element.tag] = removed_counts.get(element.tag, 0) + 1
+        remove_keeping_tail(element)
+
+
+class _UnsupportedByEventEngine(Exception):
+    pass
+
+
+@dataclass(eq=False)
+class _EventElement:
+    """Kept element of the body, with its text and its tail once minified and cleaned as by the tree engine. It has
+    what `TextAndMetadataCleaner._get_text_and_metadata` needs from an lxml element."""
+
+    tag: str
+    attrib: dict
+    parent: Optional["_EventElement"]
+    children: list = dataclasses.field(default_factory=list)
+    text: Optional[str] = None
+    tail: Optional[str] = None
+    # The removed children count for the folding
+    num_children: int = 0
+    first_child_tag: Optional[str] = None
+    # No text, child or comment
+    is_empty: bool = True
+
+    def __iter__(self):
+        return iter(self.children)
+
+    def __len__(self):
+        return len(self.children)
+
+
+@dataclass
+class _SkippedElement:
+    tag: str
+    is_serialized: bool
+    content_is_serialized: bool
+    is_empty: bool = True
+
+
+class _MinifierState:
+    """Stack of the open tags of `htmlmin.parser.HTMLMinParser`, replayed from the tags of the serialized body.
+
+    It decides where htmlmin collapses the whitespaces and which `lang` attributes it drops. It doesn't always match
+    the tree: a <a> is only closed with its parent for instance, and a start tag can close the tags of `TAG_SETS`.
+    """
+
+    def __init__(self):
+        # (tag, keeps_spaces, lang), the innermost last
+        self.stack = []
+        self.num_keeping_spaces = 0
+
+    def start(self, tag, attrs):
+        """Update the state for a start tag and remove or rename the attributes of `attrs` as htmlmin does"""
+        for idx in range(len(self.stack) - 1, -1, -1):
+            closing_tags = TAG_SETS.get(self.stack[idx][0])
+            if closing_tags and (closing_tags == "*" or tag in closing_tags):
+                self._close(self.stack[idx][0])
+                break
+
+        keeps_spaces = self.num_keeping_spaces > 0 or tag in HTMLMIN_PRE_TAGS
+        parent_lang = lang = self.stack[-1][2] if self.stack else None
+        items = []
+        for key, value in attrs.items():
+            if key.startswith("pre-") or HTMLMIN_UNESCAPED_REFERENCE_RE.search(value):
+                # htmlmin doesn't escape the value of these attributes, or unescapes the value once more
+                raise _UnsupportedByEventEngine()
+            keeps_spaces = keeps_spaces or key == "pre"
+            if key == "lang":
+                lang = value
+                if value == parent_lang:
+                    continue
+            items.append((key, value))
+        if items and self._needs_space_before_tag_end(items[-1][1]):
+            # htmlmin moves an attribute to the end rather than writing a space before the ">"
+            candidates = [idx for idx, (_, value) in enumerate(items) if self._is_quoted(value)] or [
+                idx for idx, (_, value) in enumerate(items) if not value.endswith("/")
+            ]
+            if candidates:
+                items.append(items.pop(candidates[-1]))
+        attrs.clear()
+        attrs.update(items)
+        if keeps_spaces:
+            self.num_keeping_spaces += 1
+        self.stack.append((tag, keeps_spaces, lang))
+
+    def end(self, tag):
+        if tag != "a":
+            self._close(tag)
+            return
+        contains_p = False
+        for idx in range(len(self.stack) - 1, -1, -1):
+            if self.stack[idx][0] == "p":
+                contains_p = True
+            elif self.stack[idx][0] == "a":
+                break
+        if contains_p:
+            _, keeps_spaces, _ = self.stack.pop(idx)
+            self.num_keeping_spaces -= keeps_spaces
+
+    @staticmethod
+    def _is_quoted(value):
+        return not value or "'" in value or '"' in value or CHARS_TO_QUOTE_RE.search(value) is not None
+
+    def _needs_space_before_tag_end(self, value):
+        return value.endswith("/") and not self._is_quoted(value)
+
+    def minify(self, text):
+        return text if self.num_keeping_spaces else HTML_SPACE_RE.sub(PLAIN_TEXT_SEPARATOR, text)
+
+    def _close(self, tag):
+        num_keeping_spaces = 0
+        idx = 0
+        for idx in range(len(self.stack) - 1, -1, -1):
+            num_keeping_spaces += self.stack[idx][1]
+            if self.stack[idx][0] == tag:
+                break
+            if tag != "html" and self.stack[idx][0] in ["body", "html", "head"]:
+                # An end tag without a start tag is ignored
+                return
+        del self.stack[idx:]
+        self.num_keeping_spaces -= num_keeping_spaces
+
+
+class _EventExtractionTarget:
+    """lxml parser target giving, for a cleaner which `supports_event_engine`, the body that the tree engine would
+    extract the text from.
+
+    Only the kept elements are recorded. Their text and their tail are minified as htmlmin does and the tail of a
+    removed element is merged with the text before it as by `remove_keeping_tail`. The consecutive tags are folded
+    once the document is parsed, before the extraction of the text and of the metadata.
+    """
+
+    def __init__(self, cleaner: TextAndMetadataCleaner):
+        self.cleaner = cleaner
+        self.tags_to_remove = cleaner.tag_filter.tags_to_remove_with_content
+        self.minifier = _MinifierState()
+        # In document order
+        self.elements = []
+        self.stack = []
+        self.state = "before_body"  # then "body", "body_tail" and "after_body"
+        # The removed element being skipped and the elements inside it
+        self.skipped_elements = []
+        self.pending_data = []
+        # ("text", element), ("tail", element) or ("removed_tail", parent element) for the text of `pending_data`
+        self.pending_data_owner = None
+
+    def start(self, tag, attrib):
+        if self.state == "before_body":
+            if tag != "body":
+                return
+            self.state = "body"
+            self._open("html", {}, None)
+        elif self.state != "body":
+            self._end_body_tail()
+            return
+        if self.skipped_elements:
+            parent = self.skipped_elements[-1]
+            parent.is_empty = False
+            self._skip(tag, attrib, is_serialized=parent.content_is_serialized)
+            return
+
+        self._flush_data()
+        parent = self.stack[-1]
+        parent.num_children += 1
+        parent.is_empty = False
+        if parent.num_children == 1:
+            parent.first_child_tag = tag
+        if tag in self.tags_to_remove:
+            self._skip(tag, attrib, is_serialized=True)
+            return
+        self._open(tag, attrib, parent)
+
+    def end(self, tag):
+        if self.state != "body":
+            self._end_body_tail()
+            return
+        if self.skipped_elements:
+            skipped_element = self.skipped_elements.pop()
+            if skipped_element.is_serialized:
+                if skipped_element.tag == "li" and (
+                    skipped_element.is_empty or not skipped_element.content_is_serialized
+                ):
+                    raise _UnsupportedByEventEngine()
+                if skipped_element.tag not in HTML_EMPTY_TAGS:
+                    self.minifier.end(skipped_element.tag)
+            if not self.skipped_elements:
+                self.pending_data_owner = ("removed_tail", self.stack[-1])
+            return
+
+        self._flush_data()
+        element = self.stack.pop()
+        if element.tag == "li" and element.is_empty:
+            # It is serialized without an end tag, what follows it is inside it once the body is parsed again
+            raise _UnsupportedByEventEngine()
+        if element.tag not in HTML_EMPTY_TAGS:
+            self.minifier.end(element.tag)
+        self.pending_data_owner = ("tail", element)
+        if element.parent.parent is None:
+            # The tail of the body is serialized with it, not what comes after
+            self.state = "body_tail"
+
+    def data(self, data):
+        if self.skipped_elements:
+            self.skipped_elements[-1].is_empty = False
+        elif self.state in ["body", "body_tail"]:
+            self.pending_data.append(data)
+            if self.state == "body":
+                self.stack[-1].is_empty = False
+
+    def comment(self, text):
+        if self.skipped_elements:
+            self.skipped_elements[-1].is_empty = False
+        elif self.state == "body":
+            if HTMLMIN_KEPT_COMMENTS_RE.match(text):
+                raise _UnsupportedByEventEngine()
+            self.stack[-1].is_empty = False
+        self._end_body_tail()
+
+    def pi(self, target, data=None):
+        if self.state == "body" and not self.skipped_elements:
+            raise _UnsupportedByEventEngine()
+        self._end_body_tail()
+
+    def close(self):
+        if self.state == "before_body" or len(self.stack) != 1:
+            raise _UnsupportedByEventEngine()
+        self._end_body_tail()
+        self._apply_folding()
+        return self.cleaner._get_text_and_metadata(self.stack.pop())
+
+    def _open(self, tag, attrib, parent):
+        attrib = {
+            key: key if value == "" and key in HTML_BOOLEAN_ATTRIBUTES else value for key, value in attrib.items()
+        }
+        self.minifier.start(tag, attrib)
+        element = _EventElement(tag=tag, attrib=attrib, parent=parent)
+        if parent is not None:
+            parent.children.append(element)
+        self.elements.append(element)
+        self.stack.append(element)
+        self.pending_data_owner = ("text", element)
+
+    def _skip(self, tag, attrib, is_serialized):
+        # The content of the removed elements which are not emptied by `parse_html_eliding` is minified too
+        content_is_serialized = is_serialized and tag not in self.cleaner.tags_to_elide
+        if is_serialized:
+            self.minifier.start(tag, dict(attrib) if content_is_serialized else {})
+        self.skipped_elements.append(
+            _SkippedElement(tag=tag, is_serialized=is_serialized, content_is_serialized=content_is_serialized)
+        )
+
+    def _end_body_tail(self):
+        if self.state == "body_tail":
+            self._flush_data()
+            self.state = "after_body"
+
+    def _flush_data(self):
+        if not self.pending_data:
+            return
+        text = "".join(self.pending_data)
+        self.pending_data = []
+        if self.stack[-1].tag in HTML_ESCAPED_TEXT_TAGS:
+            text = escape(text, quote=False)
+        elif self.stack[-1].tag == "plaintext":
+            raise _UnsupportedByEventEngine()
+        text = self.minifier.minify(text)
+        kind, element = self.pending_data_owner
+        if kind == "text":
+            element.text = text
+        elif kind == "tail":
+            element.tail = text
+        else:
+            self._merge_removed_tail(element, text)
+
+    @staticmethod
+    def _merge_removed_tail(parent, tail):
+        """`_preserve_tail_before_delete` for a removed child of `parent` which is after all its kept children"""
+        if not parent.children:
+            if parent.text is None:
+                parent.text = tail
+            elif not parent.text.endswith(PLAIN_TEXT_SEPARATOR) and not tail.startswith(PLAIN_TEXT_SEPARATOR):
+                parent.text = parent.text + PLAIN_TEXT_SEPARATOR + tail
+            elif parent.text.endswith(PLAIN_TEXT_SEPARATOR) and tail.startswith(PLAIN_TEXT_SEPARATOR):
+                parent.text = parent.text[: -len(PLAIN_TEXT_SEPARATOR)] + tail
+            else:
+                parent.text = parent.text + tail
+            return
+
+        previous = parent.children[-1]
+        if previous.tail is None:
+            previous.tail = tail
+        elif (
+            previous.text
+            and not previous.text.endswith(PLAIN_TEXT_SEPARATOR)
+            and not tail.startswith(PLAIN_TEXT_SEPARATOR)
+        ):
+            previous.text = previous.text + PLAIN_TEXT_SEPARATOR + tail
+        elif previous.text and previous.text.endswith(PLAIN_TEXT_SEPARATOR) and tail.startswith(PLAIN_TEXT_SEPARATOR):
+            previous.text = previous.text[: -len(PLAIN_TEXT_SEPARATOR)] + tail
+        elif not previous.tail.endswith(PLAIN_TEXT_SEPARATOR) and not tail.startswith(PLAIN_TEXT_SEPARATOR):
+            previous.tail = previous.tail + PLAIN_TEXT_SEPARATOR + tail
+        else:
+            previous.tail = previous.tail + tail
+
+    def _apply_folding(self):
+        """`ConsecutiveTagCleaner` applied to the elements, in the same order as by the tree engine"""
+        consecutive_tag_cleaner = self.cleaner.consecutive_tag_cleaner
+        for element in self.elements:
+            if (
+                element.num_children != 1
+                or not element.children
+                or not consecutive_tag_cleaner.folds(element.tag, element.attrib, element.first_child_tag)
+            ):
+                continue
+            child = element.children[0]
+            child.tag = consecutive_tag_cleaner.get_fake_tag(element.tag)
+            parent_element = element
+            while parent_element.tag in FAKE_TAGS:
+                parent_element = parent_element.parent
+            for key, value in child.attrib.items():
+                if key in parent_element.attrib:
+                    parent_element.attrib[key] += consecutive_tag_cleaner.attrib_separator + value
+                else:
+                    parent_element.attrib[key] = value
+            child.attrib["previous_tag"] = element.tag
+
+
+PROFILE_EXCLUDED_PARAMS = ["limit_decisions", "cache", "subtree_cache", "vocabulary", "stats", "attribute_sketches"]
+
+
+def get_clean_text_and_metadata_for_profiles(
+    html_str,
+    profiles: Dict[str, dict],
+    limit_decisions: Optional[Dict[str, List[LimitDecision]]] = None,
+    subtree_cache: Optional[SubtreeCache] = None,
+    vocabulary: Optional[StringVocabulary] = None,
+) -> Dict[str, Tuple[str, List[Metadata]]]:
+    """Apply several cleaner configs to a document and return the (text, metadata) of each one, by profile name.
+
+    Each profile holds the keyword arguments of `get_clean_text_and_metadata` (apart from `PROFILE_EXCLUDED_PARAMS`)
+    and gives the same result. The parsing, the selection of the body and the minification are shared by all the
+    profiles with the same tree limits, and the cleaned tree by the profiles which only differ by the filters of the
+    metadata (`tags_to_remove_alone`, `txt_*_chr_len_alone`, `attrs_to_keep`, ...). The profiles with the "events"
+    engine are processed on their own.
+    """
+    results = {}
+    prepared_documents = {}
+    cleaned_trees = {}
+    for profile_name, profile in profiles.items():
+        excluded_params = sorted(set(profile) & set(PROFILE_EXCLUDED_PARAMS))
+        if excluded_params:
+            raise ValueError(
+                f"The profile {profile_name} has parameters ({excluded_params}) which can't be set by profile. Valid "
+                f"parameters are the ones of `get_clean_text_and_metadata` apart from {PROFILE_EXCLUDED_PARAMS}."
+            )
+        cleaner = TextAndMetadataCleaner(
+            html_str=html_str,
+            start_parsing_at_tag="body",
+            subtree_cache=subtree_cache,
+            vocabulary=vocabulary,
+            **profile,
+        )
+
+        if cleaner.engine == "events":
+            results[profile_name] = cleaner.apply()
+            if limit_decisions is not None:
+                limit_decisions.setdefault(profile_name, []).extend(cleaner.limit_decisions)
+            continue
+
+        prepare_key = cleaner.get_prepare_key()
+        if prepare_key not in prepared_documents:
+            prepared_documents[prepare_key] = cleaner.prepare()
+        prepared_document = prepared_documents[prepare_key]
+
+        degraded_output = cleaner.start_from(prepared_document, copy_tree=True)
+        if degraded_output is not None:
+            results[profile_name] = degraded_output
+        else:
+            clean_key = cleaner.get_clean_key()
+            if clean_key not in cleaned_trees:
+                cleaned_trees[clean_key] = cleaner.clean_tree(prepared_document, copy_tree=True)
+            results[profile_name] = cleaner.extract(cleaned_trees[clean_key])
+
+        if limit_decisions is not None:
+            limit_decisions.setdefault(profile_name, []).extend(cleaner.limit_decisions)
+    return results
+
+
+def intern_metadata(metadata: List[Metadata], vocabulary: StringVocabulary):
+    """Intern in place the strings of metadata which were not built with `vocabulary` (e.g. loaded from disk)"""
+    for metadata_node in metadata:
+        metadata_node.value.tag = vocabulary.intern(metadata_node.value.tag)
+        attrs = metadata_node.value.attrs
+        attrs["attrs"] = [vocabulary.intern(attr) for attr in attrs["attrs"]]
+        attrs["values"] = [vocabulary.intern_value(value) for value in attrs["values"]]
 
 
 def get_clean_text_and_metadata(
@@ -620,9 +1902,17 @@ def get_clean_text_and_metadata(
     txt_max_chr_len_with_content: float = -float("inf"),
     txt_min_chr_len_with_content: float = -float("inf"),
     tags_exceptions_to_txt_max_min_chr_len_with_content: List[str] = None,
+    document_limits: Optional[DocumentLimits] = None,
+    limit_decisions: Optional[List[LimitDecision]] = None,
+    cache=None,
+    subtree_cache: Optional[SubtreeCache] = None,
+    vocabulary: Optional[StringVocabulary] = None,
+    track_byte_offsets: bool = False,
+    engine: str = "tree",
+    stats: Optional[DocumentStats] = None,
+    attribute_sketches: Optional[AttributeSketches] = None,
 ):
-    text_and_metadata_cleaner = TextAndMetadataCleaner(
-        html_str=html_str,
+    cleaner_kwargs = dict(
         tags_to_remove_with_content=tags_to_remove_with_content,
         tags_to_remove_alone=tags_to_remove_alone,
         attrs_to_keep=attrs_to_keep,
@@ -635,5 +1925,117 @@ def get_clean_text_and_metadata(
         txt_max_chr_len_with_content=txt_max_chr_len_with_content,
         txt_min_chr_len_with_content=txt_min_chr_len_with_content,
         tags_exceptions_to_txt_max_min_chr_len_with_content=tags_exceptions_to_txt_max_min_chr_len_with_content,
+        document_limits=document_limits,
+        track_byte_offsets=track_byte_offsets,
+    )
+
+    # `cache` is expected to be a `result_cache.ResultCache`, the engines give the same result so the engine is not part
+    # of the key. The statistics and the sketches are filled while the document is extracted, so the cache is not used
+    # with `stats` or `attribute_sketches`.
+    use_cache = cache is not None and stats is None and attribute_sketches is None
+    if use_cache:
+        cache_key = cache.make_key(html_str, cleaner_kwargs)
+        cached_result = cache.get(cache_key)
+        if cached_result is not None:
+            plain_text, metadata, cached_limit_decisions = cached_result
+            if limit_decisions is not None:
+                limit_decisions.extend(cached_limit_decisions)
+            if vocabulary is not None:
+                intern_metadata(metadata, vocabulary)
+            return plain_text, metadata
+
+    text_and_metadata_cleaner = TextAndMetadataCleaner(
+        html_str=html_str,
+        subtree_cache=subtree_cache,
+        vocabulary=vocabulary,
+        engine=engine,
+        stats=stats,
+        attribute_sketches=attribute_sketches,
+        **cleaner_kwargs,
     )
-    return text_and_metadata_cleaner.apply()
+    plain_text, metadata = text_and_metadata_cleaner.apply()
+    if limit_decisions is not None:
+        limit_decisions.extend(text_and_metadata_cleaner.limit_decisions)
+    if use_cache:
+        cache.put(cache_key, (plain_text, metadata, text_and_metadata_cleaner.limit_decisions))
+    return plain_text, metadata
+
+
+def get_clean_text(html_str, limit_decisions: Optional[List[LimitDecision]] = None, **cleaner_kwargs) -> str:
+    """Text of `get_clean_text_and_metadata` with the same keyword arguments, but no metadata is built: the ones which
+    only select the metadata (`tags_to_remove_alone`, `attrs_to_keep`, ...) have no effect, nor the metadata limit.
+    The "events" engine is replaced by the "tree" engine."""
+    if cleaner_kwargs.get("stats") is not None or cleaner_kwargs.get("attribute_sketches") is not None:
+        raise ValueError(
+            "The statistics and the attribute sketches are filled with the metadata, see `get_clean_text_and_metadata`"
+        )
+    if cleaner_kwargs.get("engine") == "events":
+        cleaner_kwargs["engine"] = "tree"
+    text_and_metadata_cleaner = TextAndMetadataCleaner(html_str=html_str, start_parsing_at_tag="body", **cleaner_kwargs)
+    plain_text = text_and_metadata_cleaner.apply_text()
+    if limit_decisions is not None:
+        limit_decisions.extend(text_and_metadata_cleaner.limit_decisions)
+    return plain_text
+
+
+def map_in_threads(function, items: Iterable, num_threads: int, max_pending: Optional[int] = None) -> Iterator:
+    """Lazy `map(function, items)` computed by a pool of `num_threads` threads, in the order of `items`.
+
+    At most `max_pending` items (`4 * num_threads` by default) are read ahead, so `items` can be a stream.
+    """
+    max_pending = max_pending if max_pending is not None else 4 * num_threads
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(function, item))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+class HtmlExtractor:
+    """Thread-safe equivalent of `get_clean_text_and_metadata` with a fixed config.
+
+    The config is checked once, then each call works on its own `TextAndMetadataCleaner`, so an extractor can be
+    shared by threads, along with its `cache`, `subtree_cache` and `vocabulary`. With a free-threaded interpreter (or
+    as long as lxml releases the GIL while parsing), `map` processes the documents in parallel without pickling them.
+    """
+
+    def __init__(
+        self,
+        cache=None,
+        subtree_cache: Optional[SubtreeCache] = None,
+        vocabulary: Optional[StringVocabulary] = None,
+        **cleaner_kwargs,
+    ):
+        if "limit_decisions" in cleaner_kwargs or "stats" in cleaner_kwargs:
+            raise ValueError(
+                "The limit decisions and the statistics are given by document, see `HtmlExtractor.__call__`"
+            )
+        self.cache = cache
+        self.subtree_cache = subtree_cache
+        self.vocabulary = vocabulary
+        self.cleaner_kwargs = cleaner_kwargs
+        # Raises on an invalid config
+        get_clean_text_and_metadata("<html><body></body></html>", **cleaner_kwargs)
+
+    def __call__(
+        self,
+        html_str,
+        limit_decisions: Optional[List[LimitDecision]] = None,
+        stats: Optional[DocumentStats] = None,
+    ) -> Tuple[str, List[Metadata]]:
+        return get_clean_text_and_metadata(
+            html_str,
+            limit_decisions=limit_decisions,
+            stats=stats,
+            cache=self.cache,
+            subtree_cache=self.subtree_cache,
+            vocabulary=self.vocabulary,
+            **self.cleaner_kwargs,
+        )
+
+    def map(self, html_strs: Iterable, num_threads: int = 4) -> Iterator[Tuple[str, List[Metadata]]]:
+        """Extract the documents of `html_strs` with a pool of `num_threads` threads, the results are in order"""
+        return map_in_threads(self, html_strs, num_threads=num_threads)
@@ -0,0 +1,346 @@
+import json
+from json.encoder import encode_basestring
+from typing import List, Optional
+
+from html_parser import HtmlTag, Metadata, StringVocabulary
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+METADATA_SCHEMAS = ["dataclass", "flat"]
+
+# Strings on which the optional encoder must escape exactly like `json.dumps(..., ensure_ascii=False)`
+_ESCAPING_PROBES = ['a"b\\c', "\x00\x01\x08\x09\x0a\x0c\x0d\x1f\x7f", "\u00e9\u00a0\u2028\u2029\U0001f600", "</script>"]
+
+
+def _is_escaping_compatible(encode_str):
+    try:
+        return all(
+            encode_str(probe) == json.dumps(probe, ensure_ascii=False).encode("UTF-8") for probe in _ESCAPING_PROBES
+        )
+    except Exception:
+        return False
+
+
+def _encode_str_stdlib(string: str) -> bytes:
+    return encode_basestring(string).encode("UTF-8")
+
+
+if orjson is not None and _is_escaping_compatible(orjson.dumps):
+
+    def _encode_text(string: str) -> bytes:
+        try:
+            return orjson.dumps(string)
+        except orjson.JSONEncodeError:
+            # orjson refuses lone surrogates, let the standard encoder behave as usual
+            return _encode_str_stdlib(string)
+
+else:
+    _encode_text = _encode_str_stdlib
+
+
+def _encode_value(value) -> str:
+    if isinstance(value, str):
+        return encode_basestring(value)
+    if value is None:
+        return "null"
+    if type(value) is int:
+        return int.__repr__(value)
+    return json.dumps(value, ensure_ascii=False)
+
+
+def _encode_str_list(strings) -> str:
+    return "[" + ", ".join([_encode_value(string) for string in strings]) + "]"
+
+
+def _encode_attrs(attrs) -> str:
+    if type(attrs) is dict and list(attrs) == ["attrs", "values"]:
+        return f'{{"attrs": {_encode_str_list(attrs["attrs"])}, "values": {_encode_str_list(attrs["values"])}}}'
+    return json.dumps(attrs, ensure_ascii=False)
+
+
+def encode_metadata_dataclass(metadata_node: Metadata) -> str:
+    """Same string as `json.dumps(dataclasses.asdict(metadata_node), ensure_ascii=False)`, without the byte offsets
+    when they are not tracked"""
+    byte_offsets = ""
+    if metadata_node.byte_start_idx is not None:
+        byte_offsets = (
+            f', "byte_start_idx": {_encode_value(metadata_node.byte_start_idx)}, '
+            f'"byte_end_idx": {_encode_value(metadata_node.byte_end_idx)}'
+        )
+    return (
+        f'{{"char_start_idx": {_encode_value(metadata_node.char_start_idx)}, '
+        f'"relative_start_pos": {_encode_value(metadata_node.relative_start_pos)}, '
+        f'"value": {{"tag": {_encode_value(metadata_node.value.tag)}, '
+        f'"attrs": {_encode_attrs(metadata_node.value.attrs)}}}, '
+        f'"char_end_idx": {_encode_value(metadata_node.char_end_idx)}, '
+        f'"relative_end_pos": {_encode_value(metadata_node.relative_end_pos)}, '
+        f'"key": {_encode_value(metadata_node.key)}, '
+        f'"type": {_encode_value(metadata_node.type)}'
+        f"{byte_offsets}}}"
+    )
+
+
+def encode_metadata_flat(metadata_node: Metadata) -> str:
+    """Same string as `json.dumps(convert_html_metadata_dataclass_to_dict(metadata_node), ensure_ascii=False)`"""
+    byte_offsets = ""
+    if metadata_node.byte_start_idx is not None:
+        byte_offsets = (
+            f', "byte_start_idx": {_encode_value(metadata_node.byte_start_idx)}, '
+            f'"byte_end_idx": {_encode_value(metadata_node.byte_end_idx)}'
+        )
+    return (
+        f'{{"key": {_encode_value(metadata_node.key)}, '
+        f'"type": {_encode_value(metadata_node.type)}, '
+        f'"char_start_idx": {_encode_value(metadata_node.char_start_idx)}, '
+        f'"relative_start_pos": {_encode_value(metadata_node.relative_start_pos)}, '
+        f'"char_end_idx": {_encode_value(metadata_node.char_end_idx)}, '
+        f'"relative_end_pos": {_encode_value(metadata_node.relative_end_pos)}'
+        f"{byte_offsets}, "
+        f'"value": {_encode_value(metadata_node.value.tag)}, '
+        f'"html_attrs": {_encode_attrs(metadata_node.value.attrs)}}}'
+    )
+
+
+class MetadataJsonEncoder:
+    """Encode the text and metadata of a document into a JSON line, without building intermediate dicts.
+
+    The bytes are the same as the ones written by `jsonlines.Writer(fp).write(json_example)` where `json_example` is
+    `{"text": plain_text, "metadata": [...], **extra_fields}` and each metadata is `dataclasses.asdict(node)` (schema
+    "dataclass", the byte offsets are left out when they are not tracked) or
+    `convert_html_metadata_dataclass_to_dict(node)` (schema "flat"). The text is escaped with orjson when it is
+    installed.
+    """
+
+    def __init__(self, schema: str = "dataclass"):
+        if schema not in METADATA_SCHEMAS:
+            raise ValueError(
+                f"You have requested an invalid metadata schema ({schema}). Valid schemas are {METADATA_SCHEMAS}."
+            )
+        self.schema = schema
+        self._encode_metadata = encode_metadata_dataclass if schema == "dataclass" else encode_metadata_flat
+
+    def encode_metadata(self, metadata: List[Metadata]) -> str:
+        return "[" + ", ".join([self._encode_metadata(metadata_node) for metadata_node in metadata]) + "]"
+
+    def encode(self, plain_text: str, metadata: List[Metadata], extra_fields: Optional[dict] = None) -> bytes:
+        encoded_extra_fields = ""
+        if extra_fields:
+            encoded_extra_fields = "".join(
+                f", {_encode_value(key)}: {json.dumps(value, ensure_ascii=False)}"
+                for key, value in extra_fields.items()
+            )
+        return (
+            b'{"text": '
+            + _encode_text(plain_text)
+            + f', "metadata": {self.encode_metadata(metadata)}{encoded_extra_fields}}}\n'.encode("UTF-8")
+        )
+
+
+def _write_varint(buffer: bytearray, value: int):
+    while value > 0x7F:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def _read_varint(data: bytes, pos: int):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def _zigzag(value: int) -> int:
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def _unzigzag(value: int) -> int:
+    return value // 2 if value % 2 == 0 else -(value + 1) // 2
+
+
+def _write_bytes(buffer: bytearray, string: str):
+    string_bytes = string.encode("UTF-8", errors="surrogatepass")
+    _write_varint(buffer, len(string_bytes))
+    buffer += string_bytes
+
+
+def _read_bytes(data: bytes, pos: int):
+    length, pos = _read_varint(data, pos)
+    return data[pos : pos + length].decode("UTF-8", errors="surrogatepass"), pos + length
+
+
+def _write_optional_varint(buffer: bytearray, value: Optional[int]):
+    _write_varint(buffer, 0 if value is None else value + 1)
+
+
+def _read_optional_varint(data: bytes, pos: int):
+    value, pos = _read_varint(data, pos)
+    return (None if value == 0 else value - 1), pos
+
+
+class MetadataBinaryEncoder:
+    """Encode the text and metadata of a document into a compact binary record.
+
+    Layout of a record, where all the integers are varints:
+    - the strings added to the vocabulary since the previous record (count, then length + UTF-8 bytes of each)
+    - the length and the UTF-8 bytes of the text
+    - the number of metadata, then for each one: the delta of `char_start_idx` with the previous metadata (zigzag),
+      `char_end_idx - char_start_idx`, `relative_start_pos`, `relative_end_pos`, `byte_start_idx - char_start_idx`,
+      `byte_end_idx - byte_start_idx` (all +1, 0 meaning None), the IDs of the tag, key and type, the number of
+      attributes and, for each attribute, the ID of its name and its value, either as `2 * ID` or as
+      `2 * length + 1` followed by the UTF-8 bytes when it is not in the vocabulary.
+
+    Tag names and attribute names are always part of the vocabulary, attribute values only if the vocabulary interns
+    them (see `StringVocabulary`). Since each record only holds the new strings of the vocabulary, the records must
+    be decoded in the order they were encoded, by a single `MetadataBinaryDecoder`.
+    """
+
+    def __init__(self, vocabulary: Optional[StringVocabulary] = None):
+        self.vocabulary = vocabulary if vocabulary is not None else StringVocabulary()
+        self._num_written_strings = 0
+
+    def _encode_metadata(self, buffer: bytearray, metadata: List[Metadata]):
+        vocabulary = self.vocabulary
+        _write_varint(buffer, len(metadata))
+        previous_start_idx = 0
+        for metadata_node in metadata:
+            _write_varint(buffer, _zigzag(metadata_node.char_start_idx - previous_start_idx))
+            previous_start_idx = metadata_node.char_start_idx
+            length = None
+            if metadata_node.char_end_idx is not None:
+                length = metadata_node.char_end_idx - metadata_node.char_start_idx
+            _write_optional_varint(buffer, length)
+            _write_optional_varint(buffer, metadata_node.relative_start_pos)
+            _write_optional_varint(buffer, metadata_node.relative_end_pos)
+            byte_start_offset = None
+            byte_length = None
+            if metadata_node.byte_start_idx is not None:
+                byte_start_offset = metadata_node.byte_start_idx - metadata_node.char_start_idx
+                byte_length = metadata_node.byte_end_idx - metadata_node.byte_start_idx
+            _write_optional_varint(buffer, byte_start_offset)
+            _write_optional_varint(buffer, byte_length)
+            _write_varint(buffer, vocabulary.get_id(metadata_node.value.tag))
+            _write_varint(buffer, vocabulary.get_id(metadata_node.key))
+            _write_varint(buffer, vocabulary.get_id(metadata_node.type))
+
+            attrs = metadata_node.value.attrs
+            _write_varint(buffer, len(attrs["attrs"]))
+            for attr, value in zip(attrs["attrs"], attrs["values"]):
+                _write_varint(buffer, vocabulary.get_id(attr))
+                value = vocabulary.intern_value(value)
+                if value in vocabulary:
+                    _write_varint(buffer, 2 * vocabulary.get_id(value))
+                else:
+                    value_bytes = value.encode("UTF-8", errors="surrogatepass")
+                    _write_varint(buffer, 2 * len(value_bytes) + 1)
+                    buffer += value_bytes
+
+    def encode(self, plain_text: str, metadata: List[Metadata]) -> bytes:
+        metadata_buffer = bytearray()
+        self._encode_metadata(metadata_buffer, metadata)
+
+        buffer = bytearray()
+        new_strings = self.vocabulary.strings[self._num_written_strings :]
+        _write_varint(buffer, len(new_strings))
+        for string in new_strings:
+            _write_bytes(buffer, string)
+        # The vocabulary can grow meanwhile if it is shared with the threads which process the documents
+        self._num_written_strings += len(new_strings)
+        _write_bytes(buffer, plain_text)
+        buffer += metadata_buffer
+        return bytes(buffer)
+
+
+class MetadataBinaryDecoder:
+    """Decode the records of a `MetadataBinaryEncoder`, in the order they were encoded"""
+
+    def __init__(self):
+        self.strings = []
+
+    def decode(self, record: bytes):
+        strings = self.strings
+        num_new_strings, pos = _read_varint(record, 0)
+        for _ in range(num_new_strings):
+            string, pos = _read_bytes(record, pos)
+            strings.append(string)
+        plain_text, pos = _read_bytes(record, pos)
+
+        num_metadata, pos = _read_varint(record, pos)
+        metadata = []
+        char_start_idx = 0
+        for _ in range(num_metadata):
+            start_idx_delta, pos = _read_varint(record, pos)
+            char_start_idx += _unzigzag(start_idx_delta)
+            length, pos = _read_optional_varint(record, pos)
+            relative_start_pos, pos = _read_optional_varint(record, pos)
+            relative_end_pos, pos = _read_optional_varint(record, pos)
+            byte_start_offset, pos = _read_optional_varint(record, pos)
+            byte_length, pos = _read_optional_varint(record, pos)
+            tag_id, pos = _read_varint(record, pos)
+            key_id, pos = _read_varint(record, pos)
+            type_id, pos = _read_varint(record, pos)
+
+            num_attrs, pos = _read_varint(record, pos)
+            attrs = []
+            values = []
+            for _ in range(num_attrs):
+                attr_id, pos = _read_varint(record, pos)
+                attrs.append(strings[attr_id])
+                value_code, pos = _read_varint(record, pos)
+                if value_code % 2 == 0:
+                    values.append(strings[value_code // 2])
+                else:
+                    value_length = value_code // 2
+                    values.append(record[pos : pos + value_length].decode("UTF-8", errors="surrogatepass"))
+                    pos += value_length
+
+            metadata.append(
+                Metadata(
+                    char_start_idx=char_start_idx,
+                    relative_start_pos=relative_start_pos,
+                    value=HtmlTag(tag=strings[tag_id], attrs={"attrs": attrs, "values": values}),
+                    char_end_idx=None if length is None else char_start_idx + length,
+                    relative_end_pos=relative_end_pos,
+                    key=strings[key_id],
+                    type=strings[type_id],
+                    byte_start_idx=None if byte_start_offset is None else char_start_idx + byte_start_offset,
+                    byte_end_idx=None if byte_length is None else char_start_idx + byte_start_offset + byte_length,
+                )
+            )
+        return plain_text, metadata
+
+
+def write_record(fp, record: bytes):
+    """Write a length-prefixed binary record"""
+    header = bytearray()
+    _write_varint(header, len(record))
+    fp.write(bytes(header) + record)
+
+
+def iter_records(fp):
+    """Iterate over the length-prefixed binary records written by `write_record`"""
+    while True:
+        length = 0
+        shift = 0
+        while True:
+            byte = fp.read(1)
+            if not byte:
+                if shift == 0:
+                    return
+                raise EOFError("Truncated record header")
+            length |= (byte[0] & 0x7F) << shift
+            if byte[0] < 0x80:
+                break
+            shift += 7
+        record = fp.read(length)
+        if len(record) != length:
+            raise EOFError("Truncated record")
+        yield record
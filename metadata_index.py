@@ -0,0 +1,162 @@
+from bisect import bisect_left, bisect_right
+from typing import List, Optional
+
+from html_parser import HtmlTag, Metadata
+
+# Below this height, the sub-trees of the implicit interval tree are scanned linearly
+_MIN_TREE_HEIGHT = 3
+
+
+def metadata_from_dict(metadata_dict: dict) -> Metadata:
+    """Build a `Metadata` from a metadata of an output file, in the `dataclasses.asdict` or in the flat schema"""
+    metadata_dict = dict(metadata_dict)
+    value = metadata_dict.pop("value")
+    if isinstance(value, dict):
+        value = HtmlTag(**value)
+    else:
+        value = HtmlTag(tag=value, attrs=metadata_dict.pop("html_attrs"))
+    return Metadata(value=value, **metadata_dict)
+
+
+class _IntervalTree:
+    """Intervals sorted by start, seen as an implicit binary tree augmented with the max end of each sub-tree.
+
+    The node of index i is at the height given by the number of trailing 1 bits of i, so the tree needs no other
+    storage than the sorted arrays.
+    """
+
+    def __init__(self, starts: List[int], ends: List[int]):
+        self.starts = starts
+        self.ends = ends
+        self.max_ends = list(ends)
+        self.height = self._build()
+
+    def _build(self):
+        num_intervals = len(self.starts)
+        if num_intervals == 0:
+            return -1
+        max_ends = self.max_ends
+        last_idx = 0
+        last_max_end = max_ends[0]
+        for idx in range(0, num_intervals, 2):
+            last_idx = idx
+            last_max_end = max_ends[idx]
+        height = 1
+        while 1 << height <= num_intervals:
+            half_width = 1 << (height - 1)
+            for idx in range((half_width << 1) - 1, num_intervals, half_width << 2):
+                left_max_end = max_ends[idx - half_width]
+                right_max_end = max_ends[idx + half_width] if idx + half_width < num_intervals else last_max_end
+                max_ends[idx] = max(max_ends[idx], left_max_end, right_max_end)
+            last_idx = last_idx - half_width if (last_idx >> height) & 1 else last_idx + half_width
+            if last_idx < num_intervals:
+                last_max_end = max(last_max_end, max_ends[last_idx])
+            height += 1
+        return height - 1
+
+    def overlapping(self, start: int, end: int) -> List[int]:
+        """Positions of the intervals [s, e) such that s < end and e > start, in increasing order"""
+        starts, ends, max_ends = self.starts, self.ends, self.max_ends
+        num_intervals = len(starts)
+        positions = []
+        if num_intervals == 0:
+            return positions
+        stack = [((1 << self.height) - 1, self.height, False)]
+        while stack:
+            idx, height, left_done = stack.pop()
+            if height <= _MIN_TREE_HEIGHT:
+                first_idx = idx >> height << height
+                for leaf_idx in range(first_idx, min(first_idx + (1 << (height + 1)) - 1, num_intervals)):
+                    if starts[leaf_idx] >= end:
+                        break
+                    if start < ends[leaf_idx]:
+                        positions.append(leaf_idx)
+            elif not left_done:
+                left_idx = idx - (1 << (height - 1))
+                stack.append((idx, height, True))
+                if left_idx >= num_intervals or max_ends[left_idx] > start:
+                    stack.append((left_idx, height - 1, False))
+            elif idx < num_intervals and starts[idx] < end:
+                if start < ends[idx]:
+                    positions.append(idx)
+                stack.append((idx + (1 << (height - 1)), height - 1, False))
+        return positions
+
+
+class MetadataIndex:
+    """Index over the metadata of a document to query the spans by position, in logarithmic time.
+
+    The metadata are sorted by `(char_start_idx, relative_start_pos)`, i.e. in the order of the opening tags, and the
+    queries return them in this order. A metadata spans the characters `[char_start_idx, char_end_idx)`; a metadata
+    with an empty content doesn't cover any character but is considered to be inside the ranges which contain its
+    position. Each query can be restricted to a tag, with a sub-index built on first use.
+    """
+
+    def __init__(self, metadata: List[Metadata]):
+        self.metadata = sorted(
+            metadata, key=lambda metadata_node: (metadata_node.char_start_idx, metadata_node.relative_start_pos)
+        )
+        self.starts = [metadata_node.char_start_idx for metadata_node in self.metadata]
+        self.ends = [metadata_node.char_end_idx for metadata_node in self.metadata]
+        # Empty spans are indexed as covering their first character, the queries filter them afterwards
+        self._tree = _IntervalTree(self.starts, [max(end, start + 1) for start, end in zip(self.starts, self.ends)])
+        self._tag_indexes = {}
+
+    @classmethod
+    def from_json_metadata(cls, metadata_dicts: List[dict]) -> "MetadataIndex":
+        """Build the index from the metadata of an example of an output file"""
+        return cls([metadata_from_dict(metadata_dict) for metadata_dict in metadata_dicts])
+
+    def __len__(self):
+        return len(self.metadata)
+
+    def tags(self):
+        return sorted({metadata_node.value.tag for metadata_node in self.metadata})
+
+    def _get_index(self, tag: Optional[str]) -> "MetadataIndex":
+        if tag is None:
+            return self
+        if tag not in self._tag_indexes:
+            self._tag_indexes[tag] = MetadataIndex(
+                [metadata_node for metadata_node in self.metadata if metadata_node.value.tag == tag]
+            )
+        return self._tag_indexes[tag]
+
+    def covering(self, char_idx: int, tag: Optional[str] = None) -> List[Metadata]:
+        """Metadata whose content contains the character at `char_idx` (from the outermost to the innermost)"""
+        index = self._get_index(tag)
+        return [
+            index.metadata[position]
+            for position in index._tree.overlapping(char_idx, char_idx + 1)
+            if index.ends[position] > char_idx
+        ]
+
+    def overlapping(self, start: int, end: int, tag: Optional[str] = None) -> List[Metadata]:
+        """Metadata whose content overlaps `[start, end)`, including the empty ones positioned in it"""
+        index = self._get_index(tag)
+        return [index.metadata[position] for position in index._tree.overlapping(start, end)]
+
+    def contained_in(self, start: int, end: int, tag: Optional[str] = None) -> List[Metadata]:
+        """Metadata whose content is inside `[start, end]`"""
+        index = self._get_index(tag)
+        first_position = bisect_left(index.starts, start)
+        last_position = bisect_right(index.starts, end)
+        return [
+            index.metadata[position]
+            for position in range(first_position, last_position)
+            if index.ends[position] <= end
+        ]
+
+    def inside(self, metadata_node: Metadata, tag: Optional[str] = None) -> List[Metadata]:
+        """Metadata nested in `metadata_node` (e.g. the `<a>` of a paragraph), `metadata_node` excluded"""
+        # The relative positions order the tags which open or close at the same character
+        start = (metadata_node.char_start_idx, metadata_node.relative_start_pos)
+        end = (metadata_node.char_end_idx, metadata_node.relative_end_pos)
+        return [
+            other_metadata_node
+            for other_metadata_node in self.contained_in(
+                metadata_node.char_start_idx, metadata_node.char_end_idx, tag=tag
+            )
+            if (other_metadata_node.char_start_idx, other_metadata_node.relative_start_pos) > start
+            and (other_metadata_node.char_end_idx, other_metadata_node.relative_end_pos) < end
+        ]
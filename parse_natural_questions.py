@@ -1,4 +1,4 @@
-import dataclasses
+import argparse
 import gzip
 import json
 import os
@@ -7,7 +7,6 @@ from collections import defaultdict
 from html.parser import HTMLParser
 
 import htmlmin
-import jsonlines
 import numpy as np
 import pandas as pd
 import six
@@ -17,9 +16,11 @@ from lxml.html import fromstring
 from tqdm import tqdm
 
 from html_parser import TagToRemoveWithContent, get_clean_text_and_metadata
+from metadata_encoder import MetadataJsonEncoder
+from result_cache import ResultCache
 
 
-def process_file(file_name):
+def process_file(file_name, cache_path=None, cache_max_bytes=10 * 2 ** 30):
     if file_name in [
         "nq-train-00.jsonl.gz",
         "nq-train-01.jsonl.gz",
@@ -32,33 +33,40 @@ def process_file(file_name):
         print(f"{file_name} already processed")
         return
     print(f"Start process {file_name}")
+    cache = ResultCache(cache_path, max_bytes=cache_max_bytes) if cache_path is not None else None
     file_path = os.path.join(data_dir, "train", file_name)
     target_path = os.path.join(data_dir, "pre-process", file_name)
     with gzip.GzipFile(file_path, "rb") as fi_init:
         with gzip.open(target_path, "w") as fi_target:
-            writer = jsonlines.Writer(fi_target)
+            encoder = MetadataJsonEncoder(schema="dataclass")
             for compt, line in tqdm(enumerate(fi_init)):
                 json_example = json.loads(line)
                 doc_html = json_example["document_html"]  # %%
                 # tags_to_remove_with_content = [TagToRemoveWithContent(tag="script"), TagToRemoveWithContent(tag="style")]
                 plain_text, metadata = get_clean_text_and_metadata(
                     doc_html,
+                    cache=cache,
                     # start_parsing_at_tag="html",
                     # tags_to_remove_with_content=tags_to_remove_with_content
                 )
-                json_example = {
-                    "text": plain_text,
-                    "metadata": [dataclasses.asdict(node) for node in metadata],
-                }
-                writer.write(json_example)
+                fi_target.write(encoder.encode(plain_text, metadata))
+    if cache is not None:
+        print(f"Cache statistics for {file_name}: {cache.stats()}")
     print(f"End process {file_name}")
 
 
+parser = argparse.ArgumentParser()
+# The results of `get_clean_text_and_metadata` are cached in this SQLite file, shared by the jobs (see `ResultCache`)
+parser.add_argument("--cache_path", dest="cache_path", default=None)
+parser.add_argument("--cache_max_bytes", dest="cache_max_bytes", type=float, default=10 * 2 ** 30)
+args = parser.parse_args()
+
 NUM_CORES = 8
 data_dir = os.path.join("data", "v1.0")
 
 list_dir = os.listdir(os.path.join(data_dir, "train"))
 list_dir = [f.lower() for f in list_dir]
 results = Parallel(n_jobs=NUM_CORES)(
-    delayed(process_file)(file_name) for file_name in sorted(list_dir)
+    delayed(process_file)(file_name, cache_path=args.cache_path, cache_max_bytes=args.cache_max_bytes)
+    for file_name in sorted(list_dir)
 )
@@ -1,4 +1,5 @@
 import os
+import sys
 import gzip
 import random
 from collections import defaultdict
@@ -6,19 +7,31 @@ import json
 import argparse
 from tqdm.auto import tqdm
 
+sys.path.append(".")  # It's not very nice, we need to create a module
+from parse_scripts.gzip_index import GZIP_INDEX_SUFFIX, GzipIndex
+
 
 data_path = "toy_random_sampler/data"
 new_dataset_path = "toy_random_sampler/new_dataset"
 
 total_number_examples=11
 
-def main(data_path, new_dataset_path, total_number_examples):
+def list_shards(data_path):
+    return [file_name for file_name in os.listdir(data_path) if not file_name.endswith(GZIP_INDEX_SUFFIX)]
+
+
+def main(data_path, new_dataset_path, total_number_examples, use_index=False):
     samples_index = []
-    print
+    # With `use_index`, the shards are indexed once (see `gzip_index.py`) and the sampled lines are read directly
+    gzip_indexes = {}
 
-    for file_name in tqdm(os.listdir(data_path), desc="Counts the number of samples per file"):
+    for file_name in tqdm(list_shards(data_path), desc="Counts the number of samples per file"):
         file_path = os.path.join(data_path, file_name)
-        num = sum(1 for line in gzip.open(file_path))
+        if use_index:
+            gzip_indexes[file_name] = GzipIndex.load_or_build(file_path)
+            num = gzip_indexes[file_name].num_lines
+        else:
+            num = sum(1 for line in gzip.open(file_path))
         samples_index.extend([(file_name, idx) for idx in range(num)])
 
     if not os.path.isdir(new_dataset_path):
@@ -29,8 +42,13 @@ def main(data_path, new_dataset_path, total_number_examples):
     for sample_index in sampled_indexes:
         sampled_indexes_dict[sample_index[0]].append(sample_index[1])
 
-    for file_name in tqdm(os.listdir(data_path), desc="Write new examples"):
+    for file_name in tqdm(list_shards(data_path), desc="Write new examples"):
         file_path_original = os.path.join(data_path, file_name)
+        if use_index:
+            with gzip.open(os.path.join(new_dataset_path, file_name), "w") as fi_new:
+                for _, line in gzip_indexes[file_name].read_lines(sampled_indexes_dict[file_name]):
+                    fi_new.write(line)
+            continue
         with gzip.open(file_path_original, "r") as fi_org:
             with gzip.open(os.path.join(new_dataset_path, file_name), "w") as fi_new:
                 for idx, line in enumerate(fi_org):
@@ -44,10 +62,12 @@ if __name__ == "__main__":
     parser.add_argument("--data-path", required=True)
     parser.add_argument("--new-dataset-path", required=True)
     parser.add_argument("--total-number-examples", type=int,required=True)
+    parser.add_argument("--use-index", action="store_true")
 
     args = parser.parse_args()
     main(
         data_path=args.data_path, 
         new_dataset_path=args.new_dataset_path, 
-        total_number_examples=args.total_number_examples
+        total_number_examples=args.total_number_examples,
+        use_index=args.use_index,
     )
\ No newline at end of file
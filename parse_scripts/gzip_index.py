@@ -0,0 +1,336 @@
+import argparse
+import ctypes
+import ctypes.util
+import os
+import zlib
+
+import numpy as np
+
+GZIP_INDEX_SUFFIX = ".gzidx"
+# Size of the deflate window, the last 32 KiB of output are enough to restart the decompression at any block
+WINDOW_SIZE = 32768
+_CHUNK_SIZE = 2 ** 18
+
+_Z_OK = 0
+_Z_STREAM_END = 1
+_Z_NO_FLUSH = 0
+_Z_BLOCK = 5
+
+_libz = None
+
+
+class _ZStream(ctypes.Structure):
+    _fields_ = [
+        ("next_in", ctypes.c_void_p),
+        ("avail_in", ctypes.c_uint),
+        ("total_in", ctypes.c_ulong),
+        ("next_out", ctypes.c_void_p),
+        ("avail_out", ctypes.c_uint),
+        ("total_out", ctypes.c_ulong),
+        ("msg", ctypes.c_char_p),
+        ("state", ctypes.c_void_p),
+        ("zalloc", ctypes.c_void_p),
+        ("zfree", ctypes.c_void_p),
+        ("opaque", ctypes.c_void_p),
+        ("data_type", ctypes.c_int),
+        ("adler", ctypes.c_ulong),
+        ("reserved", ctypes.c_ulong),
+    ]
+
+
+def _get_libz():
+    # The `zlib` module doesn't expose `inflatePrime` nor the block boundaries, so zlib is called through ctypes
+    global _libz
+    if _libz is None:
+        library_path = ctypes.util.find_library("z")
+        if library_path is None:
+            raise OSError("The zlib shared library is required to index and seek in gzip files")
+        libz = ctypes.CDLL(library_path)
+        stream_pointer = ctypes.POINTER(_ZStream)
+        libz.zlibVersion.restype = ctypes.c_char_p
+        libz.inflateInit2_.argtypes = [stream_pointer, ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+        libz.inflate.argtypes = [stream_pointer, ctypes.c_int]
+        libz.inflateEnd.argtypes = [stream_pointer]
+        libz.inflatePrime.argtypes = [stream_pointer, ctypes.c_int, ctypes.c_int]
+        libz.inflateSetDictionary.argtypes = [stream_pointer, ctypes.c_char_p, ctypes.c_uint]
+        _libz = libz
+    return _libz
+
+
+class _Inflater:
+    """Thin wrapper of a zlib inflate stream whose output goes to `output` (a ctypes buffer)"""
+
+    def __init__(self, window_bits: int, output_size: int):
+        self.libz = _get_libz()
+        self.stream = _ZStream()
+        self.output = ctypes.create_string_buffer(output_size)
+        self._input = None
+        ret = self.libz.inflateInit2_(
+            ctypes.byref(self.stream), window_bits, self.libz.zlibVersion(), ctypes.sizeof(_ZStream)
+        )
+        if ret != _Z_OK:
+            raise zlib.error(f"Error {ret} while initializing the decompression")
+
+    def set_input(self, data: bytes):
+        # The stream points into the bytes object, which is kept alive until the next input
+        self._input = data
+        self.stream.next_in = ctypes.cast(ctypes.c_char_p(data), ctypes.c_void_p)
+        self.stream.avail_in = len(data)
+
+    def reset_output(self):
+        self.stream.next_out = ctypes.addressof(self.output)
+        self.stream.avail_out = len(self.output)
+
+    def inflate(self, flush: int) -> int:
+        ret = self.libz.inflate(ctypes.byref(self.stream), flush)
+        if ret not in [_Z_OK, _Z_STREAM_END]:
+            message = self.stream.msg.decode() if self.stream.msg else ""
+            raise zlib.error(f"Error {ret} while decompressing: {message}")
+        return ret
+
+    def close(self):
+        self.libz.inflateEnd(ctypes.byref(self.stream))
+
+
+def get_gzip_index_path(shard_path):
+    return shard_path + GZIP_INDEX_SUFFIX
+
+
+class GzipIndex:
+    """Random access to the lines of a gzip file, in the style of zlib's `zran.c`.
+
+    The index stores decompressor checkpoints every `span` bytes of uncompressed data (position in the compressed
+    file, bit offset and the previous 32 KiB of output) and the uncompressed offset of each line. Reading a line only
+    requires decompressing from the last checkpoint before it, so several workers can read different parts of a shard
+    in parallel and a sample of lines can be read without decompressing the whole shard.
+    """
+
+    def __init__(
+        self,
+        shard_path,
+        compressed_offsets,
+        bit_offsets,
+        uncompressed_offsets,
+        windows,
+        window_offsets,
+        line_offsets,
+        compressed_size,
+    ):
+        self.shard_path = shard_path
+        self.compressed_offsets = compressed_offsets
+        self.bit_offsets = bit_offsets
+        self.uncompressed_offsets = uncompressed_offsets
+        # zlib-compressed windows, concatenated
+        self.windows = windows
+        self.window_offsets = window_offsets
+        # Uncompressed offset of the start of each line, plus the size of the uncompressed data
+        self.line_offsets = line_offsets
+        self.compressed_size = compressed_size
+
+    @classmethod
+    def build(cls, shard_path, span: int = 2 ** 20) -> "GzipIndex":
+        """Decompress the whole shard once to create its checkpoints, one every `span` uncompressed bytes"""
+        inflater = _Inflater(window_bits=47, output_size=WINDOW_SIZE)  # 32 + 15: gzip or zlib header
+        stream = inflater.stream
+        checkpoints = []
+        newline_positions = []
+        total_in = total_out = last_checkpoint_out = 0
+        try:
+            with open(shard_path, "rb") as fi:
+                inflater.reset_output()
+                while True:
+                    if stream.avail_in == 0:
+                        chunk = fi.read(_CHUNK_SIZE)
+                        if not chunk:
+                            raise ValueError(f"{shard_path} is truncated")
+                        inflater.set_input(chunk)
+                    if stream.avail_out == 0:
+                        inflater.reset_output()
+                    avail_in, avail_out = stream.avail_in, stream.avail_out
+                    output_start = WINDOW_SIZE - avail_out
+                    ret = inflater.inflate(_Z_BLOCK)
+                    total_in += avail_in - stream.avail_in
+                    num_produced = avail_out - stream.avail_out
+                    if num_produced:
+                        produced = np.frombuffer(
+                            inflater.output, dtype=np.uint8, count=num_produced, offset=output_start
+                        )
+                        newline_positions.append(np.flatnonzero(produced == ord("\n")) + total_out)
+                        total_out += num_produced
+                    if ret == _Z_STREAM_END:
+                        break
+                    # At the end of a deflate block (and not at the end of the last one)
+                    if (
+                        stream.data_type & 128
+                        and not stream.data_type & 64
+                        and (total_out == 0 or total_out - last_checkpoint_out >= span)
+                    ):
+                        output_end = WINDOW_SIZE - stream.avail_out
+                        window = inflater.output.raw[output_end:] + inflater.output.raw[:output_end]
+                        checkpoints.append((total_in, stream.data_type & 7, total_out, zlib.compress(window)))
+                        last_checkpoint_out = total_out
+                if stream.avail_in > 0 or fi.read(1):
+                    raise ValueError(f"{shard_path} has several gzip members, which can't be indexed")
+        finally:
+            inflater.close()
+
+        newline_positions = np.concatenate(newline_positions) if newline_positions else np.zeros(0, dtype=np.int64)
+        line_offsets = np.concatenate([[0], newline_positions + 1]).astype(np.uint64)
+        if line_offsets[-1] != total_out:
+            line_offsets = np.append(line_offsets, np.uint64(total_out))
+        windows = [checkpoint[3] for checkpoint in checkpoints]
+        return cls(
+            shard_path,
+            compressed_offsets=np.array([checkpoint[0] for checkpoint in checkpoints], dtype=np.uint64),
+            bit_offsets=np.array([checkpoint[1] for checkpoint in checkpoints], dtype=np.uint8),
+            uncompressed_offsets=np.array([checkpoint[2] for checkpoint in checkpoints], dtype=np.uint64),
+            windows=np.frombuffer(b"".join(windows), dtype=np.uint8),
+            window_offsets=np.cumsum([0] + [len(window) for window in windows]).astype(np.uint64),
+            line_offsets=line_offsets,
+            compressed_size=os.path.getsize(shard_path),
+        )
+
+    def save(self, index_path=None):
+        with open(index_path or get_gzip_index_path(self.shard_path), "wb") as fo:
+            np.savez(
+                fo,
+                compressed_offsets=self.compressed_offsets,
+                bit_offsets=self.bit_offsets,
+                uncompressed_offsets=self.uncompressed_offsets,
+                windows=self.windows,
+                window_offsets=self.window_offsets,
+                line_offsets=self.line_offsets,
+                compressed_size=np.uint64(self.compressed_size),
+            )
+
+    @classmethod
+    def load(cls, shard_path, index_path=None) -> "GzipIndex":
+        with np.load(index_path or get_gzip_index_path(shard_path)) as arrays:
+            gzip_index = cls(shard_path, **{name: arrays[name] for name in arrays.files})
+        gzip_index.compressed_size = int(gzip_index.compressed_size)
+        if os.path.getsize(shard_path) != gzip_index.compressed_size:
+            raise ValueError(f"The index of {shard_path} is outdated, it must be built again")
+        return gzip_index
+
+    @classmethod
+    def load_or_build(cls, shard_path, span: int = 2 ** 20) -> "GzipIndex":
+        if os.path.exists(get_gzip_index_path(shard_path)):
+            return cls.load(shard_path)
+        gzip_index = cls.build(shard_path, span=span)
+        gzip_index.save()
+        return gzip_index
+
+    @property
+    def num_lines(self):
+        return len(self.line_offsets) - 1
+
+    def __len__(self):
+        return self.num_lines
+
+    def _iter_decompressed(self, checkpoint_idx):
+        """Yield the uncompressed data from the checkpoint `checkpoint_idx` (-1 for the start of the file)"""
+        with open(self.shard_path, "rb") as fi:
+            if checkpoint_idx < 0:
+                inflater = _Inflater(window_bits=47, output_size=_CHUNK_SIZE)
+            else:
+                inflater = _Inflater(window_bits=-15, output_size=_CHUNK_SIZE)  # raw deflate
+                bit_offset = int(self.bit_offsets[checkpoint_idx])
+                fi.seek(int(self.compressed_offsets[checkpoint_idx]) - (1 if bit_offset else 0))
+                if bit_offset:
+                    # The block starts in the middle of the previous byte
+                    inflater.libz.inflatePrime(
+                        ctypes.byref(inflater.stream), bit_offset, fi.read(1)[0] >> (8 - bit_offset)
+                    )
+                window_start = int(self.window_offsets[checkpoint_idx])
+                window_end = int(self.window_offsets[checkpoint_idx + 1])
+                window = zlib.decompress(self.windows[window_start:window_end].tobytes())
+                inflater.libz.inflateSetDictionary(ctypes.byref(inflater.stream), window, len(window))
+            try:
+                stream = inflater.stream
+                while True:
+                    if stream.avail_in == 0:
+                        chunk = fi.read(_CHUNK_SIZE)
+                        if not chunk:
+                            return
+                        inflater.set_input(chunk)
+                    inflater.reset_output()
+                    ret = inflater.inflate(_Z_NO_FLUSH)
+                    num_produced = len(inflater.output) - stream.avail_out
+                    if num_produced:
+                        yield inflater.output.raw[:num_produced]
+                    if ret == _Z_STREAM_END:
+                        return
+            finally:
+                inflater.close()
+
+    def iter_lines(self, start_line: int = 0, end_line=None):
+        """Yield the lines `start_line` to `end_line` (excluded) of the shard, newline included"""
+        end_line = self.num_lines if end_line is None else min(end_line, self.num_lines)
+        if start_line >= end_line:
+            return
+        line_offsets = self.line_offsets
+        start_offset = int(line_offsets[start_line])
+        checkpoint_idx = int(np.searchsorted(self.uncompressed_offsets, start_offset, side="right")) - 1
+        buffer_offset = int(self.uncompressed_offsets[checkpoint_idx]) if checkpoint_idx >= 0 else 0
+
+        buffer = bytearray()
+        line = start_line
+        for chunk in self._iter_decompressed(checkpoint_idx):
+            buffer += chunk
+            buffer_end = buffer_offset + len(buffer)
+            while line < end_line and int(line_offsets[line + 1]) <= buffer_end:
+                yield bytes(
+                    buffer[int(line_offsets[line]) - buffer_offset : int(line_offsets[line + 1]) - buffer_offset]
+                )
+                line += 1
+            if line >= end_line:
+                return
+            # Only the start of the current line is kept
+            num_consumed = min(int(line_offsets[line]), buffer_end) - buffer_offset
+            del buffer[:num_consumed]
+            buffer_offset += num_consumed
+
+    def read_lines(self, line_indexes):
+        """Yield `(line index, line)` for the requested lines, in increasing order. A decompression is started at
+        each checkpoint which precedes a requested line, the rest of the shard is skipped."""
+        line_indexes = sorted(set(line_indexes))
+        checkpoint_idxs = (
+            np.searchsorted(self.uncompressed_offsets, self.line_offsets[line_indexes], side="right") - 1
+            if line_indexes
+            else []
+        )
+        group_start = 0
+        for idx in range(1, len(line_indexes) + 1):
+            if idx < len(line_indexes) and checkpoint_idxs[idx] == checkpoint_idxs[group_start]:
+                continue
+            group = line_indexes[group_start:idx]
+            requested = set(group)
+            for line_idx, line in enumerate(self.iter_lines(group[0], group[-1] + 1), start=group[0]):
+                if line_idx in requested:
+                    yield line_idx, line
+            group_start = idx
+
+    def split(self, num_parts: int):
+        """Split the lines in `num_parts` ranges `(start_line, end_line)` of about the same uncompressed size"""
+        total_size = int(self.line_offsets[-1])
+        boundaries = [0]
+        for part_idx in range(1, num_parts):
+            line = int(np.searchsorted(self.line_offsets[:-1], total_size * part_idx // num_parts))
+            boundaries.append(max(line, boundaries[-1]))
+        boundaries.append(self.num_lines)
+        return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the random-access index of .jsonl.gz shards")
+    parser.add_argument("shard_paths", nargs="+")
+    parser.add_argument("--span", dest="span", type=int, default=2 ** 20)
+    args = parser.parse_args()
+
+    for shard_path in args.shard_paths:
+        gzip_index = GzipIndex.build(shard_path, span=args.span)
+        gzip_index.save()
+        print(
+            f"{shard_path}: {gzip_index.num_lines} lines, {len(gzip_index.uncompressed_offsets)} checkpoints, "
+            f"{os.path.getsize(get_gzip_index_path(shard_path))} bytes of index"
+        )
@@ -0,0 +1,176 @@
+import json
+import mmap
+import os
+import struct
+import zlib
+
+import numpy as np
+
+INDEX_SUFFIX = ".idx"
+INDEX_MAGIC = b"NQSHARD1"
+COMPRESSIONS = [None, "zlib"]
+# magic, compression (0: none, 1: zlib), number of records, number of blocks
+_INDEX_HEADER = struct.Struct("<8sBQQ")
+
+
+def get_index_path(data_path):
+    return data_path + INDEX_SUFFIX
+
+
+def is_indexed_shard(data_path):
+    return os.path.exists(get_index_path(data_path))
+
+
+class IndexedShardWriter:
+    """Write the encoded lines of a processed shard in a data file, plus an offset index for random access.
+
+    Without compression, the data file is the plain JSONL. With `compression="zlib"`, the lines are grouped in blocks
+    of about `block_size` uncompressed bytes which are compressed independently, so that reading a line only requires
+    decompressing its block. The index is written next to the data file (`<data_path>.idx`) when the writer is closed.
+    """
+
+    def __init__(self, data_path, compression=None, block_size=2 ** 20, compression_level=6):
+        if compression not in COMPRESSIONS:
+            raise ValueError(
+                f"You have requested an invalid compression ({compression}). Valid compressions are {COMPRESSIONS}."
+            )
+        self.data_path = data_path
+        self.compression = compression
+        self.block_size = block_size
+        self.compression_level = compression_level
+        self._fp = open(data_path, "wb")
+        # Offsets of the lines in the uncompressed stream
+        self._record_offsets = [0]
+        # Offsets of the blocks in the uncompressed stream and in the data file
+        self._block_offsets = [0]
+        self._block_file_offsets = [0]
+        self._block = []
+        self._block_num_bytes = 0
+
+    def write(self, record: bytes):
+        self._record_offsets.append(self._record_offsets[-1] + len(record))
+        if self.compression is None:
+            self._fp.write(record)
+            return
+        self._block.append(record)
+        self._block_num_bytes += len(record)
+        if self._block_num_bytes >= self.block_size:
+            self._flush_block()
+
+    def _flush_block(self):
+        if not self._block:
+            return
+        compressed_block = zlib.compress(b"".join(self._block), self.compression_level)
+        self._fp.write(compressed_block)
+        self._block_offsets.append(self._block_offsets[-1] + self._block_num_bytes)
+        self._block_file_offsets.append(self._block_file_offsets[-1] + len(compressed_block))
+        self._block = []
+        self._block_num_bytes = 0
+
+    def close(self):
+        if self._fp.closed:
+            return
+        if self.compression is not None:
+            self._flush_block()
+        self._fp.close()
+
+        num_records = len(self._record_offsets) - 1
+        num_blocks = len(self._block_offsets) - 1
+        with open(get_index_path(self.data_path), "wb") as fi_index:
+            fi_index.write(
+                _INDEX_HEADER.pack(INDEX_MAGIC, COMPRESSIONS.index(self.compression), num_records, num_blocks)
+            )
+            fi_index.write(np.asarray(self._record_offsets, dtype="<u8").tobytes())
+            fi_index.write(np.asarray(self._block_offsets, dtype="<u8").tobytes())
+            fi_index.write(np.asarray(self._block_file_offsets, dtype="<u8").tobytes())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class IndexedShard:
+    """Random-access reader of a shard written by `IndexedShardWriter`.
+
+    The data file and the index are memory-mapped, so the pages are shared by all the processes which open the same
+    shard. `shard[i]` returns the i-th example (resolving the `{"duplicate_of": line}` references), `shard[i:j]` a list
+    of examples and `shard.get_bytes(i)` the encoded line. A reader can be pickled, the copy maps the files again.
+    """
+
+    def __init__(self, data_path):
+        self.data_path = data_path
+        self._open()
+
+    def _open(self):
+        with open(get_index_path(self.data_path), "rb") as fi_index:
+            self._index_mmap = mmap.mmap(fi_index.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, compression_id, num_records, num_blocks = _INDEX_HEADER.unpack_from(self._index_mmap, 0)
+        if magic != INDEX_MAGIC:
+            raise ValueError(f"{get_index_path(self.data_path)} is not the index of a processed shard")
+        self.compression = COMPRESSIONS[compression_id]
+        offset = _INDEX_HEADER.size
+        self._record_offsets = np.frombuffer(self._index_mmap, dtype="<u8", count=num_records + 1, offset=offset)
+        offset += 8 * (num_records + 1)
+        self._block_offsets = np.frombuffer(self._index_mmap, dtype="<u8", count=num_blocks + 1, offset=offset)
+        offset += 8 * (num_blocks + 1)
+        self._block_file_offsets = np.frombuffer(self._index_mmap, dtype="<u8", count=num_blocks + 1, offset=offset)
+
+        with open(self.data_path, "rb") as fi_data:
+            # An empty file can't be memory-mapped
+            self._data_mmap = (
+                mmap.mmap(fi_data.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(fi_data.fileno()).st_size else b""
+            )
+        self._cached_block_idx = None
+        self._cached_block = None
+
+    def __getstate__(self):
+        return {"data_path": self.data_path}
+
+    def __setstate__(self, state):
+        self.data_path = state["data_path"]
+        self._open()
+
+    def __len__(self):
+        return len(self._record_offsets) - 1
+
+    def _get_block(self, block_idx):
+        if block_idx != self._cached_block_idx:
+            start = int(self._block_file_offsets[block_idx])
+            end = int(self._block_file_offsets[block_idx + 1])
+            self._cached_block = zlib.decompress(self._data_mmap[start:end])
+            self._cached_block_idx = block_idx
+        return self._cached_block
+
+    def get_bytes(self, idx: int) -> bytes:
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f"Index {idx} is out of range for a shard of {len(self)} examples")
+        start = int(self._record_offsets[idx])
+        end = int(self._record_offsets[idx + 1])
+        if self.compression is None:
+            return self._data_mmap[start:end]
+        block_idx = int(np.searchsorted(self._block_offsets, start, side="right")) - 1
+        block_start = int(self._block_offsets[block_idx])
+        return self._get_block(block_idx)[start - block_start : end - block_start]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        json_example = json.loads(self.get_bytes(idx))
+        if "duplicate_of" in json_example:
+            json_example = json.loads(self.get_bytes(json_example["duplicate_of"]))
+        return json_example
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def close(self):
+        if isinstance(self._data_mmap, mmap.mmap):
+            self._data_mmap.close()
+        # The arrays are views of the index mapping
+        self._record_offsets = self._block_offsets = self._block_file_offsets = None
+        self._index_mmap.close()
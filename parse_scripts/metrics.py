@@ -0,0 +1,275 @@
+"""Throughput and latency metrics of the processing of the shards (see `pipeline.process_file`).
+
+Usage: python parse_scripts/metrics.py <metrics files of the shards, in JSON lines>
+Prints the summary of all the shards, from the last snapshot of each file.
+"""
+import argparse
+import json
+import os
+import time
+from bisect import bisect_left
+from typing import Dict, List, Optional
+
+METRICS_FORMATS = ["jsonl", "prometheus"]
+STAGES = ["read", "process", "wait", "write", "document"]
+# Upper bounds of the latency buckets, in seconds, from 100 µs to about 2 minutes
+LATENCY_BOUNDS = [1e-4 * 2 ** idx for idx in range(21)]
+QUANTILES = [0.5, 0.95, 0.99]
+
+
+class LatencyHistogram:
+    """Counts of the latencies by bucket (`LATENCY_BOUNDS`, plus one bucket for the larger latencies).
+
+    The quantiles are interpolated within their bucket, so they are precise to a factor 2 at worst. The histograms of
+    several shards are merged with `update`.
+    """
+
+    def __init__(self, counts: Optional[List[int]] = None, total: float = 0.0, maximum: float = 0.0):
+        self.counts = counts if counts is not None else [0] * (len(LATENCY_BOUNDS) + 1)
+        self.total = total
+        self.maximum = maximum
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def observe(self, seconds: float):
+        self.counts[bisect_left(LATENCY_BOUNDS, seconds)] += 1
+        self.total += seconds
+        self.maximum = max(self.maximum, seconds)
+
+    def update(self, other: "LatencyHistogram"):
+        self.counts = [count + other_count for count, other_count in zip(self.counts, other.counts)]
+        self.total += other.total
+        self.maximum = max(self.maximum, other.maximum)
+
+    def quantile(self, q: float) -> float:
+        count = self.count
+        if not count:
+            return 0.0
+        rank = q * count
+        cumulative_count = 0
+        for bucket_idx, bucket_count in enumerate(self.counts):
+            if bucket_count and cumulative_count + bucket_count >= rank:
+                lower_bound = LATENCY_BOUNDS[bucket_idx - 1] if bucket_idx > 0 else 0.0
+                upper_bound = LATENCY_BOUNDS[bucket_idx] if bucket_idx < len(LATENCY_BOUNDS) else self.maximum
+                quantile = lower_bound + (upper_bound - lower_bound) * (rank - cumulative_count) / bucket_count
+                return min(quantile, self.maximum)
+            cumulative_count += bucket_count
+        return self.maximum
+
+    def to_dict(self):
+        return {"counts": self.counts, "sum": self.total, "max": self.maximum}
+
+    @classmethod
+    def from_dict(cls, histogram_dict) -> "LatencyHistogram":
+        return cls(list(histogram_dict["counts"]), histogram_dict["sum"], histogram_dict["max"])
+
+
+class PipelineMetrics:
+    """Counters and latency histograms by stage of the processing of a shard, exported every `interval` seconds.
+
+    The stages of a document are its reading ("read", decompression and decoding), the call to `process_example`
+    ("process", measured in the thread or the worker process which runs it), the time the main thread waits for its
+    output ("wait", close to "process" without a pool and short when the pool keeps up), the encoding and the writing
+    of the output ("write"), and the whole time from its reading to its writing ("document"), which includes the time
+    it waits to be processed when the documents are processed ahead by a pool.
+
+    The documents skipped by the pipeline (`skipped_documents`) are the ones over the `doc_timeout` budget
+    (`timeouts`), the ones which crashed the worker process (`worker_crashes`) and the ones rejected by
+    `process_example` (`rejected_documents`, see `pipeline.DocumentSkipped`). `fatal_errors` counts the errors which
+    stopped the processing of the shard. With `metrics_path`, a snapshot is appended to the file as a JSON line
+    (`metrics_format="jsonl"`), or the file is replaced by the Prometheus text format (`metrics_format="prometheus"`,
+    for the textfile collector of the node exporter).
+    """
+
+    def __init__(
+        self,
+        shard: str,
+        metrics_path: Optional[str] = None,
+        metrics_format: str = "jsonl",
+        interval: float = 30.0,
+    ):
+        if metrics_format not in METRICS_FORMATS:
+            raise ValueError(
+                f"You have requested an invalid metrics format ({metrics_format}). Valid formats are "
+                f"{METRICS_FORMATS}."
+            )
+        self.shard = shard
+        self.metrics_path = metrics_path
+        self.metrics_format = metrics_format
+        self.interval = interval
+        self.counters: Dict[str, int] = {
+            "documents": 0,
+            "duplicates": 0,
+            "skipped_documents": 0,
+            "timeouts": 0,
+            "worker_crashes": 0,
+            "rejected_documents": 0,
+            "fatal_errors": 0,
+            "output_bytes": 0,
+        }
+        self.histograms = {stage: LatencyHistogram() for stage in STAGES}
+        self.start_time = time.time()
+        self._start = time.perf_counter()
+        self._last_export = self._start
+        # Time at which each document being processed was read, by line
+        self._read_times = {}
+
+    def inc(self, counter: str, value: int = 1):
+        self.counters[counter] += value
+
+    def observe(self, stage: str, seconds: float):
+        self.histograms[stage].observe(seconds)
+
+    def iter_timed(self, documents):
+        """Yield the documents of `pipeline._iter_documents`, measuring the "read" stage. It can be consumed by
+        another thread than the one which calls `document_done`."""
+        documents = iter(documents)
+        while True:
+            start = time.perf_counter()
+            try:
+                document = next(documents)
+            except StopIteration:
+                return
+            read_time = time.perf_counter()
+            self.observe("read", read_time - start)
+            self._read_times[document[0]] = read_time
+            yield document
+
+    def document_done(self, line: int):
+        self.counters["documents"] += 1
+        read_time = self._read_times.pop(line, None)
+        if read_time is not None:
+            self.observe("document", time.perf_counter() - read_time)
+        if time.perf_counter() - self._last_export >= self.interval:
+            self.export()
+
+    def snapshot(self):
+        elapsed = time.perf_counter() - self._start
+        return {
+            "shard": self.shard,
+            "time": time.time(),
+            "start_time": self.start_time,
+            "elapsed_s": elapsed,
+            "docs_per_s": self.counters["documents"] / elapsed if elapsed > 0 else 0.0,
+            "skip_rate": _get_skip_rate(self.counters),
+            "counters": dict(self.counters),
+            "histograms": {stage: histogram.to_dict() for stage, histogram in self.histograms.items()},
+        }
+
+    def export(self):
+        self._last_export = time.perf_counter()
+        if self.metrics_path is None:
+            return
+        if self.metrics_format == "jsonl":
+            with open(self.metrics_path, "a") as fo:
+                fo.write(json.dumps(self.snapshot()) + "\n")
+            return
+        # The collector must never read a partial file
+        tmp_path = self.metrics_path + ".tmp"
+        with open(tmp_path, "w") as fo:
+            fo.write(format_prometheus(self.snapshot()))
+        os.replace(tmp_path, self.metrics_path)
+
+    def summary(self) -> str:
+        return format_summary(self.snapshot())
+
+    def close(self):
+        self.export()
+        print(self.summary())
+
+
+def _get_skip_rate(counters) -> float:
+    return counters.get("skipped_documents", 0) / counters["documents"] if counters.get("documents") else 0.0
+
+
+def _format_labels(labels) -> str:
+    escaped_labels = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels.items()
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped_labels) + "}"
+
+
+def format_prometheus(snapshot) -> str:
+    lines = []
+    shard_labels = {"shard": snapshot["shard"]}
+    for counter, value in snapshot["counters"].items():
+        lines.append(f"# TYPE nq_{counter}_total counter")
+        lines.append(f"nq_{counter}_total{_format_labels(shard_labels)} {value}")
+    lines.append("# TYPE nq_docs_per_second gauge")
+    lines.append(f"nq_docs_per_second{_format_labels(shard_labels)} {snapshot['docs_per_s']}")
+    lines.append("# TYPE nq_skip_rate gauge")
+    lines.append(f"nq_skip_rate{_format_labels(shard_labels)} {snapshot['skip_rate']}")
+    lines.append("# TYPE nq_stage_latency_seconds histogram")
+    for stage, histogram_dict in snapshot["histograms"].items():
+        labels = {**shard_labels, "stage": stage}
+        cumulative_count = 0
+        for bound, count in zip(LATENCY_BOUNDS + ["+Inf"], histogram_dict["counts"]):
+            cumulative_count += count
+            lines.append(f"nq_stage_latency_seconds_bucket{_format_labels({**labels, 'le': bound})} {cumulative_count}")
+        lines.append(f"nq_stage_latency_seconds_sum{_format_labels(labels)} {histogram_dict['sum']}")
+        lines.append(f"nq_stage_latency_seconds_count{_format_labels(labels)} {cumulative_count}")
+    return "\n".join(lines) + "\n"
+
+
+def format_summary(snapshot) -> str:
+    counters = snapshot["counters"]
+    lines = [
+        f"Metrics of {snapshot['shard']}: {counters['documents']} documents in {snapshot['elapsed_s']:.1f}s "
+        f"({snapshot['docs_per_s']:.1f} docs/s), {counters['duplicates']} duplicates, "
+        f"{counters['skipped_documents']} skipped ({snapshot['skip_rate']:.2%}: {counters['timeouts']} timeouts, "
+        f"{counters['worker_crashes']} worker crashes, {counters['rejected_documents']} rejected), "
+        f"{counters['fatal_errors']} fatal errors"
+    ]
+    for stage, histogram_dict in snapshot["histograms"].items():
+        histogram = LatencyHistogram.from_dict(histogram_dict)
+        if not histogram.count:
+            continue
+        quantiles = ", ".join(f"p{round(q * 100)}: {histogram.quantile(q) * 1000:.2f}ms" for q in QUANTILES)
+        lines.append(f"  {stage}: {quantiles}, max: {histogram.maximum * 1000:.2f}ms ({histogram.count} samples)")
+    return "\n".join(lines)
+
+
+def merge_snapshots(snapshots, shard="all"):
+    """Snapshot of several shards processed in parallel: the counters and the histograms are summed and the
+    throughput is measured from the start of the first shard to the last snapshot"""
+    counters = {}
+    histograms = {}
+    for snapshot in snapshots:
+        for counter, value in snapshot["counters"].items():
+            counters[counter] = counters.get(counter, 0) + value
+        for stage, histogram_dict in snapshot["histograms"].items():
+            histograms.setdefault(stage, LatencyHistogram()).update(LatencyHistogram.from_dict(histogram_dict))
+    start_time = min((snapshot["start_time"] for snapshot in snapshots), default=0.0)
+    end_time = max((snapshot["time"] for snapshot in snapshots), default=0.0)
+    elapsed = end_time - start_time
+    return {
+        "shard": shard,
+        "time": end_time,
+        "start_time": start_time,
+        "elapsed_s": elapsed,
+        "docs_per_s": counters.get("documents", 0) / elapsed if elapsed > 0 else 0.0,
+        "skip_rate": _get_skip_rate(counters),
+        "counters": counters,
+        "histograms": {stage: histogram.to_dict() for stage, histogram in histograms.items()},
+    }
+
+
+def load_last_snapshot(metrics_path):
+    last_line = None
+    with open(metrics_path, "r") as fi:
+        for line in fi:
+            if line.strip():
+                last_line = line
+    return json.loads(last_line) if last_line is not None else None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summary of the metrics of the shards being processed")
+    parser.add_argument("metrics_paths", nargs="+")
+    args = parser.parse_args()
+
+    snapshots = [load_last_snapshot(metrics_path) for metrics_path in args.metrics_paths]
+    print(format_summary(merge_snapshots([snapshot for snapshot in snapshots if snapshot is not None])))
@@ -1,14 +1,11 @@
 import argparse
 import dataclasses
-import gzip
-import json
+import functools
 import os
 import sys
-from typing import OrderedDict
+from typing import Optional, OrderedDict
 
-import jsonlines
 from joblib import Parallel, delayed
-from tqdm import tqdm
 
 sys.path.append(".")  # It's not very nice, we need to create a module
 from html_parser import (
@@ -17,6 +14,9 @@ from html_parser import (
     get_clean_text_and_metadata,
     Metadata,
 )
+from metadata_encoder import MetadataJsonEncoder
+from parse_scripts import pipeline
+from result_cache import ResultCache
 
 
 def convert_html_metadata_dataclass_to_dict(metadata: Metadata):
@@ -28,6 +28,11 @@ def convert_html_metadata_dataclass_to_dict(metadata: Metadata):
             "relative_start_pos": metadata.relative_start_pos,
             "char_end_idx": metadata.char_end_idx,
             "relative_end_pos": metadata.relative_end_pos,
+            **(
+                {"byte_start_idx": metadata.byte_start_idx, "byte_end_idx": metadata.byte_end_idx}
+                if metadata.byte_start_idx is not None
+                else {}
+            ),
             # The information about the HTML tag is separated into two keys because the dictionary must have a stable
             # format between the different types of metadata
             "value": metadata.value.tag,
@@ -37,7 +42,7 @@ def convert_html_metadata_dataclass_to_dict(metadata: Metadata):
     return html_metadata_dict
 
 
-def process_example(doc_html):  # %%
+def get_cleaner_config():
     forms_tags = [
         # "button",
         # "datalist",
@@ -93,8 +98,7 @@ def process_example(doc_html):  # %%
         # *[TagToRemove(tag=tag, content_max_char_length=128) for tag in tags_to_remove_alone_standard_textual],
         # *[TagToRemove(tag=tag, content_max_char_length=64) for tag in tags_to_remove_alone_specific],
     ]
-    plain_text, metadata = get_clean_text_and_metadata(
-        doc_html,
+    return dict(
         tags_to_remove_with_content=tags_to_remove_with_content,
         tags_to_remove_alone=tags_to_remove_alone,
         # attrs_to_keep=["class", "id"],
@@ -103,6 +107,14 @@ def process_example(doc_html):  # %%
         # tags_exceptions_to_txt_max_min_chr_len_with_content=tags_to_remove_alone_specific
         convert_br_tag_to_breaking_line=True,
     )
+
+
+def process_example(
+    doc_html, cache: Optional[ResultCache] = None, encoder: Optional[MetadataJsonEncoder] = None
+):  # %%
+    plain_text, metadata = get_clean_text_and_metadata(doc_html, **get_cleaner_config(), cache=cache)
+    if encoder is not None:
+        return encoder.encode(plain_text, metadata)
     json_example = {
         "text": plain_text,
         "metadata": [
@@ -112,8 +124,15 @@ def process_example(doc_html):  # %%
     return json_example
 
 
-def process_file(file_name, data_dir_target, split="train"):
-    print(f"Start process {file_name}")
+def process_file(
+    file_name,
+    data_dir_target,
+    split="train",
+    doc_timeout=None,
+    cache_path=None,
+    cache_max_bytes=10 * 2 ** 30,
+    dedup=None,
+):
     file_path = os.path.join(data_dir_orig, split, file_name)
     target_dir = data_dir_target
     print(f"Results will be saved into {target_dir}")
@@ -123,15 +142,16 @@ def process_file(file_name, data_dir_target, split="train"):
     if not os.path.exists(target_dir):
         os.makedirs(target_dir)
 
-    with gzip.GzipFile(file_path, "rb") as fi_init:
-        with gzip.open(target_path, "w") as fi_target:
-            writer = jsonlines.Writer(fi_target)
-            for compt, line in tqdm(enumerate(fi_init)):
-                json_example = json.loads(line)
-                doc_html = json_example["document_html"]
-                json_example = process_example(doc_html)
-                writer.write(json_example)
-    print(f"End process {file_name}")
+    cache = ResultCache(cache_path, max_bytes=cache_max_bytes) if cache_path is not None else None
+    pipeline.process_file(
+        file_path,
+        target_path,
+        functools.partial(process_example, cache=cache, encoder=MetadataJsonEncoder(schema="flat")),
+        doc_timeout=doc_timeout,
+        dedup=dedup,
+    )
+    if cache is not None:
+        print(f"Cache statistics for {file_name}: {cache.stats()}")
 
 
 if __name__ == "__main__":
@@ -142,6 +162,10 @@ if __name__ == "__main__":
     parser.add_argument("--data-dir-target", required=True)
     parser.add_argument("--num-cores", dest="num_cores")
     parser.set_defaults(num_cores=8)
+    parser.add_argument("--doc-timeout", dest="doc_timeout", type=float, default=None)
+    parser.add_argument("--cache-path", dest="cache_path", default=None)
+    parser.add_argument("--cache-max-bytes", dest="cache_max_bytes", type=float, default=10 * 2 ** 30)
+    parser.add_argument("--dedup", dest="dedup", choices=["copy", "reference"], default=None)
 
     args = parser.parse_args()
 
@@ -152,12 +176,30 @@ if __name__ == "__main__":
     list_dir = os.listdir(os.path.join(data_dir_orig, split))
     list_dir = [f.lower() for f in list_dir]
     results = Parallel(n_jobs=NUM_CORES)(
-        delayed(process_file)(file_name, args.data_dir_target, split) for file_name in sorted(list_dir)
+        delayed(process_file)(
+            file_name,
+            args.data_dir_target,
+            split,
+            args.doc_timeout,
+            args.cache_path,
+            args.cache_max_bytes,
+            args.dedup,
+        )
+        for file_name in sorted(list_dir)
     )
 
     split = "dev"
     list_dir = os.listdir(os.path.join(data_dir_orig, split))
     list_dir = [f.lower() for f in list_dir]
     results = Parallel(n_jobs=NUM_CORES)(
-        delayed(process_file)(file_name, args.data_dir_target, split) for file_name in sorted(list_dir)
+        delayed(process_file)(
+            file_name,
+            args.data_dir_target,
+            split,
+            args.doc_timeout,
+            args.cache_path,
+            args.cache_max_bytes,
+            args.dedup,
+        )
+        for file_name in sorted(list_dir)
     )
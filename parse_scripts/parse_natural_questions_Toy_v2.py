@@ -1,23 +1,30 @@
 import argparse
 import dataclasses
-import gzip
-import json
+import functools
 import os
 import sys
-from typing import OrderedDict
+from typing import Optional, OrderedDict
 
-import jsonlines
 from joblib import Parallel, delayed
-from tqdm import tqdm
 
 sys.path.append(".")  # It's not very nice, we need to create a module
+from attribute_sketches import AttributeSketches
 from html_parser import (
+    ENGINES,
+    DocumentLimits,
+    DocumentStats,
+    StringVocabulary,
+    SubtreeCache,
     TagToRemove,
     TagToRemoveWithContent,
     get_clean_text_and_metadata,
     Metadata,
 )
-
+from metadata_encoder import MetadataJsonEncoder
+from parse_scripts import pipeline
+from parse_scripts.gzip_index import GZIP_INDEX_SUFFIX, GzipIndex
+from parse_scripts.metrics import METRICS_FORMATS
+from result_cache import ResultCache
 
 def convert_html_metadata_dataclass_to_dict(metadata: Metadata):
     html_metadata_dict = OrderedDict(
@@ -28,6 +35,11 @@ def convert_html_metadata_dataclass_to_dict(metadata: Metadata):
             "relative_start_pos": metadata.relative_start_pos,
             "char_end_idx": metadata.char_end_idx,
             "relative_end_pos": metadata.relative_end_pos,
+            **(
+                {"byte_start_idx": metadata.byte_start_idx, "byte_end_idx": metadata.byte_end_idx}
+                if metadata.byte_start_idx is not None
+                else {}
+            ),
             # The information about the HTML tag is separated into two keys because the dictionary must have a stable
             # format between the different types of metadata
             "value": metadata.value.tag,
@@ -37,7 +49,7 @@ def convert_html_metadata_dataclass_to_dict(metadata: Metadata):
     return html_metadata_dict
 
 
-def process_example(doc_html):  # %%
+def get_cleaner_config():
     forms_tags = [
         # "button",
         # "datalist",
@@ -85,42 +97,186 @@ def process_example(doc_html):  # %%
         # *[TagToRemove(tag=tag, content_max_char_length=128) for tag in tags_to_remove_alone_standard_textual],
         # *[TagToRemove(tag=tag, content_max_char_length=64) for tag in tags_to_remove_alone_specific],
     ]
-    plain_text, metadata = get_clean_text_and_metadata(
-        doc_html,
+    return dict(
         tags_to_remove_with_content=tags_to_remove_with_content,
         tags_to_remove_alone=tags_to_remove_alone,
         # attrs_to_keep=["class", "id"],
         consecutive_tags_to_fold=["div"],
     )
-    json_example = {
-        "text": plain_text,
-        "metadata": [
-            convert_html_metadata_dataclass_to_dict(node) for node in metadata
-        ],
-    }
-    return json_example
 
 
-def process_file(file_name, split="train"):
-    print(f"Start process {file_name}")
+def process_example(
+    doc_html,
+    document_limits: Optional[DocumentLimits] = None,
+    cache: Optional[ResultCache] = None,
+    subtree_cache: Optional[SubtreeCache] = None,
+    encoder: Optional[MetadataJsonEncoder] = None,
+    track_byte_offsets: bool = False,
+    engine: str = "tree",
+    collect_stats: bool = False,
+    attribute_sketches: Optional[AttributeSketches] = None,
+    binary: bool = False,
+    vocabulary: Optional[StringVocabulary] = None,
+):  # %%
+    """Returns the output example of a document, or with `collect_stats` a dictionary with the output example
+    ("examples") and the `DocumentStats` of the document ("stats"). With `binary`, the example is the plain text and
+    the metadata, encoded by the pipeline (the limit decisions are not part of it). A document skipped because of a
+    limit raises `pipeline.DocumentSkipped` with its example."""
+    limit_decisions = []
+    stats = DocumentStats() if collect_stats else None
+    plain_text, metadata = get_clean_text_and_metadata(
+        doc_html,
+        **get_cleaner_config(),
+        document_limits=document_limits,
+        limit_decisions=limit_decisions,
+        cache=cache,
+        subtree_cache=subtree_cache,
+        vocabulary=vocabulary,
+        track_byte_offsets=track_byte_offsets,
+        engine=engine,
+        stats=stats,
+        attribute_sketches=attribute_sketches,
+    )
+    skip_decisions = [decision for decision in limit_decisions if decision.policy == "skip"]
+    if binary:
+        example = (plain_text, metadata)
+        if skip_decisions:
+            raise pipeline.DocumentSkipped(f"Over the {skip_decisions[0].limit} limit", example)
+        return example
+    extra_fields = {}
+    if document_limits is not None:
+        extra_fields["limit_decisions"] = [dataclasses.asdict(decision) for decision in limit_decisions]
+    if encoder is not None:
+        json_example = encoder.encode(plain_text, metadata, extra_fields=extra_fields)
+    else:
+        json_example = {
+            "text": plain_text,
+            "metadata": [
+                convert_html_metadata_dataclass_to_dict(node) for node in metadata
+            ],
+            **extra_fields,
+        }
+    example = {"examples": json_example, "stats": dataclasses.asdict(stats)} if collect_stats else json_example
+    if skip_decisions:
+        raise pipeline.DocumentSkipped(f"Over the {skip_decisions[0].limit} limit", example)
+    return example
+
+
+def process_file(
+    file_name,
+    split="train",
+    document_limits=None,
+    doc_timeout=None,
+    cache_path=None,
+    cache_max_bytes=10 * 2 ** 30,
+    dedup=None,
+    subtree_cache_max_chars=None,
+    intern_attr_values=False,
+    track_byte_offsets=False,
+    output_format="jsonl.gz",
+    num_threads=None,
+    num_processes=None,
+    transport="shared_memory",
+    part_idx=None,
+    num_shard_parts=1,
+    engine="tree",
+    collect_stats=False,
+    attribute_sketches_precision=None,
+    max_shard_bytes=None,
+    max_shard_records=None,
+    num_writers=4,
+    io_queue_size=None,
+    metrics_format=None,
+    metrics_interval=30.0,
+):
+    if output_format == "binary" and collect_stats:
+        raise ValueError("The statistics of the documents can't be written with the binary output")
+    if intern_attr_values and output_format != "binary":
+        # Only the binary output writes the IDs of the vocabulary
+        raise ValueError("The attribute values can only be interned for the binary output")
+    if attribute_sketches_precision is not None and (doc_timeout is not None or num_processes is not None):
+        # The sketches would be filled in the worker processes
+        raise ValueError("The attribute sketches can't be collected with a `doc_timeout` or a pool of processes")
     file_path = os.path.join(data_dir, split, file_name)
     target_dir = os.path.join(data_dir, "SaulLu/Natural_Questions_HTML_Toy_V2")
     print(f"Results will be saved into {target_dir}")
 
     target_path = os.path.join(target_dir, file_name)
+    line_range = None
+    if num_shard_parts > 1:
+        # Each part of the shard is processed by its own job, starting at a checkpoint of the shard index
+        line_range = GzipIndex.load(file_path).split(num_shard_parts)[part_idx]
+        file_stem, file_extension = file_name.split(".", 1)
+        target_path = os.path.join(
+            target_dir, f"{file_stem}-part-{part_idx:03d}-of-{num_shard_parts:03d}.{file_extension}"
+        )
+    if output_format == "binary" and target_path.endswith(".jsonl.gz"):
+        target_path = target_path[: -len(".jsonl.gz")] + ".bin.gz"
+    elif output_format != "jsonl.gz" and target_path.endswith(".gz"):
+        target_path = target_path[: -len(".gz")]
 
     if not os.path.exists(target_dir):
         os.makedirs(target_dir)
+    target_stem, target_extension = os.path.basename(target_path).split(".", 1)
+    metrics_path = None
+    if metrics_format is not None:
+        metrics_extension = "jsonl" if metrics_format == "jsonl" else "prom"
+        metrics_path = os.path.join(target_dir, f"{target_stem}.metrics.{metrics_extension}")
+    if collect_stats:
+        # The statistics of the documents are written next to the output, one line by document
+        target_path = {
+            "examples": target_path,
+            "stats": os.path.join(target_dir, f"{target_stem}.stats.{target_extension}"),
+        }
 
-    with gzip.GzipFile(file_path, "rb") as fi_init:
-        with gzip.open(target_path, "w") as fi_target:
-            writer = jsonlines.Writer(fi_target)
-            for compt, line in tqdm(enumerate(fi_init)):
-                json_example = json.loads(line)
-                doc_html = json_example["document_html"]
-                json_example = process_example(doc_html)
-                writer.write(json_example)
-    print(f"End process {file_name}")
+    cache = ResultCache(cache_path, max_bytes=cache_max_bytes) if cache_path is not None else None
+    subtree_cache = SubtreeCache(max_chars=subtree_cache_max_chars) if subtree_cache_max_chars is not None else None
+    attribute_sketches = (
+        AttributeSketches(precision=attribute_sketches_precision) if attribute_sketches_precision is not None else None
+    )
+    # Interning table of the documents of the shard, the binary output writes its IDs
+    vocabulary = StringVocabulary(intern_attr_values=intern_attr_values)
+    pipeline.process_file(
+        file_path,
+        target_path,
+        functools.partial(
+            process_example,
+            document_limits=document_limits,
+            cache=cache,
+            subtree_cache=subtree_cache,
+            encoder=MetadataJsonEncoder(schema="flat"),
+            track_byte_offsets=track_byte_offsets,
+            engine=engine,
+            collect_stats=collect_stats,
+            attribute_sketches=attribute_sketches,
+            binary=output_format == "binary",
+            vocabulary=vocabulary,
+        ),
+        doc_timeout=doc_timeout,
+        dedup=dedup,
+        output_format=output_format,
+        num_threads=num_threads,
+        num_processes=num_processes,
+        transport=transport,
+        line_range=line_range,
+        max_shard_bytes=max_shard_bytes,
+        max_shard_records=max_shard_records,
+        num_writers=num_writers,
+        io_queue_size=io_queue_size,
+        metrics_path=metrics_path,
+        metrics_format=metrics_format if metrics_format is not None else "jsonl",
+        metrics_interval=metrics_interval,
+        vocabulary=vocabulary,
+    )
+    if cache is not None:
+        print(f"Cache statistics for {file_name}: {cache.stats()}")
+    if subtree_cache is not None and doc_timeout is None:
+        # With `doc_timeout`, the sub-tree cache lives in the worker process
+        print(f"Sub-tree cache statistics for {file_name}: {subtree_cache.stats()}")
+    if attribute_sketches is not None:
+        # The sketches of the shards are merged with `AttributeSketches.update`
+        attribute_sketches.save(os.path.join(target_dir, f"{target_stem}.attribute_sketches.npz"))
+        print(f"{len(attribute_sketches)} (tag, attribute) pairs sketched for {file_name}")
 
 
 if __name__ == "__main__":
@@ -130,22 +286,95 @@ if __name__ == "__main__":
     parser.set_defaults(data_dir=os.path.join("data", "v1.0"))
     parser.add_argument("--num_cores", dest="num_cores")
     parser.set_defaults(num_cores=8)
+    parser.add_argument("--max_input_bytes", dest="max_input_bytes", type=float, default=float("inf"))
+    parser.add_argument("--max_elements", dest="max_elements", type=float, default=float("inf"))
+    parser.add_argument("--max_depth", dest="max_depth", type=float, default=float("inf"))
+    parser.add_argument("--max_metadata", dest="max_metadata", type=float, default=float("inf"))
+    parser.add_argument("--doc_timeout", dest="doc_timeout", type=float, default=None)
+    parser.add_argument("--cache_path", dest="cache_path", default=None)
+    parser.add_argument("--cache_max_bytes", dest="cache_max_bytes", type=float, default=10 * 2 ** 30)
+    parser.add_argument("--dedup", dest="dedup", choices=["copy", "reference"], default=None)
+    parser.add_argument("--subtree_cache_max_chars", dest="subtree_cache_max_chars", type=int, default=None)
+    # Also intern the short attribute values, written as IDs by the binary output
+    parser.add_argument("--intern_attr_values", dest="intern_attr_values", action="store_true")
+    parser.add_argument("--track_byte_offsets", dest="track_byte_offsets", action="store_true")
+    parser.add_argument(
+        "--output_format", dest="output_format", choices=pipeline.OUTPUT_FORMATS, default="jsonl.gz"
+    )
+    # Number of threads processing the documents of each shard, mostly useful with a free-threaded interpreter
+    parser.add_argument("--num_threads", dest="num_threads", type=int, default=None)
+    # Number of processes processing the documents of each shard, the documents and the outputs are not pickled with
+    # the "shared_memory" transport
+    parser.add_argument("--num_processes", dest="num_processes", type=int, default=None)
+    parser.add_argument("--transport", dest="transport", choices=pipeline.TRANSPORTS, default="shared_memory")
+    # Number of jobs processing each shard, the shards are indexed first so that each job starts at its part
+    parser.add_argument("--num_shard_parts", dest="num_shard_parts", type=int, default=1)
+    # The "events" engine extracts the documents without building a tree when the config allows it
+    parser.add_argument("--engine", dest="engine", choices=ENGINES, default="tree")
+    # Write the structural statistics of each document (see `DocumentStats`) in a file next to each output shard
+    parser.add_argument("--collect_stats", dest="collect_stats", action="store_true")
+    # Save the approximate number of distinct values of each (tag, attribute) pair of each output shard, with sketches
+    # of `2 ** attribute_sketches_precision` bytes (see `AttributeSketches`)
+    parser.add_argument("--attribute_sketches_precision", dest="attribute_sketches_precision", type=int, default=None)
+    # Split each output in gzip JSONL shards of bounded size (uncompressed bytes or records) listed by a manifest, the
+    # shards are compressed by `num_writers` threads
+    parser.add_argument("--max_shard_bytes", dest="max_shard_bytes", type=int, default=None)
+    parser.add_argument("--max_shard_records", dest="max_shard_records", type=int, default=None)
+    parser.add_argument("--num_writers", dest="num_writers", type=int, default=4)
+    # Read and write each shard in their own threads, through queues of `io_queue_size` documents
+    parser.add_argument("--io_queue_size", dest="io_queue_size", type=int, default=None)
+    # Write the throughput and the latencies of each output shard every `metrics_interval` seconds next to it, the
+    # files in JSON lines are summarized by `parse_scripts/metrics.py`
+    parser.add_argument("--metrics_format", dest="metrics_format", choices=METRICS_FORMATS, default=None)
+    parser.add_argument("--metrics_interval", dest="metrics_interval", type=float, default=30.0)
 
     args = parser.parse_args()
 
     NUM_CORES = int(args.num_cores)
     data_dir = args.data_dir
 
-    split = "train"
-    list_dir = os.listdir(os.path.join(data_dir, split))
-    list_dir = [f.lower() for f in list_dir]
-    results = Parallel(n_jobs=NUM_CORES)(
-        delayed(process_file)(file_name, split) for file_name in sorted(list_dir)
+    document_limits = DocumentLimits(
+        max_input_bytes=args.max_input_bytes,
+        max_elements=args.max_elements,
+        max_depth=args.max_depth,
+        max_metadata=args.max_metadata,
     )
+    if document_limits == DocumentLimits():
+        document_limits = None
 
-    split = "dev"
-    list_dir = os.listdir(os.path.join(data_dir, split))
-    list_dir = [f.lower() for f in list_dir]
-    results = Parallel(n_jobs=NUM_CORES)(
-        delayed(process_file)(file_name, split) for file_name in sorted(list_dir)
+    process_file_kwargs = dict(
+        document_limits=document_limits,
+        doc_timeout=args.doc_timeout,
+        cache_path=args.cache_path,
+        cache_max_bytes=args.cache_max_bytes,
+        dedup=args.dedup,
+        subtree_cache_max_chars=args.subtree_cache_max_chars,
+        intern_attr_values=args.intern_attr_values,
+        track_byte_offsets=args.track_byte_offsets,
+        output_format=args.output_format,
+        num_threads=args.num_threads,
+        num_processes=args.num_processes,
+        transport=args.transport,
+        num_shard_parts=args.num_shard_parts,
+        engine=args.engine,
+        collect_stats=args.collect_stats,
+        attribute_sketches_precision=args.attribute_sketches_precision,
+        max_shard_bytes=args.max_shard_bytes,
+        max_shard_records=args.max_shard_records,
+        num_writers=args.num_writers,
+        io_queue_size=args.io_queue_size,
+        metrics_format=args.metrics_format,
+        metrics_interval=args.metrics_interval,
     )
+    for split in ["train", "dev"]:
+        list_dir = os.listdir(os.path.join(data_dir, split))
+        list_dir = [f.lower() for f in list_dir if not f.endswith(GZIP_INDEX_SUFFIX)]
+        if args.num_shard_parts > 1:
+            Parallel(n_jobs=NUM_CORES)(
+                delayed(GzipIndex.load_or_build)(os.path.join(data_dir, split, file_name)) for file_name in list_dir
+            )
+        results = Parallel(n_jobs=NUM_CORES)(
+            delayed(process_file)(file_name, split=split, part_idx=part_idx, **process_file_kwargs)
+            for file_name in sorted(list_dir)
+            for part_idx in range(args.num_shard_parts)
+        )
@@ -0,0 +1,167 @@
+import argparse
+import dataclasses
+import functools
+import os
+import sys
+from typing import Optional
+
+from joblib import Parallel, delayed
+
+sys.path.append(".")  # It's not very nice, we need to create a module
+from html_parser import DocumentLimits, StringVocabulary, SubtreeCache, get_clean_text_and_metadata_for_profiles
+from metadata_encoder import MetadataJsonEncoder
+from parse_scripts import parse_natural_questions_Toy_keep_everything, parse_natural_questions_Toy_v2, pipeline
+
+# The documents are parsed and minified once for all the profiles
+PROFILES = {
+    "Toy_V2": parse_natural_questions_Toy_v2.get_cleaner_config,
+    "Toy_keep_everything": parse_natural_questions_Toy_keep_everything.get_cleaner_config,
+}
+
+def process_example(
+    doc_html,
+    profiles,
+    document_limits: Optional[DocumentLimits] = None,
+    subtree_cache: Optional[SubtreeCache] = None,
+    encoder: Optional[MetadataJsonEncoder] = None,
+    binary: bool = False,
+    vocabulary: Optional[StringVocabulary] = None,
+):
+    profile_configs = {profile: get_cleaner_config() for profile, get_cleaner_config in profiles.items()}
+    if document_limits is not None:
+        for cleaner_config in profile_configs.values():
+            cleaner_config["document_limits"] = document_limits
+    limit_decisions = {}
+    results = get_clean_text_and_metadata_for_profiles(
+        doc_html,
+        profile_configs,
+        limit_decisions=limit_decisions,
+        subtree_cache=subtree_cache,
+        vocabulary=vocabulary,
+    )
+    json_examples = {}
+    for profile, (plain_text, metadata) in results.items():
+        if binary:
+            # Encoded by the pipeline
+            json_examples[profile] = (plain_text, metadata)
+            continue
+        extra_fields = {}
+        if document_limits is not None:
+            extra_fields["limit_decisions"] = [
+                dataclasses.asdict(decision) for decision in limit_decisions.get(profile, [])
+            ]
+        if encoder is not None:
+            json_examples[profile] = encoder.encode(plain_text, metadata, extra_fields=extra_fields)
+        else:
+            json_examples[profile] = {
+                "text": plain_text,
+                "metadata": [
+                    parse_natural_questions_Toy_v2.convert_html_metadata_dataclass_to_dict(node) for node in metadata
+                ],
+                **extra_fields,
+            }
+    return json_examples
+
+
+def process_file(
+    file_name,
+    data_dir_target,
+    split="train",
+    profile_names=None,
+    document_limits=None,
+    doc_timeout=None,
+    dedup=None,
+    subtree_cache_max_chars=None,
+    output_format="jsonl.gz",
+):
+    profiles = {profile: PROFILES[profile] for profile in (profile_names or PROFILES)}
+    file_path = os.path.join(data_dir, split, file_name)
+
+    target_paths = {}
+    for profile in profiles:
+        target_dir = os.path.join(data_dir_target, profile)
+        if not os.path.exists(target_dir):
+            os.makedirs(target_dir)
+        target_path = os.path.join(target_dir, file_name)
+        if output_format == "binary" and target_path.endswith(".jsonl.gz"):
+            target_path = target_path[: -len(".jsonl.gz")] + ".bin.gz"
+        elif output_format != "jsonl.gz" and target_path.endswith(".gz"):
+            target_path = target_path[: -len(".gz")]
+        target_paths[profile] = target_path
+    print(f"Results will be saved into {sorted(target_paths.values())}")
+
+    subtree_cache = SubtreeCache(max_chars=subtree_cache_max_chars) if subtree_cache_max_chars is not None else None
+    # Interning table of the documents of the shard, the binary output writes its IDs
+    vocabulary = StringVocabulary()
+    pipeline.process_file(
+        file_path,
+        target_paths,
+        functools.partial(
+            process_example,
+            profiles=profiles,
+            document_limits=document_limits,
+            subtree_cache=subtree_cache,
+            encoder=MetadataJsonEncoder(schema="flat"),
+            binary=output_format == "binary",
+            vocabulary=vocabulary,
+        ),
+        doc_timeout=doc_timeout,
+        dedup=dedup,
+        output_format=output_format,
+        vocabulary=vocabulary,
+    )
+    if subtree_cache is not None and doc_timeout is None:
+        print(f"Sub-tree cache statistics for {file_name}: {subtree_cache.stats()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--data_dir", dest="data_dir")
+    parser.set_defaults(data_dir=os.path.join("data", "v1.0"))
+    parser.add_argument("--data_dir_target", dest="data_dir_target", required=True)
+    parser.add_argument("--profiles", dest="profiles", nargs="+", choices=sorted(PROFILES), default=None)
+    parser.add_argument("--num_cores", dest="num_cores")
+    parser.set_defaults(num_cores=8)
+    parser.add_argument("--max_input_bytes", dest="max_input_bytes", type=float, default=float("inf"))
+    parser.add_argument("--max_elements", dest="max_elements", type=float, default=float("inf"))
+    parser.add_argument("--max_depth", dest="max_depth", type=float, default=float("inf"))
+    parser.add_argument("--max_metadata", dest="max_metadata", type=float, default=float("inf"))
+    parser.add_argument("--doc_timeout", dest="doc_timeout", type=float, default=None)
+    parser.add_argument("--dedup", dest="dedup", choices=["copy", "reference"], default=None)
+    parser.add_argument("--subtree_cache_max_chars", dest="subtree_cache_max_chars", type=int, default=None)
+    parser.add_argument(
+        "--output_format", dest="output_format", choices=pipeline.OUTPUT_FORMATS, default="jsonl.gz"
+    )
+
+    args = parser.parse_args()
+
+    NUM_CORES = int(args.num_cores)
+    data_dir = args.data_dir
+
+    document_limits = DocumentLimits(
+        max_input_bytes=args.max_input_bytes,
+        max_elements=args.max_elements,
+        max_depth=args.max_depth,
+        max_metadata=args.max_metadata,
+    )
+    if document_limits == DocumentLimits():
+        document_limits = None
+
+    for split in ["train", "dev"]:
+        list_dir = os.listdir(os.path.join(data_dir, split))
+        list_dir = [f.lower() for f in list_dir]
+        results = Parallel(n_jobs=NUM_CORES)(
+            delayed(process_file)(
+                file_name,
+                args.data_dir_target,
+                split,
+                args.profiles,
+                document_limits,
+                args.doc_timeout,
+                args.dedup,
+                args.subtree_cache_max_chars,
+                args.output_format,
+            )
+            for file_name in sorted(list_dir)
+        )
@@ -0,0 +1,714 @@
+import dataclasses
+import functools
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
+import queue
+import struct
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+
+from tqdm import tqdm
+
+from html_parser import get_clean_text_and_metadata
+from metadata_encoder import (
+    MetadataBinaryDecoder,
+    MetadataBinaryEncoder,
+    MetadataJsonEncoder,
+    iter_records,
+    write_record,
+)
+from parse_scripts.gzip_index import GzipIndex
+from parse_scripts.indexed_shard import IndexedShard, IndexedShardWriter, is_indexed_shard
+from parse_scripts.metrics import METRICS_FORMATS, PipelineMetrics
+from parse_scripts.shard_writer import ShardedWriter, is_manifest, read_manifest
+from parse_scripts.shared_memory_transport import (
+    TRANSPORTS,
+    DocumentTimeoutError,
+    DocumentWorkerCrashError,
+    WorkerPool,
+)
+
+EMPTY_EXAMPLE = {"text": "", "metadata": []}
+EMPTY_BINARY_EXAMPLE = ("", [])
+DEDUP_MODES = [None, "copy", "reference"]
+OUTPUT_FORMATS = ["jsonl.gz", "indexed", "indexed-zlib", "binary"]
+
+
+class DocumentSkipped(Exception):
+    """Raised by `process_example` for a document which it drops (over a limit of the cleaner for instance), `example`
+    is written in its place"""
+
+    def __init__(self, reason: str, example):
+        # Both arguments are given to `Exception` so that it can be pickled by the worker processes
+        super().__init__(reason, example)
+        self.reason = reason
+        self.example = example
+
+    def __str__(self):
+        return self.reason
+
+
+def _document_worker_loop(connection, function):
+    while True:
+        try:
+            args = connection.recv()
+        except EOFError:
+            break
+        if args is None:
+            break
+        try:
+            result = function(*args)
+        except Exception as error:
+            try:
+                connection.send(("error", error))
+            except Exception:
+                # The exception can't always be pickled
+                connection.send(("error", RuntimeError(repr(error))))
+        else:
+            connection.send(("ok", result))
+
+
+class DocumentWorker:
+    """Call `function` in a child process, one document at a time.
+
+    If a call takes more than `timeout` seconds, the child process is killed and replaced by a new one and
+    `DocumentTimeoutError` is raised, so that the caller can carry on with the next document.
+    """
+
+    def __init__(self, function, timeout: float):
+        self.function = function
+        self.timeout = timeout
+        self.num_restarts = 0
+        # "fork" avoids having to pickle `function`, which is often defined in a `__main__` module
+        start_method = "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+        self._context = multiprocessing.get_context(start_method)
+        self._start()
+
+    def _start(self):
+        self._connection, child_connection = self._context.Pipe()
+        self._process = self._context.Process(
+            target=_document_worker_loop,
+            args=(child_connection, self.function),
+            daemon=True,
+        )
+        self._process.start()
+        child_connection.close()
+
+    def restart(self):
+        self._process.kill()
+        self._process.join()
+        self._connection.close()
+        self.num_restarts += 1
+        self._start()
+
+    def __call__(self, *args):
+        self._connection.send(args)
+        if not self._connection.poll(self.timeout):
+            self.restart()
+            raise DocumentTimeoutError(f"The document was not processed within {self.timeout} seconds")
+        try:
+            status, result = self._connection.recv()
+        except EOFError:
+            self.restart()
+            raise DocumentWorkerCrashError(
+                f"The worker process died while processing the document (exit code {self._process.exitcode})"
+            )
+        if status == "error":
+            raise result
+        return result
+
+    def close(self):
+        if self._process.is_alive():
+            try:
+                self._connection.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            self._process.join(timeout=1)
+            if self._process.is_alive():
+                self._process.kill()
+                self._process.join()
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def encode_example(json_example) -> bytes:
+    # Same bytes as `jsonlines.Writer(fp).write(json_example)`, `process_example` can also return the encoded line
+    if isinstance(json_example, bytes):
+        return json_example
+    return json.dumps(json_example, ensure_ascii=False).encode("UTF-8") + b"\n"
+
+
+_JSON_ENCODER = MetadataJsonEncoder()
+
+
+def process_html_example(doc_html, document_limits=None, **cleaner_kwargs) -> bytes:
+    """`process_example` which cleans a document with `get_clean_text_and_metadata` and writes its metadata with the
+    "dataclass" schema. With `document_limits`, the example also has the decisions taken on the limits
+    ("limit_decisions", empty when the document is within them), and a document skipped by a limit raises
+    `DocumentSkipped`."""
+    limit_decisions = []
+    plain_text, metadata = get_clean_text_and_metadata(
+        doc_html, document_limits=document_limits, limit_decisions=limit_decisions, **cleaner_kwargs
+    )
+    extra_fields = {}
+    if document_limits is not None:
+        extra_fields["limit_decisions"] = [dataclasses.asdict(decision) for decision in limit_decisions]
+    example = _JSON_ENCODER.encode(plain_text, metadata, extra_fields=extra_fields)
+    skip_decisions = [decision for decision in limit_decisions if decision.policy == "skip"]
+    if skip_decisions:
+        raise DocumentSkipped(f"Over the {skip_decisions[0].limit} limit", example)
+    return example
+
+
+def fingerprint_document(doc_html) -> bytes:
+    return hashlib.blake2b(doc_html.encode("UTF-8", errors="surrogatepass"), digest_size=16).digest()
+
+
+def _iter_documents(lines, first_byte_offset=0):
+    """Yield the line number, the byte offset and the `document_html` of each example of a shard"""
+    next_byte_offset = first_byte_offset
+    for compt, line in enumerate(lines):
+        byte_offset = next_byte_offset
+        next_byte_offset += len(line)
+        yield compt, byte_offset, json.loads(line)["document_html"], None
+
+
+def _process_ahead(documents, submit, max_pending, dedup=None):
+    """Submit ahead the documents to a pool (`submit(doc_html)` returns a future), the futures are yielded in order.
+
+    With `dedup`, only the first occurrence of each document is submitted, the others are left to `process_file`.
+    """
+    seen_fingerprints = set()
+    pending = deque()
+    for compt, byte_offset, doc_html, _ in documents:
+        future = None
+        if dedup is None:
+            future = submit(doc_html)
+        else:
+            fingerprint = fingerprint_document(doc_html)
+            if fingerprint not in seen_fingerprints:
+                seen_fingerprints.add(fingerprint)
+                future = submit(doc_html)
+        pending.append((compt, byte_offset, doc_html, future))
+        if len(pending) >= max_pending:
+            yield pending.popleft()
+    while pending:
+        yield pending.popleft()
+
+
+class MeasuredQueue:
+    """Bounded queue between two stages of `process_file`, the producer blocks while it's full.
+
+    It records its depth after each `put` and the time spent by the producer waiting for a free slot (`put_wait_s`)
+    and by the consumer waiting for an item (`get_wait_s`), each side being a single thread.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._queue = queue.Queue(maxsize)
+        self.num_items = 0
+        self.total_depth = 0
+        self.max_depth = 0
+        self.put_wait_time = 0.0
+        self.get_wait_time = 0.0
+
+    def put(self, item, stop_event: threading.Event = None) -> bool:
+        """Returns False if `stop_event` is set before the item could be put"""
+        start = time.perf_counter()
+        while True:
+            try:
+                self._queue.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                if stop_event is not None and stop_event.is_set():
+                    return False
+        self.put_wait_time += time.perf_counter() - start
+        depth = self._queue.qsize()
+        self.num_items += 1
+        self.total_depth += depth
+        self.max_depth = max(self.max_depth, depth)
+        return True
+
+    def get(self):
+        start = time.perf_counter()
+        item = self._queue.get()
+        self.get_wait_time += time.perf_counter() - start
+        return item
+
+    def stats(self):
+        return {
+            "num_items": self.num_items,
+            "maxsize": self.maxsize,
+            "mean_depth": self.total_depth / self.num_items if self.num_items else 0.0,
+            "max_depth": self.max_depth,
+            "put_wait_s": round(self.put_wait_time, 3),
+            "get_wait_s": round(self.get_wait_time, 3),
+        }
+
+
+_END_OF_QUEUE = object()
+
+
+class _ReaderError:
+    def __init__(self, error):
+        self.error = error
+
+
+class QueuedReader:
+    """Iterate over `documents` (see `_iter_documents`) in a thread, so that the decompression and the decoding of the
+    lines overlap the processing. At most `queue_size` documents are read ahead."""
+
+    def __init__(self, documents, queue_size: int):
+        self.queue = MeasuredQueue(queue_size)
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(documents,), daemon=True)
+        self._thread.start()
+
+    def _run(self, documents):
+        try:
+            for document in documents:
+                if not self.queue.put(document, self._stop_event):
+                    return
+        except Exception as error:
+            self.queue.put(_ReaderError(error), self._stop_event)
+            return
+        self.queue.put(_END_OF_QUEUE, self._stop_event)
+
+    def __iter__(self):
+        while True:
+            document = self.queue.get()
+            if document is _END_OF_QUEUE:
+                return
+            if isinstance(document, _ReaderError):
+                raise document.error
+            yield document
+
+    def close(self):
+        # The reader can be blocked on a full queue if the documents are not all consumed
+        self._stop_event.set()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class QueuedWriter:
+    """Write the encoded lines to `fi_target` in a thread, so that the compression and the writes overlap the
+    processing. At most `queue_size` lines are waiting, an error of the writer is raised by the next `write`."""
+
+    def __init__(self, fi_target, queue_size: int):
+        self.fi_target = fi_target
+        self.queue = MeasuredQueue(queue_size)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is _END_OF_QUEUE:
+                return
+            # The queue is still emptied after an error, so that `write` never blocks
+            if self._error is None:
+                try:
+                    self.fi_target.write(record)
+                except Exception as error:
+                    self._error = error
+
+    def write(self, record: bytes):
+        if self._error is not None:
+            raise self._error
+        self.queue.put(record)
+
+    def close(self):
+        if self._thread.is_alive():
+            self.queue.put(_END_OF_QUEUE)
+            self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _encode_binary_example(encoder: MetadataBinaryEncoder, example) -> bytes:
+    plain_text, metadata = example
+    return encoder.encode(plain_text, metadata)
+
+
+# Time spent in `process_example`, in front of the output of a worker process
+_PROCESS_TIME = struct.Struct("<d")
+
+
+def _timed_call(function, *args):
+    """Result of the call and the time it took, measured in the thread which runs it"""
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def _process_encoded_document(process_example, multi_profile, doc_html_bytes: bytes) -> bytes:
+    """Worker side of the process pool: the document and the encoded output lines (one by profile) are bytes, the
+    output starts with the processing time (`_PROCESS_TIME`)"""
+    json_example, process_time = _timed_call(process_example, doc_html_bytes.decode("UTF-8", errors="surrogatepass"))
+    if multi_profile:
+        encoded_example = b"".join(encode_example(json_example[profile]) for profile in sorted(json_example))
+    else:
+        encoded_example = encode_example(json_example)
+    return _PROCESS_TIME.pack(process_time) + encoded_example
+
+
+class BinaryRecordWriter:
+    """Write length-prefixed binary records (see `metadata_encoder.write_record`) in a gzip file"""
+
+    def __init__(self, target_path):
+        self._fp = gzip.open(target_path, "wb")
+
+    def write(self, record: bytes):
+        write_record(self._fp, record)
+
+    def close(self):
+        self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def open_target(target_path, output_format="jsonl.gz", max_shard_bytes=None, max_shard_records=None, num_writers=4):
+    if max_shard_bytes is not None or max_shard_records is not None:
+        if output_format != "jsonl.gz":
+            raise ValueError("Only the jsonl.gz output can be split in shards of bounded size")
+        return ShardedWriter(
+            target_path, max_shard_bytes=max_shard_bytes, max_shard_records=max_shard_records, num_writers=num_writers
+        )
+    if output_format == "jsonl.gz":
+        return gzip.open(target_path, "w")
+    if output_format == "binary":
+        return BinaryRecordWriter(target_path)
+    return IndexedShardWriter(target_path, compression="zlib" if output_format == "indexed-zlib" else None)
+
+
+def process_file(
+    file_path,
+    target_path,
+    process_example,
+    doc_timeout=None,
+    dedup=None,
+    dedup_max_bytes=2 ** 30,
+    output_format="jsonl.gz",
+    num_threads=None,
+    num_processes=None,
+    transport="shared_memory",
+    line_range=None,
+    max_shard_bytes=None,
+    max_shard_records=None,
+    num_writers=4,
+    io_queue_size=None,
+    metrics_path=None,
+    metrics_format="jsonl",
+    metrics_interval=30.0,
+    vocabulary=None,
+):
+    """Apply `process_example` (for instance `process_html_example`) to the `document_html` of each example of a Natural
+    Questions shard.
+
+    If `doc_timeout` is set, each document is processed in a worker process with a budget of `doc_timeout` seconds,
+    by a `DocumentWorker` or by the workers of the pool of processes (see `WorkerPool`). The worker of a document over
+    budget is killed and replaced, the document is logged with its shard and line offset and an empty example is
+    written in its place, so that the output lines stay aligned with the input lines. The threads of `num_threads`
+    can't be stopped, so they can't be given a budget.
+
+    If `dedup` is set, each distinct `document_html` of the shard is processed only once. With `dedup="reference"`,
+    the next occurrences are written as `{"duplicate_of": <line of the first occurrence>}` (see `read_examples`). With
+    `dedup="copy"`, the output of the first occurrence is written again, it is kept in memory within the limit of
+    `dedup_max_bytes` (least recently used outputs are forgotten and the document is processed again).
+
+    With `output_format="indexed"` (or "indexed-zlib"), the output is written as an `IndexedShard` (uncompressed or
+    block-compressed data file plus an offset index) instead of a gzip JSONL file. With `output_format="binary"`,
+    `process_example` must return `(plain_text, metadata)` and the output is a gzip file of the records of a
+    `MetadataBinaryEncoder` (see `read_binary_examples`). Each record only holds the strings which are new to the
+    vocabulary, so they are encoded in order in the main process and the documents can't be deduplicated. The encoders
+    use `vocabulary` if it is given, for instance the `StringVocabulary` which interned the strings of the documents.
+
+    If `target_path` is a dictionary `{profile: path}`, `process_example` must return a dictionary `{profile: example}`
+    (see `get_clean_text_and_metadata_for_profiles`) and each profile is written in its own output file.
+
+    If `num_threads` is set, the documents are processed ahead by a pool of threads instead of one by one, the output
+    is the same. `process_example` must then be thread-safe (see `html_parser.HtmlExtractor`).
+
+    If `num_processes` is set, the documents are processed ahead by a pool of processes. With
+    `transport="shared_memory"`, the documents and the encoded outputs go through shared memory ring buffers instead
+    of being pickled (`transport="pipe"`), the time spent to move them is part of the returned statistics.
+
+    If `line_range=(start_line, end_line)` is set, only these lines of the shard are processed. The shard is read with
+    its `GzipIndex` (built if missing), which starts the decompression at the closest checkpoint, so that several
+    workers can process the parts of a shard in parallel.
+
+    If `max_shard_bytes` or `max_shard_records` is set, the output is split in gzip JSONL shards of bounded size,
+    compressed by `num_writers` threads, and described by a manifest (see `shard_writer.ShardedWriter`).
+
+    If `io_queue_size` is set, the shard is decompressed and decoded by a reader thread and the outputs are compressed
+    and written by a writer thread by output file, through queues of `io_queue_size` items which bound the memory. The
+    returned statistics give the depth of each queue and the time waited on each side: a reader queue which is often
+    empty (`get_wait_s`) points to the reading, a writer queue which is often full (`put_wait_s`) to the writing, and
+    a full reader queue with an empty writer queue to the processing of the documents.
+
+    `process_example` can raise `DocumentSkipped` for a document it drops, its example is written and the document is
+    counted as skipped. The throughput, the skipped documents and the latencies of each stage are measured (see
+    `metrics.PipelineMetrics`) and their summary is printed at the end. With `metrics_path`, they are also written
+    every `metrics_interval` seconds in the `metrics_format` format.
+    """
+    if dedup not in DEDUP_MODES:
+        raise ValueError(f"You have requested an invalid deduplication mode ({dedup}). Valid modes are {DEDUP_MODES}.")
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(
+            f"You have requested an invalid output format ({output_format}). Valid formats are {OUTPUT_FORMATS}."
+        )
+    if transport not in TRANSPORTS:
+        raise ValueError(f"You have requested an invalid transport ({transport}). Valid transports are {TRANSPORTS}.")
+    if num_threads is not None and doc_timeout is not None:
+        raise ValueError("The documents can't be processed by a pool of threads with a `doc_timeout`, use processes")
+    if num_threads is not None and num_processes is not None:
+        raise ValueError("The documents can be processed either by a pool of threads or by a pool of processes")
+    if metrics_format not in METRICS_FORMATS:
+        raise ValueError(
+            f"You have requested an invalid metrics format ({metrics_format}). Valid formats are {METRICS_FORMATS}."
+        )
+    if output_format == "binary" and (dedup is not None or num_processes is not None):
+        raise ValueError("The binary output can't be deduplicated nor encoded by a pool of processes")
+    if (max_shard_bytes is not None or max_shard_records is not None) and dedup == "reference":
+        # Each output shard must be readable on its own
+        raise ValueError("The duplicates can't reference lines of other output shards, use `dedup='copy'`")
+
+    multi_profile = isinstance(target_path, dict)
+    target_paths = target_path if multi_profile else {None: target_path}
+    if output_format == "binary":
+        # One encoder by output file, each of them writes all the strings of the vocabulary
+        encode_functions = {
+            profile: functools.partial(_encode_binary_example, MetadataBinaryEncoder(vocabulary))
+            for profile in target_paths
+        }
+        empty_example = EMPTY_BINARY_EXAMPLE
+    else:
+        encode_functions = {profile: encode_example for profile in target_paths}
+        empty_example = EMPTY_EXAMPLE
+
+    print(f"Start process {file_path}")
+    worker = None
+    if doc_timeout is not None and num_processes is None:
+        worker = DocumentWorker(process_example, timeout=doc_timeout)
+    canonical_lines = {}
+    copied_outputs = OrderedDict()
+    copied_outputs_size = 0
+    num_documents = 0
+    num_duplicates = 0
+    pool = None
+    reader = None
+    writers = {}
+    first_line = 0
+    shard = os.path.basename(file_path) if line_range is None else f"{os.path.basename(file_path)}:{line_range[0]}"
+    metrics = PipelineMetrics(shard, metrics_path, metrics_format, interval=metrics_interval)
+    try:
+        with ExitStack() as stack:
+            if line_range is None:
+                documents = _iter_documents(stack.enter_context(gzip.GzipFile(file_path, "rb")))
+            else:
+                first_line, end_line = line_range
+                gzip_index = GzipIndex.load_or_build(file_path)
+                documents = _iter_documents(
+                    gzip_index.iter_lines(first_line, end_line), int(gzip_index.line_offsets[first_line])
+                )
+            documents = metrics.iter_timed(documents)
+            fi_targets = {
+                profile: stack.enter_context(
+                    open_target(profile_target_path, output_format, max_shard_bytes, max_shard_records, num_writers)
+                )
+                for profile, profile_target_path in target_paths.items()
+            }
+            if io_queue_size is not None:
+                reader = stack.enter_context(QueuedReader(documents, io_queue_size))
+                documents = iter(reader)
+                writers = {
+                    profile: stack.enter_context(QueuedWriter(fi_target, io_queue_size))
+                    for profile, fi_target in fi_targets.items()
+                }
+                fi_targets = writers
+            if num_threads is not None:
+                executor = stack.enter_context(ThreadPoolExecutor(max_workers=num_threads))
+                documents = _process_ahead(
+                    documents,
+                    functools.partial(executor.submit, _timed_call, process_example),
+                    4 * num_threads,
+                    dedup=dedup,
+                )
+            if num_processes is not None:
+                pool = stack.enter_context(
+                    WorkerPool(
+                        functools.partial(_process_encoded_document, process_example, multi_profile),
+                        num_workers=num_processes,
+                        transport=transport,
+                        timeout=doc_timeout,
+                    )
+                )
+                documents = _process_ahead(
+                    documents,
+                    lambda doc_html: pool.submit(doc_html.encode("UTF-8", errors="surrogatepass")),
+                    4 * num_processes,
+                    dedup=dedup,
+                )
+            for compt, byte_offset, doc_html, future in tqdm(documents):
+                num_documents += 1
+
+                if dedup is not None:
+                    fingerprint = fingerprint_document(doc_html)
+                    canonical_line = canonical_lines.get(fingerprint)
+                    if canonical_line is not None and dedup == "reference":
+                        for fi_target in fi_targets.values():
+                            fi_target.write(encode_example({"duplicate_of": canonical_line}))
+                        num_duplicates += 1
+                        metrics.inc("duplicates")
+                        metrics.document_done(compt)
+                        continue
+                    if canonical_line is not None and fingerprint in copied_outputs:
+                        copied_outputs.move_to_end(fingerprint)
+                        for profile, fi_target in fi_targets.items():
+                            fi_target.write(copied_outputs[fingerprint][profile])
+                        num_duplicates += 1
+                        metrics.inc("duplicates")
+                        metrics.document_done(compt)
+                        continue
+
+                wait_start = time.perf_counter()
+                try:
+                    if future is not None and pool is not None:
+                        encoded_example = future.result()
+                        (process_time,) = _PROCESS_TIME.unpack_from(encoded_example)
+                        json_example = encoded_example[_PROCESS_TIME.size :]
+                        if multi_profile:
+                            # One encoded line by profile, in the order of the profile names
+                            lines = [line + b"\n" for line in json_example.split(b"\n")[:-1]]
+                            json_example = dict(zip(sorted(fi_targets), lines))
+                    elif future is not None:
+                        json_example, process_time = future.result()
+                    elif worker is None:
+                        json_example, process_time = _timed_call(process_example, doc_html)
+                    else:
+                        json_example, process_time = _timed_call(worker, doc_html)
+                    metrics.observe("process", process_time)
+                except (DocumentTimeoutError, DocumentWorkerCrashError, DocumentSkipped) as error:
+                    print(f"Skip {file_path} line {first_line + compt} (byte offset {byte_offset}): {error}")
+                    metrics.inc("skipped_documents")
+                    if isinstance(error, DocumentSkipped):
+                        metrics.inc("rejected_documents")
+                        json_example = error.example
+                    else:
+                        metrics.inc("timeouts" if isinstance(error, DocumentTimeoutError) else "worker_crashes")
+                        json_example = (
+                            {profile: empty_example for profile in fi_targets} if multi_profile else empty_example
+                        )
+                write_start = time.perf_counter()
+                metrics.observe("wait", write_start - wait_start)
+                json_examples = json_example if multi_profile else {None: json_example}
+                encoded_examples = {
+                    profile: encode_functions[profile](json_examples[profile]) for profile in fi_targets
+                }
+                for profile, fi_target in fi_targets.items():
+                    fi_target.write(encoded_examples[profile])
+                metrics.observe("write", time.perf_counter() - write_start)
+
+                if dedup is not None:
+                    canonical_lines.setdefault(fingerprint, compt)
+                encoded_size = sum(len(encoded_example) for encoded_example in encoded_examples.values())
+                metrics.inc("output_bytes", encoded_size)
+                metrics.document_done(compt)
+                if dedup == "copy" and encoded_size <= dedup_max_bytes:
+                    copied_outputs[fingerprint] = encoded_examples
+                    copied_outputs_size += encoded_size
+                    while copied_outputs_size > dedup_max_bytes:
+                        _, forgotten_outputs = copied_outputs.popitem(last=False)
+                        copied_outputs_size -= sum(len(output) for output in forgotten_outputs.values())
+    except Exception:
+        metrics.inc("fatal_errors")
+        raise
+    finally:
+        if worker is not None:
+            worker.close()
+        metrics.close()
+
+    if dedup is not None:
+        dedup_ratio = num_duplicates / num_documents if num_documents else 0.0
+        print(f"Deduplication of {file_path}: {num_duplicates}/{num_documents} duplicates ({dedup_ratio:.1%})")
+    stats = {"num_documents": num_documents, "num_duplicates": num_duplicates}
+    if pool is not None:
+        stats["transport"] = pool.stats()
+        print(f"Transport of {file_path}: {stats['transport']}")
+    if reader is not None:
+        stats["queues"] = {"reader": reader.queue.stats()}
+        for profile, writer in writers.items():
+            stats["queues"]["writer" if profile is None else f"writer {profile}"] = writer.queue.stats()
+        print(f"Queues of {file_path}: {stats['queues']}")
+    print(f"End process {file_path}")
+    return stats
+
+
+def read_binary_examples(target_path):
+    """Iterate over the `(plain_text, metadata)` of a shard processed with `output_format="binary"`"""
+    decoder = MetadataBinaryDecoder()
+    with gzip.open(target_path, "rb") as fi:
+        for record in iter_records(fi):
+            yield decoder.decode(record)
+
+
+def read_examples(target_path):
+    """Iterate over the examples of a processed shard, resolving the references written with `dedup="reference"`.
+
+    The duplicates are the same objects as their first occurrence. Indexed shards are read with `IndexedShard`, and
+    the shards listed by a manifest of `ShardedWriter` are read in order.
+    """
+    if is_manifest(target_path):
+        for shard in read_manifest(target_path):
+            yield from read_examples(shard["path"])
+        return
+    if is_indexed_shard(target_path):
+        shard = IndexedShard(target_path)
+        try:
+            yield from shard
+        finally:
+            shard.close()
+        return
+
+    referenced_lines = set()
+    with gzip.open(target_path) as fi:
+        for line in fi:
+            if line.startswith(b'{"duplicate_of": '):
+                referenced_lines.add(json.loads(line)["duplicate_of"])
+
+    canonical_examples = {}
+    with gzip.open(target_path) as fi:
+        for idx, line in enumerate(fi):
+            json_example = json.loads(line)
+            if "duplicate_of" in json_example:
+                json_example = canonical_examples[json_example["duplicate_of"]]
+            elif idx in referenced_lines:
+                canonical_examples[idx] = json_example
+            yield json_example
@@ -0,0 +1,96 @@
+"""Re-apply metadata filters to a processed shard without parsing the documents again.
+
+The shard must have been processed without metadata filters (no `tags_to_remove_alone`, no `txt_*_chr_len_alone`,
+all the attributes and no metadata limit), as `parse_natural_questions_Toy_v2.py` does by default. The first run
+converts it into a columnar `StagedShard` (`<shard>.staged.npz`) which is reused by the next runs.
+
+Usage: python parse_scripts/refilter_shard.py --staged_path <shard> --target_path <filtered shard>
+    --tags_to_remove_alone span:64 li --txt_max_chr_len_alone 0 --attrs_to_keep class id
+"""
+import argparse
+import dataclasses
+import os
+import sys
+import time
+
+sys.path.append(".")  # It's not very nice, we need to create a module
+from html_parser import DocumentLimits, TagToRemove
+from metadata_encoder import MetadataBinaryEncoder, MetadataJsonEncoder
+from parse_scripts import pipeline
+from staged_metadata import StagedShard
+
+
+def parse_tag_to_remove(tag_to_remove_str):
+    """`tag`, `tag:max_length` or `tag:max_length:min_length`"""
+    tag, *lengths = tag_to_remove_str.split(":")
+    tag_to_remove = TagToRemove(tag)
+    if len(lengths) > 0:
+        tag_to_remove.content_max_char_length = float(lengths[0])
+    if len(lengths) > 1:
+        tag_to_remove.content_min_char_length = float(lengths[1])
+    return tag_to_remove
+
+
+def load_staged_shard(staged_path):
+    staged_shard_path = staged_path + ".staged.npz"
+    if os.path.exists(staged_shard_path):
+        return StagedShard.load(staged_shard_path)
+    staged_shard = StagedShard.from_json_examples(pipeline.read_examples(staged_path))
+    staged_shard.save(staged_shard_path)
+    return staged_shard
+
+
+def refilter_shard(staged_path, target_path, output_format="jsonl.gz", **filters):
+    start = time.time()
+    staged_shard = load_staged_shard(staged_path)
+    print(f"Loaded {len(staged_shard)} staged documents from {staged_path} in {time.time() - start:.1f}s")
+
+    start = time.time()
+    results = staged_shard.apply_filters(**filters)
+    encoder = MetadataJsonEncoder(schema="flat")
+    binary_encoder = MetadataBinaryEncoder()
+    with pipeline.open_target(target_path, output_format) as fi_target:
+        for plain_text, metadata, limit_decisions in results:
+            if output_format == "binary":
+                # The limit decisions are not part of the binary records
+                fi_target.write(binary_encoder.encode(plain_text, metadata))
+                continue
+            extra_fields = {}
+            if limit_decisions:
+                extra_fields["limit_decisions"] = [dataclasses.asdict(decision) for decision in limit_decisions]
+            fi_target.write(encoder.encode(plain_text, metadata, extra_fields=extra_fields))
+    print(f"Filtered {len(results)} documents into {target_path} in {time.time() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--staged_path", dest="staged_path", required=True)
+    parser.add_argument("--target_path", dest="target_path", required=True)
+    parser.add_argument("--output_format", dest="output_format", choices=pipeline.OUTPUT_FORMATS, default="jsonl.gz")
+    parser.add_argument("--tags_to_remove_alone", dest="tags_to_remove_alone", nargs="*", default=[])
+    parser.add_argument("--txt_max_chr_len_alone", dest="txt_max_chr_len_alone", type=float, default=-float("inf"))
+    parser.add_argument("--txt_min_chr_len_alone", dest="txt_min_chr_len_alone", type=float, default=-float("inf"))
+    parser.add_argument(
+        "--tags_exceptions_to_txt_max_min_chr_len_alone",
+        dest="tags_exceptions_to_txt_max_min_chr_len_alone",
+        nargs="*",
+        default=None,
+    )
+    parser.add_argument("--attrs_to_keep", dest="attrs_to_keep", nargs="*", default=None)
+    parser.add_argument("--max_metadata", dest="max_metadata", type=float, default=float("inf"))
+
+    args = parser.parse_args()
+
+    refilter_shard(
+        args.staged_path,
+        args.target_path,
+        output_format=args.output_format,
+        tags_to_remove_alone=[parse_tag_to_remove(tag) for tag in args.tags_to_remove_alone],
+        txt_max_chr_len_alone=args.txt_max_chr_len_alone,
+        txt_min_chr_len_alone=args.txt_min_chr_len_alone,
+        tags_exceptions_to_txt_max_min_chr_len_alone=args.tags_exceptions_to_txt_max_min_chr_len_alone,
+        attrs_to_keep=args.attrs_to_keep,
+        document_limits=DocumentLimits(max_metadata=args.max_metadata)
+        if args.max_metadata != float("inf")
+        else None,
+    )
@@ -0,0 +1,132 @@
+import gzip
+import hashlib
+import json
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+SHARD_SUFFIX = ".jsonl.gz"
+MANIFEST_SUFFIX = ".manifest.json"
+
+
+def _get_target_base(target_path):
+    if not target_path.endswith(SHARD_SUFFIX):
+        raise ValueError(f"The path of a sharded output must end with {SHARD_SUFFIX} ({target_path})")
+    return target_path[: -len(SHARD_SUFFIX)]
+
+
+def get_manifest_path(target_path):
+    return _get_target_base(target_path) + MANIFEST_SUFFIX
+
+
+def is_manifest(path):
+    return path.endswith(MANIFEST_SUFFIX)
+
+
+def _write_shard(shard_path, records, compression_level):
+    data = b"".join(records)
+    # Without the modification time in the header, the same records always give the same checksum
+    compressed_data = gzip.compress(data, compresslevel=compression_level, mtime=0)
+    with open(shard_path, "wb") as fo:
+        fo.write(compressed_data)
+    return {
+        "path": os.path.basename(shard_path),
+        "num_records": len(records),
+        "num_bytes": len(data),
+        "compressed_bytes": len(compressed_data),
+        "sha256": hashlib.sha256(compressed_data).hexdigest(),
+    }
+
+
+class ShardedWriter:
+    """Write the encoded lines of a processed shard in several gzip JSONL shards of bounded size, plus a manifest.
+
+    A new shard is started once the current one holds `max_shard_bytes` uncompressed bytes or `max_shard_records`
+    records. The full shards are compressed and written by `num_writers` threads, at most `num_writers` of them are
+    waiting in memory. With `target_path="<base>.jsonl.gz"`, the shards are written as `<base>-00000.jsonl.gz`, ...
+    and the manifest `<base>.manifest.json`, which lists the shards in order with their number of records, their sizes
+    and the SHA-256 of their file, is written when the writer is closed.
+    """
+
+    def __init__(self, target_path, max_shard_bytes=None, max_shard_records=None, num_writers=4, compression_level=6):
+        if max_shard_bytes is None and max_shard_records is None:
+            raise ValueError("A maximum number of bytes or of records by shard is required")
+        self.target_path = target_path
+        self._target_base = _get_target_base(target_path)
+        self.max_shard_bytes = max_shard_bytes
+        self.max_shard_records = max_shard_records
+        self.num_writers = num_writers
+        self.compression_level = compression_level
+        self._executor = ThreadPoolExecutor(max_workers=num_writers)
+        self._pending_shards = deque()
+        self.shards = []
+        self._records = []
+        self._num_bytes = 0
+        self._num_shards = 0
+        self._closed = False
+
+    def write(self, record: bytes):
+        self._records.append(record)
+        self._num_bytes += len(record)
+        if (self.max_shard_bytes is not None and self._num_bytes >= self.max_shard_bytes) or (
+            self.max_shard_records is not None and len(self._records) >= self.max_shard_records
+        ):
+            self._roll_over()
+
+    def _roll_over(self):
+        shard_path = f"{self._target_base}-{self._num_shards:05d}{SHARD_SUFFIX}"
+        self._pending_shards.append(
+            self._executor.submit(_write_shard, shard_path, self._records, self.compression_level)
+        )
+        self._num_shards += 1
+        self._records = []
+        self._num_bytes = 0
+        while len(self._pending_shards) > self.num_writers:
+            self.shards.append(self._pending_shards.popleft().result())
+
+    def close(self, write_manifest=True):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if self._records and write_manifest:
+                self._roll_over()
+            while self._pending_shards:
+                self.shards.append(self._pending_shards.popleft().result())
+        finally:
+            self._executor.shutdown(wait=True)
+        if not write_manifest:
+            return
+
+        first_record = 0
+        for shard in self.shards:
+            shard["first_record"] = first_record
+            first_record += shard["num_records"]
+        with open(get_manifest_path(self.target_path), "w") as fo:
+            json.dump({"num_records": first_record, "shards": self.shards}, fo, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # The manifest of an incomplete output is not written
+        self.close(write_manifest=exc_type is None)
+
+
+def read_manifest(manifest_path):
+    """Shards listed by a manifest, in order, with their path resolved"""
+    with open(manifest_path, "r") as fi:
+        manifest = json.load(fi)
+    shards = manifest["shards"]
+    for shard in shards:
+        shard["path"] = os.path.join(os.path.dirname(manifest_path), shard["path"])
+    return shards
+
+
+def verify_shard(shard) -> bool:
+    """Whether the file of a shard of `read_manifest` has the checksum of the manifest"""
+    sha256 = hashlib.sha256()
+    with open(shard["path"], "rb") as fi:
+        for chunk in iter(lambda: fi.read(2 ** 20), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest() == shard["sha256"]
@@ -0,0 +1,335 @@
+import multiprocessing
+import struct
+import time
+from collections import deque
+from multiprocessing import shared_memory
+from typing import Optional
+
+TRANSPORTS = ["shared_memory", "pipe"]
+# Positions (in bytes since the creation of the buffer) of the end of the last written record and of the end of the
+# last read record
+_POSITIONS = struct.Struct("<QQ")
+
+
+class DocumentTimeoutError(Exception):
+    pass
+
+
+class DocumentWorkerCrashError(Exception):
+    pass
+
+
+class SharedRingBuffer:
+    """Ring buffer of byte records in a `multiprocessing.shared_memory` block, for one writer and one reader process.
+
+    `try_write` copies a record in the buffer and returns its position, which is the only thing to send to the reader
+    along with the length of the record. The records are read (and their space released) in the order of writing. A
+    record is never split: if it doesn't fit at the end of the buffer, it is written at the start.
+
+    A buffer is pickled by the name of its block, so a process started with "spawn" attaches to the same block.
+    """
+
+    def __init__(self, capacity: int, name: Optional[str] = None):
+        self.capacity = capacity
+        if name is None:
+            self._shm = shared_memory.SharedMemory(create=True, size=_POSITIONS.size + capacity)
+            _POSITIONS.pack_into(self._shm.buf, 0, 0, 0)
+        else:
+            # The spawned processes share the resource tracker of their parent, the block is only unlinked once
+            self._shm = shared_memory.SharedMemory(name=name)
+        self._data = self._shm.buf[_POSITIONS.size : _POSITIONS.size + capacity]
+
+    def __reduce__(self):
+        return SharedRingBuffer, (self.capacity, self._shm.name)
+
+    def try_write(self, data: bytes) -> Optional[int]:
+        """Returns the position of the record, or None if there is not enough free space"""
+        length = len(data)
+        write_pos, read_pos = _POSITIONS.unpack_from(self._shm.buf, 0)
+        offset = write_pos % self.capacity
+        start_pos = write_pos if offset + length <= self.capacity else write_pos + self.capacity - offset
+        if start_pos + length - read_pos > self.capacity:
+            return None
+        start = start_pos % self.capacity
+        self._data[start : start + length] = data
+        struct.pack_into("<Q", self._shm.buf, 0, start_pos + length)
+        return start_pos
+
+    def read(self, pos: int, length: int) -> bytes:
+        start = pos % self.capacity
+        data = bytes(self._data[start : start + length])
+        struct.pack_into("<Q", self._shm.buf, 8, pos + length)
+        return data
+
+    def close(self, unlink: bool = False):
+        self._data.release()
+        self._shm.close()
+        if unlink:
+            self._shm.unlink()
+
+
+def _write_record(buffer: Optional[SharedRingBuffer], data: bytes, wait) -> Optional[int]:
+    """Write `data` in `buffer`, calling `wait` while the buffer is full. Returns None if the record doesn't fit."""
+    if buffer is None or len(data) > buffer.capacity:
+        return None
+    pos = buffer.try_write(data)
+    while pos is None and wait():
+        pos = buffer.try_write(data)
+    return pos
+
+
+def _wait_for_reader():
+    time.sleep(0.0005)
+    return True
+
+
+def _worker_loop(connection, function, input_buffer, output_buffer):
+    try:
+        _process_records(connection, function, input_buffer, output_buffer)
+    finally:
+        # The views of the blocks must be released before the blocks are closed at the exit of a spawned process
+        for buffer in [input_buffer, output_buffer]:
+            if buffer is not None:
+                buffer.close()
+
+
+def _process_records(connection, function, input_buffer, output_buffer):
+    while True:
+        try:
+            connection.poll(None)
+            start = time.perf_counter()
+            message = connection.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        kind, payload = message
+        data = input_buffer.read(*payload) if kind == "shared_memory" else payload
+        transport_seconds = time.perf_counter() - start
+        try:
+            result = function(data)
+        except Exception as error:
+            try:
+                connection.send(("error", error, 0.0))
+            except Exception:
+                # The exception can't always be pickled
+                connection.send(("error", RuntimeError(repr(error)), 0.0))
+            continue
+        start = time.perf_counter()
+        # The parent process reads the outputs as soon as they are announced, so the buffer is freed without waiting
+        # for this worker
+        pos = _write_record(output_buffer, result, _wait_for_reader)
+        if pos is None:
+            connection.send(("inline", result, transport_seconds + time.perf_counter() - start))
+        else:
+            connection.send(("shared_memory", (pos, len(result)), transport_seconds + time.perf_counter() - start))
+
+
+class WorkerPoolResult:
+    def __init__(self, pool: "WorkerPool", worker: "_PoolWorker"):
+        self._pool = pool
+        self._worker = worker
+        self._done = False
+        self._value = None
+        self._error = None
+        # Time (`time.perf_counter`) at which the worker is killed if it hasn't sent the result
+        self.deadline = None
+
+    def _set(self, value=None, error=None):
+        self._done = True
+        self._value = value
+        self._error = error
+
+    def result(self) -> bytes:
+        while not self._done:
+            self._pool._receive(self._worker)
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+
+class _PoolWorker:
+    def __init__(self, context, function, buffer_size, use_shared_memory):
+        self._context = context
+        self._function = function
+        self._buffer_size = buffer_size
+        self._use_shared_memory = use_shared_memory
+        self.pending = deque()
+        self._start()
+
+    def _start(self):
+        self.input_buffer = SharedRingBuffer(self._buffer_size) if self._use_shared_memory else None
+        self.output_buffer = SharedRingBuffer(self._buffer_size) if self._use_shared_memory else None
+        self.connection, child_connection = self._context.Pipe()
+        self.process = self._context.Process(
+            target=_worker_loop,
+            args=(child_connection, self._function, self.input_buffer, self.output_buffer),
+            daemon=True,
+        )
+        self.process.start()
+        child_connection.close()
+
+    def restart(self):
+        """Replace the process by a new one, with new buffers: the records sent to the old one are lost"""
+        self.process.kill()
+        self.process.join()
+        self.close()
+        self._start()
+
+    def close(self):
+        self.connection.close()
+        for buffer in [self.input_buffer, self.output_buffer]:
+            if buffer is not None:
+                buffer.close(unlink=True)
+
+
+class WorkerPool:
+    """Pool of processes applying `function` to byte records, with the records and the results passed through
+    shared memory.
+
+    Each worker has an input and an output `SharedRingBuffer` of `buffer_size` bytes, so only the positions and the
+    lengths of the records go through its pipe. The records which don't fit in a buffer are sent through the pipe,
+    as with `transport="pipe"` which is the pickling baseline. `submit` returns a `WorkerPoolResult` whose `result()`
+    is the output of `function`; `stats()` gives the time spent to move the records on both sides.
+
+    The workers are forked when the platform allows it. Otherwise, or with another `start_method` ("spawn" is the
+    default on macOS and Windows), `function` must be picklable and the workers attach to the buffers by their name.
+
+    If `timeout` is set, each worker is sent one record at a time, and a worker which hasn't sent its result
+    `timeout` seconds after it was sent its record is killed and replaced by a new one: the `result()` of the record
+    raises `DocumentTimeoutError` (or `DocumentWorkerCrashError` if the worker died), and the other workers carry on.
+    """
+
+    def __init__(
+        self,
+        function,
+        num_workers: int,
+        buffer_size: int = 64 * 2 ** 20,
+        max_pending: int = 8,
+        transport: str = "shared_memory",
+        timeout: Optional[float] = None,
+        start_method: Optional[str] = None,
+    ):
+        if transport not in TRANSPORTS:
+            raise ValueError(
+                f"You have requested an invalid transport ({transport}). Valid transports are {TRANSPORTS}."
+            )
+        self.transport = transport
+        self.timeout = timeout
+        # The deadline of a record starts when it is sent, so the worker must be idle then
+        self.max_pending = max_pending if timeout is None else 1
+        if start_method is None and "fork" in multiprocessing.get_all_start_methods():
+            # "fork" avoids having to pickle `function`, which is often defined in a `__main__` module
+            start_method = "fork"
+        context = multiprocessing.get_context(start_method)
+        self._workers = [
+            _PoolWorker(context, function, buffer_size, use_shared_memory=transport == "shared_memory")
+            for _ in range(num_workers)
+        ]
+        self._next_worker_idx = 0
+        self._stats = {
+            "num_records": 0,
+            "input_bytes": 0,
+            "output_bytes": 0,
+            "num_inline_records": 0,
+            "parent_transport_seconds": 0.0,
+            "worker_transport_seconds": 0.0,
+            "num_timeouts": 0,
+            "num_crashes": 0,
+        }
+
+    def submit(self, data: bytes) -> WorkerPoolResult:
+        worker = self._workers[self._next_worker_idx]
+        self._next_worker_idx = (self._next_worker_idx + 1) % len(self._workers)
+        while len(worker.pending) >= self.max_pending:
+            self._receive(worker)
+
+        waiting_seconds = 0.0
+
+        def wait():
+            nonlocal waiting_seconds
+            # The worker frees its input buffer before sending each result
+            if not worker.pending:
+                return False
+            wait_start = time.perf_counter()
+            self._receive(worker)
+            waiting_seconds += time.perf_counter() - wait_start
+            return True
+
+        start = time.perf_counter()
+        pos = _write_record(worker.input_buffer, data, wait)
+        if pos is None:
+            # Both sides could block on sending a large record through the pipe, the worker must be idle first
+            while worker.pending:
+                self._receive(worker)
+            start = time.perf_counter()
+            waiting_seconds = 0.0
+            worker.connection.send(("inline", data))
+            self._stats["num_inline_records"] += 1
+        else:
+            worker.connection.send(("shared_memory", (pos, len(data))))
+        self._stats["parent_transport_seconds"] += time.perf_counter() - start - waiting_seconds
+        self._stats["num_records"] += 1
+        self._stats["input_bytes"] += len(data)
+        result = WorkerPoolResult(self, worker)
+        if self.timeout is not None:
+            result.deadline = time.perf_counter() + self.timeout
+        worker.pending.append(result)
+        return result
+
+    def _receive(self, worker: _PoolWorker):
+        result = worker.pending.popleft()
+        try:
+            # The time spent waiting for the worker to process the record is not part of the transport
+            timeout = None if result.deadline is None else max(result.deadline - time.perf_counter(), 0.0)
+            if not worker.connection.poll(timeout):
+                worker.restart()
+                self._stats["num_timeouts"] += 1
+                result._set(error=DocumentTimeoutError(f"The document was not processed within {self.timeout} seconds"))
+                return
+        except EOFError:
+            pass
+        start = time.perf_counter()
+        try:
+            kind, payload, worker_transport_seconds = worker.connection.recv()
+        except EOFError:
+            worker.process.join()
+            if self.timeout is None:
+                raise RuntimeError(f"A worker process died (exit code {worker.process.exitcode})")
+            error = DocumentWorkerCrashError(
+                f"The worker process died while processing the document (exit code {worker.process.exitcode})"
+            )
+            worker.restart()
+            self._stats["num_crashes"] += 1
+            result._set(error=error)
+            return
+        if kind == "error":
+            result._set(error=payload)
+            return
+        data = worker.output_buffer.read(*payload) if kind == "shared_memory" else payload
+        self._stats["parent_transport_seconds"] += time.perf_counter() - start
+        self._stats["worker_transport_seconds"] += worker_transport_seconds
+        self._stats["output_bytes"] += len(data)
+        result._set(value=data)
+
+    def stats(self) -> dict:
+        return {"transport": self.transport, **self._stats}
+
+    def close(self):
+        for worker in self._workers:
+            if worker.process.is_alive():
+                try:
+                    worker.connection.send(None)
+                except (BrokenPipeError, OSError):
+                    pass
+                worker.process.join(timeout=1)
+                if worker.process.is_alive():
+                    worker.process.kill()
+                    worker.process.join()
+            worker.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,77 @@
+import gzip
+import json
+import random
+import sys
+
+import pytest
+
+sys.path.append(".")  # It's not very nice, we need to create a module
+from parse_scripts.gzip_index import GzipIndex, get_gzip_index_path
+from parse_scripts.pipeline import process_file, read_examples
+
+
+def write_shard(path, num_lines=200, seed=0):
+    with open("parse_scripts/data_test/raw_wiki_page.txt", "r") as f:
+        wiki_html = f.read()
+    rng = random.Random(seed)
+    lines = [
+        (
+            json.dumps(
+                {"document_html": wiki_html[: rng.randint(0, 5000)] + f"<p>{idx} {rng.getrandbits(8000):x}</p>"}
+            )
+            + "\n"
+        ).encode()
+        for idx in range(num_lines)
+    ]
+    with gzip.open(path, "wb") as fo:
+        fo.write(b"".join(lines))
+    return lines
+
+
+def get_last_characters(doc_html):
+    return {"text": doc_html[-12:], "metadata": []}
+
+
+def test_gzip_index_random_access(tmp_path):
+    shard_path = str(tmp_path / "nq-train-00.jsonl.gz")
+    lines = write_shard(shard_path)
+    GzipIndex.build(shard_path, span=2 ** 14).save()
+    gzip_index = GzipIndex.load(shard_path)
+
+    assert gzip_index.num_lines == len(lines)
+    # Enough checkpoints to start in the middle of a byte
+    assert len(gzip_index.uncompressed_offsets) > 5
+    assert len(set(gzip_index.bit_offsets.tolist())) > 1
+    assert list(gzip_index.iter_lines()) == lines
+    for start_line, end_line in [(0, 1), (7, 31), (100, 200), (199, 200), (150, 150), (180, 500)]:
+        assert list(gzip_index.iter_lines(start_line, end_line)) == lines[start_line:end_line]
+
+    sampled_lines = random.Random(1).sample(range(len(lines)), 25)
+    assert list(gzip_index.read_lines(sampled_lines)) == [(idx, lines[idx]) for idx in sorted(sampled_lines)]
+
+    parts = gzip_index.split(3)
+    assert parts[0][0] == 0 and parts[-1][1] == len(lines)
+    assert [line for start_line, end_line in parts for line in gzip_index.iter_lines(start_line, end_line)] == lines
+
+
+def test_gzip_index_outdated(tmp_path):
+    shard_path = str(tmp_path / "nq-train-00.jsonl.gz")
+    write_shard(shard_path, num_lines=10)
+    GzipIndex.load_or_build(shard_path)
+    write_shard(shard_path, num_lines=20)
+    with pytest.raises(ValueError):
+        GzipIndex.load(shard_path)
+
+
+def test_process_file_line_range(tmp_path):
+    shard_path = str(tmp_path / "nq-train-00.jsonl.gz")
+    lines = write_shard(shard_path, num_lines=50)
+    GzipIndex.build(shard_path, span=2 ** 14).save()
+
+    texts = []
+    for part_idx, line_range in enumerate(GzipIndex.load(shard_path).split(4)):
+        target_path = str(tmp_path / f"nq-train-00-part-{part_idx}.jsonl.gz")
+        process_file(shard_path, target_path, get_last_characters, line_range=line_range)
+        texts.extend(example["text"] for example in read_examples(target_path))
+    assert texts == [json.loads(line)["document_html"][-12:] for line in lines]
+    assert get_gzip_index_path(shard_path).endswith(".gzidx")
@@ -0,0 +1,69 @@
+import json
+import pickle
+import sys
+
+import pytest
+
+sys.path.append(".")  # It's not very nice, we need to create a module
+from parse_scripts.indexed_shard import IndexedShard, IndexedShardWriter
+from parse_scripts.pipeline import encode_example, process_file, read_examples
+from parse_scripts.test_pipeline import write_nq_shard
+
+EXAMPLES = [{"text": f"document {idx} " + "é" * idx, "metadata": [{"value": "p", "idx": idx}]} for idx in range(50)]
+
+
+@pytest.mark.parametrize("compression", [None, "zlib"])
+def test_indexed_shard_random_access(tmp_path, compression):
+    data_path = str(tmp_path / "shard.jsonl")
+    with IndexedShardWriter(data_path, compression=compression, block_size=256) as writer:
+        for json_example in EXAMPLES:
+            writer.write(encode_example(json_example))
+
+    shard = IndexedShard(data_path)
+    assert len(shard) == len(EXAMPLES)
+    assert shard[17] == EXAMPLES[17]
+    assert shard[-1] == EXAMPLES[-1]
+    assert shard[3] == EXAMPLES[3]
+    assert shard[10:20:3] == EXAMPLES[10:20:3]
+    assert shard.get_bytes(5) == encode_example(EXAMPLES[5])
+    assert list(shard) == EXAMPLES
+    with pytest.raises(IndexError):
+        shard[len(EXAMPLES)]
+
+    if compression is None:
+        with open(data_path, "rb") as fi:
+            assert [json.loads(line) for line in fi] == EXAMPLES
+
+    unpickled_shard = pickle.loads(pickle.dumps(shard))
+    assert unpickled_shard[42] == EXAMPLES[42]
+    unpickled_shard.close()
+    shard.close()
+
+
+def test_empty_indexed_shard(tmp_path):
+    data_path = str(tmp_path / "empty.jsonl")
+    IndexedShardWriter(data_path, compression="zlib").close()
+    assert len(IndexedShard(data_path)) == 0
+
+
+@pytest.mark.parametrize("output_format", ["indexed", "indexed-zlib"])
+def test_process_file_indexed_output(tmp_path, output_format):
+    documents = ["a", "b", "a", "c"]
+    file_path = str(tmp_path / "nq-train-00.jsonl.gz")
+    target_path = str(tmp_path / "target.jsonl")
+    write_nq_shard(file_path, documents)
+
+    process_file(
+        file_path,
+        target_path,
+        lambda doc_html: {"text": doc_html.upper(), "metadata": []},
+        dedup="reference",
+        output_format=output_format,
+    )
+
+    expected_examples = [{"text": document.upper(), "metadata": []} for document in documents]
+    assert IndexedShard(target_path)[2] == expected_examples[2]
+    assert list(read_examples(target_path)) == expected_examples
+
+    with pytest.raises(ValueError):
+        process_file(file_path, target_path, lambda doc_html: {}, output_format="parquet")
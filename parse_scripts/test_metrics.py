@@ -0,0 +1,103 @@
+import gzip
+import json
+import sys
+
+import pytest
+
+sys.path.append(".")  # It's not very nice, we need to create a module
+from parse_scripts.metrics import LatencyHistogram, PipelineMetrics, format_prometheus, merge_snapshots
+from parse_scripts.pipeline import DocumentSkipped, process_file
+from parse_scripts.test_pipeline import slow_upper, write_nq_shard
+
+
+def reject_long_documents(doc_html):
+    example = {"text": doc_html.upper(), "metadata": []}
+    if len(doc_html) > 1:
+        raise DocumentSkipped("Over the length limit", {"text": "", "metadata": []})
+    return example
+
+
+def test_latency_histogram():
+    histogram = LatencyHistogram()
+    for idx in range(1, 1001):
+        histogram.observe(idx / 1000)
+    assert histogram.count == 1000
+    assert histogram.maximum == 1.0
+    # The quantiles are within a factor 2 of the exact ones
+    for q in [0.5, 0.95, 0.99]:
+        assert q / 2 <= histogram.quantile(q) <= min(2 * q, 1.0)
+    assert histogram.quantile(0.5) <= histogram.quantile(0.95) <= histogram.quantile(0.99)
+
+    other_histogram = LatencyHistogram()
+    other_histogram.observe(200.0)
+    histogram.update(other_histogram)
+    assert (histogram.count, histogram.maximum, histogram.quantile(1.0)) == (1001, 200.0, 200.0)
+    assert LatencyHistogram.from_dict(histogram.to_dict()).counts == histogram.counts
+    assert LatencyHistogram().quantile(0.5) == 0.0
+
+
+def test_process_file_metrics(tmp_path, capsys):
+    file_path = str(tmp_path / "nq-train-00.jsonl.gz")
+    target_path = str(tmp_path / "nq-train-00-processed.jsonl.gz")
+    write_nq_shard(file_path, ["a", "b", "a", "hang", "c"])
+
+    metrics_path = str(tmp_path / "nq-train-00.metrics.jsonl")
+    process_file(file_path, target_path, slow_upper, doc_timeout=2, metrics_path=metrics_path, metrics_interval=0)
+    with open(metrics_path) as fi:
+        snapshots = [json.loads(line) for line in fi]
+    # One snapshot by document, plus the final one
+    assert len(snapshots) == 6
+    assert [snapshot["counters"]["documents"] for snapshot in snapshots] == [1, 2, 3, 4, 5, 5]
+    assert snapshots[-1]["counters"]["skipped_documents"] == snapshots[-1]["counters"]["timeouts"] == 1
+    assert snapshots[-1]["skip_rate"] == 0.2
+    assert sum(snapshots[-1]["histograms"]["document"]["counts"]) == 5
+    # The document which timed out has no processing time, the main thread waited for it
+    assert sum(snapshots[-1]["histograms"]["process"]["counts"]) == 4
+    assert snapshots[-1]["histograms"]["wait"]["max"] >= 2
+    output = capsys.readouterr().out
+    assert "Metrics of nq-train-00.jsonl.gz: 5 documents" in output
+    assert "1 skipped (20.00%: 1 timeouts, 0 worker crashes, 0 rejected), 0 fatal errors" in output
+    assert "document: p50: " in output
+
+    merged_snapshot = merge_snapshots([snapshots[-1], snapshots[-1]])
+    assert merged_snapshot["counters"]["documents"] == 10
+    assert sum(merged_snapshot["histograms"]["read"]["counts"]) == 10
+
+    write_nq_shard(file_path, ["a", "b", "a", "c", "d"])
+    prometheus_path = str(tmp_path / "nq-train-00.prom")
+    process_file(
+        file_path, target_path, slow_upper, dedup="reference", metrics_path=prometheus_path, metrics_format="prometheus"
+    )
+    with open(prometheus_path) as fi:
+        prometheus_lines = fi.read().splitlines()
+    assert 'nq_documents_total{shard="nq-train-00.jsonl.gz"} 5' in prometheus_lines
+    assert 'nq_duplicates_total{shard="nq-train-00.jsonl.gz"} 1' in prometheus_lines
+    assert 'nq_stage_latency_seconds_bucket{shard="nq-train-00.jsonl.gz",stage="document",le="+Inf"} 5' in (
+        prometheus_lines
+    )
+
+    with pytest.raises(ValueError):
+        process_file(file_path, target_path, slow_upper, metrics_format="csv")
+
+
+@pytest.mark.parametrize("num_threads", [None, 2])
+def test_process_file_metrics_of_rejected_documents(tmp_path, num_threads):
+    file_path = str(tmp_path / "nq-train-00.jsonl.gz")
+    target_path = str(tmp_path / "nq-train-00-processed.jsonl.gz")
+    write_nq_shard(file_path, ["a", "hang", "b", "long"])
+
+    metrics_path = str(tmp_path / "nq-train-00.metrics.jsonl")
+    process_file(file_path, target_path, reject_long_documents, num_threads=num_threads, metrics_path=metrics_path)
+    with gzip.open(target_path) as fi:
+        assert [json.loads(line)["text"] for line in fi] == ["A", "", "B", ""]
+    with open(metrics_path) as fi:
+        snapshot = json.loads(fi.readlines()[-1])
+    assert snapshot["counters"]["skipped_documents"] == snapshot["counters"]["rejected_documents"] == 2
+    assert snapshot["counters"]["fatal_errors"] == 0
+    assert sum(snapshot["histograms"]["process"]["counts"]) == 2
+    assert sum(snapshot["histograms"]["wait"]["counts"]) == 4
+
+
+def test_prometheus_labels_are_escaped():
+    metrics = PipelineMetrics('shard "0"\\')
+    assert 'nq_fatal_errors_total{shard="shard \\"0\\"\\\\"} 0' in format_prometheus(metrics.snapshot()).splitlines()
@@ -1,8 +1,11 @@
 import sys
 import jsonlines
+import pytest
 
 sys.path.append(".")  # It's not very nice, we need to create a module
 from html_parser import (
+    DocumentLimits,
+    StringVocabulary,
     TagToRemove,
     TagToRemoveWithContent,
     get_clean_text_and_metadata,
@@ -12,6 +15,7 @@ from parse_scripts.parse_natural_questions_Toy_v2 import (
     convert_html_metadata_dataclass_to_dict,
     process_example,
 )
+from parse_scripts.pipeline import DocumentSkipped
 
 
 def test_toy_webpage():
@@ -77,3 +81,34 @@ def test_wiki_webpage():
     assert true_plain_text == plain_text
 
     assert metadata_list == []
+
+
+def test_process_example_collects_stats():
+    html = "<html><body><div><p>a<br>b</p><script>x</script></div></body></html>"
+    result = process_example(html, collect_stats=True)
+    assert result["examples"] == process_example(html)
+    assert result["stats"]["tag_counts"]["p"] == 1
+    assert result["stats"]["removed_with_content_counts"] == {"script": 1}
+
+
+def test_process_example_for_the_binary_output():
+    html = "<html><body><div><p class='a'>a<br>b</p><script>x</script></div></body></html>"
+    plain_text, metadata = process_example(html, binary=True)
+    assert process_example(html) == {
+        "text": plain_text,
+        "metadata": [convert_html_metadata_dataclass_to_dict(node) for node in metadata],
+    }
+
+    vocabulary = StringVocabulary(intern_attr_values=True)
+    assert process_example(html, binary=True, vocabulary=vocabulary) == (plain_text, metadata)
+    assert {"p", "class", "a"} <= set(vocabulary.strings)
+
+
+def test_process_example_raises_for_the_skipped_documents():
+    html = "<html><body><p>" + "a" * 100 + "</p></body></html>"
+    document_limits = DocumentLimits(max_input_bytes=50, input_bytes_policy="skip")
+    with pytest.raises(DocumentSkipped) as excinfo:
+        process_example(html, document_limits=document_limits)
+    assert str(excinfo.value) == "Over the input_bytes limit"
+    assert excinfo.value.example["limit_decisions"][0]["policy"] == "skip"
+    assert process_example(html, document_limits=DocumentLimits(max_input_bytes=50))["text"]
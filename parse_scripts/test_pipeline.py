@@ -0,0 +1,264 @@
+import gzip
+import json
+import functools
+import sys
+import time
+
+import jsonlines
+import pytest
+
+sys.path.append(".")  # It's not very nice, we need to create a module
+from html_parser import DocumentLimits, StringVocabulary, get_clean_text_and_metadata
+from parse_scripts.pipeline import (
+    DocumentTimeoutError,
+    DocumentWorker,
+    process_file,
+    process_html_example,
+    read_binary_examples,
+    read_examples,
+)
+
+
+def slow_upper(doc_html):
+    if doc_html == "hang":
+        time.sleep(60)
+    if doc_html == "fail":
+        raise ValueError("Invalid document")
+    return {"text": doc_html.upper(), "metadata": []}
+
+
+def write_nq_shard(path, documents):
+    with gzip.open(path, "w") as fi:
+        writer = jsonlines.Writer(fi)
+        for document in documents:
+            writer.write({"document_html": document})
+
+
+def test_document_worker_timeout():
+    with DocumentWorker(slow_upper, timeout=2) as worker:
+        assert worker("a") == {"text": "A", "metadata": []}
+
+        start = time.time()
+        with pytest.raises(DocumentTimeoutError):
+            worker("hang")
+        assert time.time() - start < 10
+        assert worker.num_restarts == 1
+
+        # The replacing worker is fully functional
+        assert worker("b") == {"text": "B", "metadata": []}
+        with pytest.raises(ValueError):
+            worker("fail")
+        assert worker("c") == {"text": "C", "metadata": []}
+
+
+@pytest.mark.parametrize("num_processes", [None, 2])
+def test_process_file_skips_documents_over_budget(tmp_path, capsys, num_processes):
+    file_path = str(tmp_path / "nq-train-00.jsonl.gz")
+    target_path = str(tmp_path / "nq-train-00-processed.jsonl.gz")
+    write_nq_shard(file_path, ["a", "hang", "b", "c", "d"])
+
+    stats = process_file(file_path, target_path, slow_upper, doc_timeout=2, num_processes=num_processes)
+
+    with gzip.open(target_path) as fi:
+        examples = [json.loads(line) for line in fi]
+    assert [example["text"] for example in examples] == ["A", "", "B", "C", "D"]
+    first_line_length = len(json.dumps({"document_html": "a"}, ensure_ascii=False)) + 1
+    assert f"Skip {file_path} line 1 (byte offset {first_line_length})" in capsys.readouterr().out
+    if num_processes is not None:
+        assert stats["transport"]["num_timeouts"] == 1
+
+    with pytest.raises(ValueError):
+        process_file(file_path, target_path, slow_upper, doc_timeout=2, num_threads=2)
+
+
+PROCESSED_DOCUMENTS = []
+
+
+def record_and_upper(doc_html):
+    PROCESSED_DOCUMENTS.append(doc_html)
+    return {"text": doc_html.upper(), "metadata": []}
+
+
+@pytest.mark.parametrize("dedup", ["copy", "reference"])
+def test_process_file_deduplication(tmp_path, dedup):
+    file_path = str(tmp_path / "nq-train-00.jsonl.gz")
+    target_path = str(tmp_path / "nq-train-00-processed.jsonl.gz")
+    write_nq_shard(file_path, ["a", "b", "a", "a", "c", "b"])
+
+    PROCESSED_DOCUMENTS.clear()
+    stats = process_file(file_path, target_path, record_and_upper, dedup=dedup)
+
+    assert stats == {"num_documents": 6, "num_duplicates": 3}
+    assert PROCESSED_DOCUMENTS == ["a", "b", "c"]
+    assert [example["text"] for example in read_examples(target_path)] == ["A", "B", "A", "A", "C", "B"]
+    with gzip.open(target_path) as fi:
+        lines = fi.readlines()
+    if dedup == "reference":
+        assert json.loads(lines[3]) == {"duplicate_of": 0}
+    else:
+        assert lines[3] == lines[0]
+
+    # Without memory to keep the outputs, the duplicates are processed again
+    PROCESSED_DOCUMENTS.clear()
+    process_file(file_path, target_path, record_and_upper, dedup="copy", dedup_max_bytes=0)
+    assert len(PROCESSED_DOCUMENTS) == 6
+
+
+def upper_and_lower(doc_html):
+    if doc_html == "hang":
+        time.sleep(60)
+    return {"upper": {"text": doc_html.upper(), "metadata": []}, "lower": {"text": doc_html.lower(), "metadata": []}}
+
+
+@pytest.mark.parametrize("dedup", [None, "copy", "reference"])
+def test_process_file_profiles(tmp_path, dedup):
+    file_path = str(tmp_path / "nq-train-00.jsonl.gz")
+    target_paths = {
+        "upper": str(tmp_path / "nq-train-00-upper.jsonl.gz"),
+        "lower": str(tmp_path / "nq-train-00-lower.jsonl.gz"),
+    }
+    write_nq_shard(file_path, ["a", "B", "hang", "a"])
+
+    process_file(file_path, target_paths, upper_and_lower, doc_timeout=2, dedup=dedup)
+
+    assert [example["text"] for example in read_examples(target_paths["upper"])] == ["A", "B", "", "A"]
+    assert [example["text"] for example in read_examples(target_paths["lower"])] == ["a", "b", "", "a"]
+
+
+@pytest.mark.parametrize("dedup", [None, "copy", "reference"])
+def test_process_file_threads(tmp_path, dedup):
+    file_path = str(tmp_path / "nq-train-00.jsonl.gz")
+    target_path = str(tmp_path / "nq-train-00-processed.jsonl.gz")
+    documents = ["a", "b", "a", "c", "b"] * 10
+    write_nq_shard(file_path, documents)
+
+    PROCESSED_DOCUMENTS.clear()
+    stats = process_file(file_path, target_path, record_and_upper, dedup=dedup, num_threads=3)
+
+    assert stats["num_documents"] == len(documents)
+    assert [example["text"] for example in read_examples(target_path)] == [document.upper() for document in documents]
+    assert len(PROCESSED_DOCUMENTS) == (len(documents) if dedup is None else 3)
+
+    with pytest.raises(ValueError):
+        process_file(file_path, target_path, record_and_upper, doc_timeout=2, num_threads=3)
+
+
+@pytest.mark.parametrize("transport", ["shared_memory", "pipe"])
+@pytest.mark.parametrize("dedup", [None, "reference"])
+def test_process_file_processes(tmp_path, transport, dedup):
+    file_path = str(tmp_path / "nq-train-00.jsonl.gz")
+    target_path = str(tmp_path / "nq-train-00-processed.jsonl.gz")
+    documents = ["a", "b", "a", "é 中文", "b"] * 10
+    write_nq_shard(file_path, documents)
+
+    stats = process_file(file_path, target_path, slow_upper, dedup=dedup, num_processes=2, transport=transport)
+    assert [example["text"] for example in read_examples(target_path)] == [document.upper() for document in documents]
+    assert stats["transport"]["num_records"] == (len(documents) if dedup is None else 3)
+
+    target_paths = {
+        "upper": str(tmp_path / "nq-train-00-upper.jsonl.gz"),
+        "lower": str(tmp_path / "nq-train-00-lower.jsonl.gz"),
+    }
+    process_file(file_path, target_paths, upper_and_lower, dedup=dedup, num_processes=2, transport=transport)
+    assert [example["text"] for example in read_examples(target_paths["upper"])] == [
+        document.upper() for document in documents
+    ]
+    assert [example["text"] for example in read_examples(target_paths["lower"])] == [
+        document.lower() for document in documents
+    ]
+
+
+@pytest.mark.parametrize("num_threads", [None, 3])
+@pytest.mark.parametrize("dedup", [None, "copy", "reference"])
+def test_process_file_io_queues(tmp_path, num_threads, dedup):
+    file_path = str(tmp_path / "nq-train-00.jsonl.gz")
+    documents = ["a", "b", "a", "é 中文", "b"] * 20
+    write_nq_shard(file_path, documents)
+
+    target_path = str(tmp_path / "nq-train-00-processed.jsonl.gz")
+    stats = process_file(file_path, target_path, slow_upper, dedup=dedup, num_threads=num_threads, io_queue_size=4)
+    assert [example["text"] for example in read_examples(target_path)] == [document.upper() for document in documents]
+    assert stats["queues"]["reader"]["num_items"] == len(documents) + 1
+    assert stats["queues"]["writer"]["num_items"] == len(documents) + 1
+    assert stats["queues"]["reader"]["max_depth"] <= 4
+
+    target_paths = {
+        "upper": str(tmp_path / "nq-train-00-upper.jsonl.gz"),
+        "lower": str(tmp_path / "nq-train-00-lower.jsonl.gz"),
+    }
+    stats = process_file(file_path, target_paths, upper_and_lower, dedup=dedup, io_queue_size=4)
+    assert sorted(stats["queues"]) == ["reader", "writer lower", "writer upper"]
+    assert [example["text"] for example in read_examples(target_paths["lower"])] == [
+        document.lower() for document in documents
+    ]
+
+
+def test_process_file_io_queues_errors(tmp_path):
+    file_path = str(tmp_path / "nq-train-00.jsonl.gz")
+    target_path = str(tmp_path / "nq-train-00-processed.jsonl.gz")
+    with gzip.open(file_path, "w") as fi:
+        fi.write(b'{"document_html": "a"}\n' * 50 + b"not json\n")
+    # The errors of the reader thread are raised by `process_file`
+    with pytest.raises(json.JSONDecodeError):
+        process_file(file_path, target_path, slow_upper, io_queue_size=2)
+
+    write_nq_shard(file_path, ["a"] * 50 + ["fail"] + ["b"] * 50)
+    with pytest.raises(ValueError):
+        process_file(file_path, target_path, slow_upper, io_queue_size=2)
+
+
+@pytest.mark.parametrize("num_threads", [None, 2])
+def test_process_file_binary_output(tmp_path, num_threads):
+    file_path = str(tmp_path / "nq-train-00.jsonl.gz")
+    target_path = str(tmp_path / "nq-train-00.bin.gz")
+    documents = [
+        f'<html><body><div class="c{idx % 3}"><p id="p{idx}">Document {idx} é 中文</p></div></body></html>'
+        for idx in range(20)
+    ]
+    write_nq_shard(file_path, documents)
+
+    process_file(file_path, target_path, get_clean_text_and_metadata, output_format="binary", num_threads=num_threads)
+    assert list(read_binary_examples(target_path)) == [get_clean_text_and_metadata(document) for document in documents]
+
+    with pytest.raises(ValueError):
+        process_file(file_path, target_path, get_clean_text_and_metadata, output_format="binary", dedup="copy")
+
+
+@pytest.mark.parametrize("num_threads", [None, 2])
+def test_process_file_binary_output_with_the_vocabulary_of_the_documents(tmp_path, num_threads):
+    file_path = str(tmp_path / "nq-train-00.jsonl.gz")
+    target_path = str(tmp_path / "nq-train-00.bin.gz")
+    documents = [f'<html><body><div class="c{idx % 3}"><p>Document {idx}</p></div></body></html>' for idx in range(20)]
+    write_nq_shard(file_path, documents)
+
+    vocabulary = StringVocabulary(intern_attr_values=True)
+    process_example = functools.partial(get_clean_text_and_metadata, vocabulary=vocabulary)
+    process_file(
+        file_path, target_path, process_example, output_format="binary", num_threads=num_threads, vocabulary=vocabulary
+    )
+    assert list(read_binary_examples(target_path)) == [get_clean_text_and_metadata(document) for document in documents]
+    # The attribute values are written as IDs of the vocabulary
+    assert {"div", "class", "c0", "c1", "c2"} <= set(vocabulary.strings)
+
+
+def test_process_file_writes_the_limit_decisions(tmp_path, capsys):
+    file_path = str(tmp_path / "nq-train-00.jsonl.gz")
+    target_path = str(tmp_path / "nq-train-00-processed.jsonl.gz")
+    small_document = "<html><body><p>a</p></body></html>"
+    large_document = "<html><body>" + "<p>b</p>" * 5 + "</body></html>"
+    huge_document = "<html><body>" + "<p>c</p>" * 50 + "</body></html>"
+    write_nq_shard(file_path, [small_document, large_document, huge_document])
+
+    document_limits = DocumentLimits(
+        max_input_bytes=300, input_bytes_policy="skip", max_elements=4, elements_policy="text-only"
+    )
+    process_file(file_path, target_path, functools.partial(process_html_example, document_limits=document_limits))
+    examples = list(read_examples(target_path))
+    assert [example["limit_decisions"] for example in examples] == [
+        [],
+        [{"limit": "elements", "value": 6, "max_value": 4, "policy": "text-only"}],
+        [{"limit": "input_bytes", "value": len(huge_document), "max_value": 300, "policy": "skip"}],
+    ]
+    assert [example["text"] for example in examples] == ["a\n", "b\nb\nb\nb\nb\n", ""]
+    assert examples[0]["metadata"] and not examples[1]["metadata"]
+    assert f"Skip {file_path} line 2" in capsys.readouterr().out
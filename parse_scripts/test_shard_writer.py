@@ -0,0 +1,85 @@
+import gzip
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.append(".")  # It's not very nice, we need to create a module
+from parse_scripts.pipeline import encode_example, process_file, read_examples
+from parse_scripts.shard_writer import ShardedWriter, get_manifest_path, read_manifest, verify_shard
+from parse_scripts.test_pipeline import slow_upper, write_nq_shard
+
+EXAMPLES = [{"text": f"document {idx} " + "é" * idx, "metadata": []} for idx in range(103)]
+
+
+def test_sharded_writer_rolls_over_by_records(tmp_path):
+    target_path = str(tmp_path / "nq-train-00.jsonl.gz")
+    with ShardedWriter(target_path, max_shard_records=10, num_writers=3) as writer:
+        for json_example in EXAMPLES:
+            writer.write(encode_example(json_example))
+
+    manifest_path = get_manifest_path(target_path)
+    assert manifest_path == str(tmp_path / "nq-train-00.manifest.json")
+    shards = read_manifest(manifest_path)
+    assert [os.path.basename(shard["path"]) for shard in shards[:2]] == [
+        "nq-train-00-00000.jsonl.gz",
+        "nq-train-00-00001.jsonl.gz",
+    ]
+    assert [shard["num_records"] for shard in shards] == [10] * 10 + [3]
+    assert [shard["first_record"] for shard in shards] == list(range(0, 110, 10))
+    assert all(verify_shard(shard) for shard in shards)
+    for shard in shards:
+        with gzip.open(shard["path"]) as fi:
+            records = fi.read()
+        assert len(records) == shard["num_bytes"]
+        assert [json.loads(line) for line in records.splitlines()] == EXAMPLES[
+            shard["first_record"] : shard["first_record"] + shard["num_records"]
+        ]
+    assert list(read_examples(manifest_path)) == EXAMPLES
+
+    with open(shards[0]["path"], "ab") as fo:
+        fo.write(b"\0")
+    assert not verify_shard(shards[0])
+
+
+def test_sharded_writer_rolls_over_by_bytes(tmp_path):
+    target_path = str(tmp_path / "nq-train-00.jsonl.gz")
+    with ShardedWriter(target_path, max_shard_bytes=500) as writer:
+        for json_example in EXAMPLES:
+            writer.write(encode_example(json_example))
+    shards = read_manifest(get_manifest_path(target_path))
+    # A shard is closed by the record which reaches the limit
+    assert all(shard["num_bytes"] < 500 + len(encode_example(EXAMPLES[-1])) for shard in shards)
+    assert all(shard["num_bytes"] >= 500 for shard in shards[:-1])
+    assert list(read_examples(get_manifest_path(target_path))) == EXAMPLES
+
+    with pytest.raises(ValueError):
+        ShardedWriter(target_path)
+
+
+def test_sharded_writer_without_manifest_on_error(tmp_path):
+    target_path = str(tmp_path / "nq-train-00.jsonl.gz")
+    with pytest.raises(RuntimeError):
+        with ShardedWriter(target_path, max_shard_records=2) as writer:
+            for json_example in EXAMPLES[:5]:
+                writer.write(encode_example(json_example))
+            raise RuntimeError("Interrupted")
+    assert not os.path.exists(get_manifest_path(target_path))
+
+
+def test_process_file_sharded_output(tmp_path):
+    file_path = str(tmp_path / "nq-train-00.jsonl.gz")
+    target_path = str(tmp_path / "nq-train-00-processed.jsonl.gz")
+    documents = [f"document {idx}" for idx in range(25)]
+    write_nq_shard(file_path, documents)
+
+    process_file(file_path, target_path, slow_upper, num_threads=2, max_shard_records=7, num_writers=2)
+    manifest_path = get_manifest_path(target_path)
+    assert [shard["num_records"] for shard in read_manifest(manifest_path)] == [7, 7, 7, 4]
+    assert [example["text"] for example in read_examples(manifest_path)] == [document.upper() for document in documents]
+
+    with pytest.raises(ValueError):
+        process_file(file_path, target_path, slow_upper, dedup="reference", max_shard_records=7)
+    with pytest.raises(ValueError):
+        process_file(file_path, target_path, slow_upper, output_format="indexed", max_shard_records=7)
@@ -0,0 +1,92 @@
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.append(".")  # It's not very nice, we need to create a module
+from parse_scripts.shared_memory_transport import (
+    DocumentTimeoutError,
+    DocumentWorkerCrashError,
+    SharedRingBuffer,
+    WorkerPool,
+)
+
+
+def upper_bytes(data):
+    if data == b"fail":
+        raise ValueError("Invalid record")
+    if data == b"hang":
+        time.sleep(60)
+    if data == b"crash":
+        os._exit(1)
+    return data.upper() * 2
+
+
+def test_ring_buffer_wraps_around():
+    buffer = SharedRingBuffer(capacity=10)
+    try:
+        first_pos = buffer.try_write(b"abcdef")
+        assert first_pos == 0
+        # Not enough space left before the first record is read
+        assert buffer.try_write(b"ghijkl") is None
+        assert buffer.read(first_pos, 6) == b"abcdef"
+        # The record doesn't fit at the end of the buffer, it is written at the start
+        second_pos = buffer.try_write(b"ghijkl")
+        assert second_pos == 10
+        assert buffer.try_write(b"mnop") is None
+        assert buffer.read(second_pos, 6) == b"ghijkl"
+        assert buffer.try_write(b"mnop") == 16
+        assert buffer.try_write(b"qrstuvw") is None
+        assert buffer.read(16, 4) == b"mnop"
+        assert buffer.try_write(b"qrstuvw") == 20
+    finally:
+        buffer.close(unlink=True)
+
+
+@pytest.mark.parametrize("transport", ["shared_memory", "pipe"])
+def test_worker_pool(transport):
+    records = [f"record {idx} ".encode() * (idx % 7) for idx in range(50)] + [b"x" * 5000, b"fail", b"last"]
+    with WorkerPool(upper_bytes, num_workers=3, buffer_size=4096, max_pending=4, transport=transport) as pool:
+        results = [pool.submit(record) for record in records]
+        for record, result in zip(records, results):
+            if record == b"fail":
+                with pytest.raises(ValueError):
+                    result.result()
+            else:
+                assert result.result() == upper_bytes(record)
+        stats = pool.stats()
+
+    assert stats["num_records"] == len(records)
+    assert stats["input_bytes"] == sum(len(record) for record in records)
+    if transport == "shared_memory":
+        # Only the record larger than the buffer went through the pipe
+        assert stats["num_inline_records"] == 1
+    else:
+        assert stats["num_inline_records"] == len(records)
+    assert stats["parent_transport_seconds"] > 0 and stats["worker_transport_seconds"] > 0
+
+
+@pytest.mark.parametrize("transport", ["shared_memory", "pipe"])
+def test_worker_pool_timeout(transport):
+    records = [b"a", b"hang", b"b", b"crash", b"c", b"x" * 5000, b"d"]
+    with WorkerPool(upper_bytes, num_workers=2, buffer_size=4096, transport=transport, timeout=2) as pool:
+        results = [pool.submit(record) for record in records]
+        with pytest.raises(DocumentTimeoutError):
+            results[1].result()
+        with pytest.raises(DocumentWorkerCrashError):
+            results[3].result()
+        for record, result in zip(records, results):
+            if record not in [b"hang", b"crash"]:
+                assert result.result() == upper_bytes(record)
+        stats = pool.stats()
+    assert (stats["num_timeouts"], stats["num_crashes"]) == (1, 1)
+
+
+def test_worker_pool_with_spawned_workers():
+    records = [f"record {idx} ".encode() * (idx % 7) for idx in range(20)] + [b"x" * 5000]
+    with WorkerPool(upper_bytes, num_workers=2, buffer_size=4096, start_method="spawn") as pool:
+        results = [pool.submit(record) for record in records]
+        assert [result.result() for result in results] == [upper_bytes(record) for record in records]
+        stats = pool.stats()
+    assert stats["num_inline_records"] == 1
@@ -0,0 +1,195 @@
+import dataclasses
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+import htmlmin
+from lxml import etree
+
+import html_parser
+from html_parser import HtmlTag, LimitDecision, Metadata
+
+
+def _to_json_compatible(obj):
+    if dataclasses.is_dataclass(obj):
+        return {"__class__": type(obj).__name__, **dataclasses.asdict(obj)}
+    raise TypeError(f"Object of type {type(obj).__name__} can't be part of a cleaner config")
+
+
+def hash_config(config: dict) -> str:
+    """Canonical hash of a cleaner config, the versions of the parser and of the libraries which change its output
+    (lxml, libxml2 and htmlmin) are part of it"""
+    canonical_config = json.dumps(
+        {
+            "config": config,
+            "html_parser_version": html_parser.__version__,
+            "lxml_version": etree.LXML_VERSION,
+            "libxml2_version": etree.LIBXML_VERSION,
+            "htmlmin_version": htmlmin.__version__,
+        },
+        sort_keys=True,
+        default=_to_json_compatible,
+    )
+    return hashlib.sha256(canonical_config.encode("UTF-8")).hexdigest()
+
+
+def hash_html(html_str) -> str:
+    html_bytes = html_str if isinstance(html_str, bytes) else html_str.encode("UTF-8", errors="surrogatepass")
+    return hashlib.sha256(html_bytes).hexdigest()
+
+
+def serialize_result(plain_text, metadata, limit_decisions) -> bytes:
+    result = {
+        "text": plain_text,
+        "metadata": [dataclasses.asdict(metadata_node) for metadata_node in metadata],
+        "limit_decisions": [dataclasses.asdict(decision) for decision in limit_decisions],
+    }
+    return zlib.compress(json.dumps(result, ensure_ascii=False).encode("UTF-8"))
+
+
+def deserialize_result(blob: bytes):
+    result = json.loads(zlib.decompress(blob).decode("UTF-8"))
+    metadata = []
+    for metadata_dict in result["metadata"]:
+        value = HtmlTag(**metadata_dict.pop("value"))
+        metadata.append(Metadata(value=value, **metadata_dict))
+    limit_decisions = [LimitDecision(**decision) for decision in result["limit_decisions"]]
+    return result["text"], metadata, limit_decisions
+
+
+class ResultCache:
+    """On-disk cache of the results of `get_clean_text_and_metadata`.
+
+    The results are stored in a SQLite database, keyed by the hash of the input HTML and the hash of the cleaner
+    config. When the database grows over `max_bytes`, the least recently used results are evicted. The cache can be
+    shared between processes and threads, each thread of each process opens its own connection. The total size of
+    the results is read and updated within `BEGIN IMMEDIATE` transactions, so that the concurrent writers don't lose
+    their updates.
+    """
+
+    def __init__(self, path: str, max_bytes: float = 10 * 2 ** 30):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._local = threading.local()
+        # Protects the counters of the instance
+        self._lock = threading.Lock()
+
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS results "
+                "(key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access)")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS info (id INTEGER PRIMARY KEY, total_size INTEGER NOT NULL, "
+                "hits INTEGER NOT NULL, misses INTEGER NOT NULL, evictions INTEGER NOT NULL)"
+            )
+            connection.execute(
+                "INSERT OR IGNORE INTO info (id, total_size, hits, misses, evictions) VALUES (0, 0, 0, 0, 0)"
+            )
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_local"], state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        # A connection can't be shared between threads nor inherited by a forked process
+        if getattr(self._local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=60)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def make_key(self, html_str, config: dict) -> str:
+        return f"{hash_html(html_str)}-{hash_config(config)}"
+
+    def get(self, key: str):
+        connection = self._connection()
+        row = connection.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            with self._lock:
+                self.misses += 1
+            with connection:
+                connection.execute("UPDATE info SET misses = misses + 1 WHERE id = 0")
+            return None
+        with self._lock:
+            self.hits += 1
+        with connection:
+            connection.execute("UPDATE results SET last_access = ? WHERE key = ?", (time.time(), key))
+            connection.execute("UPDATE info SET hits = hits + 1 WHERE id = 0")
+        return deserialize_result(row[0])
+
+    def put(self, key: str, result):
+        blob = serialize_result(*result)
+        connection = self._connection()
+        with connection:
+            # The size of the replaced result must not change before the total size is updated
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute("SELECT size FROM results WHERE key = ?", (key,)).fetchone()
+            previous_size = row[0] if row is not None else 0
+            connection.execute(
+                "INSERT OR REPLACE INTO results (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, blob, len(blob), time.time()),
+            )
+            connection.execute("UPDATE info SET total_size = total_size + ? WHERE id = 0", (len(blob) - previous_size,))
+        self._evict()
+
+    def _evict(self):
+        connection = self._connection()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            (total_size,) = connection.execute("SELECT total_size FROM info WHERE id = 0").fetchone()
+            if total_size <= self.max_bytes:
+                return
+            num_evictions = 0
+            while total_size > self.max_bytes:
+                rows = connection.execute(
+                    "SELECT key, size FROM results ORDER BY last_access LIMIT 64"
+                ).fetchall()
+                if not rows:
+                    break
+                for key, size in rows:
+                    if total_size <= self.max_bytes:
+                        break
+                    connection.execute("DELETE FROM results WHERE key = ?", (key,))
+                    total_size -= size
+                    num_evictions += 1
+            connection.execute(
+                "UPDATE info SET total_size = ?, evictions = evictions + ? WHERE id = 0", (total_size, num_evictions)
+            )
+        with self._lock:
+            self.evictions += num_evictions
+
+    def stats(self) -> dict:
+        """Statistics of the cache file, accumulated over all the processes and runs which used it.
+
+        The attributes `hits`, `misses` and `evictions` only count the operations of this instance.
+        """
+        connection = self._connection()
+        (num_entries,) = connection.execute("SELECT COUNT(*) FROM results").fetchone()
+        total_size, hits, misses, evictions = connection.execute(
+            "SELECT total_size, hits, misses, evictions FROM info WHERE id = 0"
+        ).fetchone()
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+            "evictions": evictions,
+            "num_entries": num_entries,
+            "size_bytes": total_size,
+        }
@@ -0,0 +1,310 @@
+import dataclasses
+import json
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from html_parser import DocumentLimits, HtmlTag, LimitDecision, Metadata, TagToRemove, get_clean_text_and_metadata
+from metadata_index import metadata_from_dict
+
+# Parameters of `get_clean_text_and_metadata` which only select the metadata (and their attributes) once the text is
+# extracted, they can be re-applied on a staged shard without parsing the documents again
+FILTER_PARAMS = [
+    "tags_to_remove_alone",
+    "txt_max_chr_len_alone",
+    "txt_min_chr_len_alone",
+    "tags_exceptions_to_txt_max_min_chr_len_alone",
+    "attrs_to_keep",
+]
+
+
+def extract_unfiltered(html_str, **kwargs):
+    """Extract the text and all the metadata (with all their attributes) of a document, to be filtered later.
+
+    The keyword arguments are the ones of `get_clean_text_and_metadata` apart from `FILTER_PARAMS`. The metadata
+    limit of `document_limits` is not enforced here, since it applies to the filtered metadata.
+    """
+    filter_params = sorted(set(kwargs) & set(FILTER_PARAMS))
+    if filter_params:
+        raise ValueError(
+            f"You have requested filter parameters ({filter_params}) for an unfiltered extraction. They must be "
+            "passed to `StagedShard.apply_filters`."
+        )
+    document_limits = kwargs.pop("document_limits", None)
+    if document_limits is not None:
+        document_limits = dataclasses.replace(document_limits, max_metadata=float("inf"))
+    limit_decisions = []
+    plain_text, metadata = get_clean_text_and_metadata(
+        html_str, document_limits=document_limits, limit_decisions=limit_decisions, **kwargs
+    )
+    return plain_text, metadata, limit_decisions
+
+
+def _concat_strings(strings: List[str]):
+    encoded_strings = [string.encode("UTF-8", errors="surrogatepass") for string in strings]
+    offsets = np.zeros(len(encoded_strings) + 1, dtype=np.int64)
+    np.cumsum([len(encoded_string) for encoded_string in encoded_strings], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded_strings), dtype=np.uint8), offsets
+
+
+def _split_strings(blob: np.ndarray, offsets: np.ndarray) -> List[str]:
+    blob = blob.tobytes()
+    return [
+        blob[start:end].decode("UTF-8", errors="surrogatepass") for start, end in zip(offsets[:-1], offsets[1:])
+    ]
+
+
+def _rank_in_groups(sort_keys, group_keys):
+    """Rank of each row in the group of rows sharing the same `group_keys`, ordered by `sort_keys` (last key first)"""
+    order = np.lexsort(sort_keys + group_keys)
+    group_keys = np.stack([key[order] for key in group_keys])
+    is_group_start = np.ones(len(order), dtype=bool)
+    is_group_start[1:] = np.any(group_keys[:, 1:] != group_keys[:, :-1], axis=0)
+    group_start_positions = np.maximum.accumulate(np.where(is_group_start, np.arange(len(order)), 0))
+    ranks = np.empty(len(order), dtype=np.int64)
+    ranks[order] = np.arange(len(order)) - group_start_positions
+    return ranks
+
+
+class StagedShard:
+    """Columnar store of the unfiltered extraction results of a shard.
+
+    The metadata of all the documents are stored in flat arrays, so that the metadata filters (`FILTER_PARAMS`) and
+    the metadata limit can be applied to the whole shard in a vectorized pass with `apply_filters`. Filtering a staged
+    shard gives the same result as extracting the documents again with the filters.
+    """
+
+    def __init__(self, arrays: dict):
+        self.arrays = arrays
+        self.strings = json.loads(str(arrays["strings"]))
+        self._string_ids = {string: string_id for string_id, string in enumerate(self.strings)}
+
+    def __len__(self):
+        return len(self.arrays["metadata_offsets"]) - 1
+
+    @classmethod
+    def from_examples(cls, examples: Iterable[Tuple[str, List[Metadata], List[LimitDecision]]]) -> "StagedShard":
+        strings = []
+        string_ids = {}
+
+        def get_id(string):
+            if string not in string_ids:
+                string_ids[string] = len(strings)
+                strings.append(string)
+            return string_ids[string]
+
+        texts = []
+        limit_decisions = []
+        metadata_offsets = [0]
+        columns = {
+            name: []
+            for name in [
+                "starts",
+                "ends",
+                "relative_starts",
+                "relative_ends",
+                "byte_starts",
+                "byte_ends",
+                "tag_ids",
+                "key_ids",
+                "type_ids",
+            ]
+        }
+        attr_offsets = [0]
+        attr_key_ids = []
+        attr_values = []
+        for plain_text, metadata, document_limit_decisions in examples:
+            texts.append(plain_text)
+            limit_decisions.append([dataclasses.asdict(decision) for decision in document_limit_decisions])
+            metadata_offsets.append(metadata_offsets[-1] + len(metadata))
+            for metadata_node in metadata:
+                columns["starts"].append(metadata_node.char_start_idx)
+                columns["ends"].append(metadata_node.char_end_idx)
+                columns["relative_starts"].append(metadata_node.relative_start_pos)
+                columns["relative_ends"].append(metadata_node.relative_end_pos)
+                columns["byte_starts"].append(
+                    -1 if metadata_node.byte_start_idx is None else metadata_node.byte_start_idx
+                )
+                columns["byte_ends"].append(-1 if metadata_node.byte_end_idx is None else metadata_node.byte_end_idx)
+                columns["tag_ids"].append(get_id(metadata_node.value.tag))
+                columns["key_ids"].append(get_id(metadata_node.key))
+                columns["type_ids"].append(get_id(metadata_node.type))
+                attrs = metadata_node.value.attrs
+                attr_key_ids.extend(get_id(attr) for attr in attrs["attrs"])
+                attr_values.extend(attrs["values"])
+                attr_offsets.append(len(attr_key_ids))
+
+        text_blob, text_offsets = _concat_strings(texts)
+        attr_value_blob, attr_value_offsets = _concat_strings(attr_values)
+        arrays = {
+            "strings": np.array(json.dumps(strings)),
+            "limit_decisions": np.array(json.dumps(limit_decisions)),
+            "text_blob": text_blob,
+            "text_offsets": text_offsets,
+            "metadata_offsets": np.array(metadata_offsets, dtype=np.int64),
+            "attr_offsets": np.array(attr_offsets, dtype=np.int64),
+            "attr_key_ids": np.array(attr_key_ids, dtype=np.int32),
+            "attr_value_blob": attr_value_blob,
+            "attr_value_offsets": attr_value_offsets,
+            **{
+                name: np.array(values, dtype=np.int32 if name.endswith("_ids") else np.int64)
+                for name, values in columns.items()
+            },
+        }
+        return cls(arrays)
+
+    @classmethod
+    def from_json_examples(cls, json_examples: Iterable[dict]) -> "StagedShard":
+        """Build a staged shard from the examples of an output file (with its metadata unfiltered)"""
+        return cls.from_examples(
+            (
+                json_example["text"],
+                [metadata_from_dict(metadata_dict) for metadata_dict in json_example["metadata"]],
+                [LimitDecision(**decision) for decision in json_example.get("limit_decisions", [])],
+            )
+            for json_example in json_examples
+        )
+
+    def save(self, path):
+        np.savez(path, **self.arrays)
+
+    @classmethod
+    def load(cls, path) -> "StagedShard":
+        with np.load(path) as arrays:
+            return cls(dict(arrays))
+
+    def _get_string_ids(self, tags) -> np.ndarray:
+        return np.array([self._string_ids[tag] for tag in tags if tag in self._string_ids], dtype=np.int32)
+
+    def _get_kept_metadata(
+        self, tags_to_remove_alone, txt_max_chr_len_alone, txt_min_chr_len_alone, tags_exceptions_alone
+    ):
+        tag_ids = self.arrays["tag_ids"]
+        lengths = self.arrays["ends"] - self.arrays["starts"]
+
+        # Same rules as `TagFilter.drop_tag`
+        dropped = np.zeros(len(tag_ids), dtype=bool)
+        rules = {tag_to_remove.tag: tag_to_remove for tag_to_remove in tags_to_remove_alone or []}
+        for tag, tag_to_remove in rules.items():
+            if tag not in self._string_ids:
+                continue
+            dropped |= (
+                (tag_ids == self._string_ids[tag])
+                & (lengths <= tag_to_remove.content_max_char_length)
+                & (lengths >= tag_to_remove.content_min_char_length)
+            )
+        is_exception = np.isin(tag_ids, self._get_string_ids(tags_exceptions_alone or []))
+        dropped |= ~is_exception & (lengths <= txt_max_chr_len_alone) & (lengths >= txt_min_chr_len_alone)
+        return ~dropped
+
+    def apply_filters(
+        self,
+        tags_to_remove_alone: Optional[List[TagToRemove]] = None,
+        txt_max_chr_len_alone: float = -float("inf"),
+        txt_min_chr_len_alone: float = -float("inf"),
+        tags_exceptions_to_txt_max_min_chr_len_alone: Optional[List[str]] = None,
+        attrs_to_keep: Optional[List[str]] = None,
+        document_limits: Optional[DocumentLimits] = None,
+    ) -> List[Tuple[str, List[Metadata], List[LimitDecision]]]:
+        """Filter the metadata of all the documents, returns the (text, metadata, limit decisions) of each document"""
+        arrays = self.arrays
+        num_documents = len(self)
+        metadata_offsets = arrays["metadata_offsets"]
+        document_ids = np.repeat(np.arange(num_documents), np.diff(metadata_offsets))
+
+        kept = self._get_kept_metadata(
+            tags_to_remove_alone,
+            txt_max_chr_len_alone,
+            txt_min_chr_len_alone,
+            tags_exceptions_to_txt_max_min_chr_len_alone,
+        )
+        kept_positions = np.flatnonzero(kept)
+        kept_document_ids = document_ids[kept_positions]
+
+        # Metadata limit, on the filtered metadata
+        num_kept_by_document = np.bincount(kept_document_ids, minlength=num_documents)
+        max_metadata = document_limits.max_metadata if document_limits is not None else float("inf")
+        over_limit = num_kept_by_document > max_metadata
+        if over_limit.any():
+            if document_limits.metadata_policy == "truncate":
+                ranks = _rank_in_groups(
+                    (arrays["relative_starts"][kept_positions], arrays["starts"][kept_positions]),
+                    (kept_document_ids,),
+                )
+                kept_positions = kept_positions[ranks < max_metadata]
+            else:
+                kept_positions = kept_positions[~over_limit[kept_document_ids]]
+            kept_document_ids = document_ids[kept_positions]
+
+        # Same renumbering as `TextAndMetadataCleaner._clean_relative_pos`, on the starts and the ends together
+        num_kept = len(kept_positions)
+        ranks = _rank_in_groups(
+            (np.concatenate([arrays["relative_starts"][kept_positions], arrays["relative_ends"][kept_positions]]),),
+            (
+                np.concatenate([arrays["starts"][kept_positions], arrays["ends"][kept_positions]]),
+                np.concatenate([kept_document_ids, kept_document_ids]),
+            ),
+        )
+        relative_starts, relative_ends = ranks[:num_kept], ranks[num_kept:]
+
+        # Attribute projection
+        attr_offsets = arrays["attr_offsets"]
+        attr_key_ids = arrays["attr_key_ids"]
+        if attrs_to_keep is None:
+            kept_attrs = np.ones(len(attr_key_ids), dtype=bool)
+        else:
+            kept_attrs = np.isin(attr_key_ids, self._get_string_ids(attrs_to_keep))
+        attr_values = _split_strings(arrays["attr_value_blob"], arrays["attr_value_offsets"])
+
+        texts = _split_strings(arrays["text_blob"], arrays["text_offsets"])
+        limit_decisions = json.loads(str(arrays["limit_decisions"]))
+        results = [
+            (texts[document_id], [], [LimitDecision(**decision) for decision in limit_decisions[document_id]])
+            for document_id in range(num_documents)
+        ]
+        for document_id in np.flatnonzero(over_limit):
+            policy = document_limits.metadata_policy
+            results[document_id][2].append(
+                LimitDecision(
+                    limit="metadata",
+                    value=int(num_kept_by_document[document_id]),
+                    max_value=max_metadata,
+                    policy=policy,
+                )
+            )
+            if policy == "skip":
+                results[document_id] = ("", [], results[document_id][2])
+
+        strings = self.strings
+        columns = {
+            name: arrays[name][kept_positions].tolist()
+            for name in ["starts", "ends", "byte_starts", "byte_ends", "tag_ids", "key_ids", "type_ids"]
+        }
+        for idx, (position, document_id) in enumerate(zip(kept_positions.tolist(), kept_document_ids.tolist())):
+            attr_positions = [
+                attr_position
+                for attr_position in range(attr_offsets[position], attr_offsets[position + 1])
+                if kept_attrs[attr_position]
+            ]
+            byte_start_idx = columns["byte_starts"][idx]
+            byte_end_idx = columns["byte_ends"][idx]
+            results[document_id][1].append(
+                Metadata(
+                    char_start_idx=columns["starts"][idx],
+                    relative_start_pos=int(relative_starts[idx]),
+                    value=HtmlTag(
+                        tag=strings[columns["tag_ids"][idx]],
+                        attrs={
+                            "attrs": [strings[attr_key_ids[attr_position]] for attr_position in attr_positions],
+                            "values": [attr_values[attr_position] for attr_position in attr_positions],
+                        },
+                    ),
+                    char_end_idx=columns["ends"][idx],
+                    relative_end_pos=int(relative_ends[idx]),
+                    key=strings[columns["key_ids"][idx]],
+                    type=strings[columns["type_ids"][idx]],
+                    byte_start_idx=None if byte_start_idx < 0 else byte_start_idx,
+                    byte_end_idx=None if byte_end_idx < 0 else byte_end_idx,
+                )
+            )
+        return results
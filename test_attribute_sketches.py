@@ -0,0 +1,87 @@
+import pytest
+
+from attribute_sketches import AttributeSketches, HyperLogLog
+from html_parser import get_clean_text, get_clean_text_and_metadata
+
+
+def test_hyperloglog_estimates():
+    for num_values in [10, 1000, 20000]:
+        sketch = HyperLogLog()
+        for idx in range(num_values):
+            # Each value is added twice
+            sketch.add(f"value-{idx}")
+            sketch.add(f"value-{idx}")
+        assert abs(sketch.estimate() - num_values) <= 0.05 * num_values
+
+    with pytest.raises(ValueError):
+        HyperLogLog(precision=3)
+    with pytest.raises(ValueError):
+        HyperLogLog(precision=10).update(HyperLogLog(precision=12))
+
+
+def test_attribute_sketches_merge_and_save(tmp_path):
+    first_half, second_half, all_values = AttributeSketches(), AttributeSketches(), AttributeSketches()
+    for idx in range(4000):
+        attrib = {"class": f"class-{idx % 500}", "id": f"id-{idx}"}
+        (first_half if idx < 2000 else second_half).add("div", attrib)
+        all_values.add("div", attrib)
+    first_half.update(second_half)
+    assert first_half.estimates() == all_values.estimates()
+    assert abs(all_values.estimates()[("div", "class")] - 500) <= 25
+    assert abs(all_values.estimates()[("div", "id")] - 4000) <= 200
+
+    path = tmp_path / "sketches.npz"
+    all_values.save(path)
+    loaded_sketches = AttributeSketches.load(path)
+    assert loaded_sketches.attrs is None
+    assert loaded_sketches.estimates() == all_values.estimates()
+
+    AttributeSketches(attrs=["class"], precision=6).save(path)
+    loaded_sketches = AttributeSketches.load(path)
+    assert (loaded_sketches.attrs, loaded_sketches.precision, len(loaded_sketches)) == (["class"], 6, 0)
+
+
+def test_attribute_sketches_are_filled_by_the_extraction():
+    html = '<html><body><div class="a" id="x"><p class="b">text</p><p class="b">other</p></div></body></html>'
+    for engine in ["tree", "flat", "events"]:
+        attribute_sketches = AttributeSketches(attrs=["class"])
+        result = get_clean_text_and_metadata(html, attribute_sketches=attribute_sketches, engine=engine)
+        assert result == get_clean_text_and_metadata(html)
+        assert {pair: round(estimate) for pair, estimate in attribute_sketches.estimates().items()} == {
+            ("div", "class"): 1,
+            ("p", "class"): 1,
+        }
+
+    with pytest.raises(ValueError):
+        get_clean_text(html, attribute_sketches=AttributeSketches())
+
+
+def test_attribute_sketches_follow_attrs_to_keep_and_max_pairs():
+    html = '<html><body><div class="a" id="x"><p class="b" id="y">text</p></div></body></html>'
+    attribute_sketches = AttributeSketches()
+    get_clean_text_and_metadata(html, attrs_to_keep=["class"], attribute_sketches=attribute_sketches)
+    assert sorted(attribute_sketches.sketches) == [("div", "class"), ("p", "class")]
+
+    attribute_sketches = AttributeSketches(max_pairs=2)
+    get_clean_text_and_metadata(html, attribute_sketches=attribute_sketches)
+    assert len(attribute_sketches) == 2
+    assert attribute_sketches.num_ignored_values == 2
+
+    merged_sketches = AttributeSketches(max_pairs=1)
+    merged_sketches.update(attribute_sketches)
+    assert (len(merged_sketches), merged_sketches.num_ignored_values, merged_sketches.num_dropped_sketches) == (1, 2, 1)
+    merged_sketches.update(attribute_sketches)
+    assert (merged_sketches.num_ignored_values, merged_sketches.num_dropped_sketches) == (4, 2)
+
+
+def test_attribute_sketches_see_the_elements_before_the_folding():
+    html = "<html><body><div class='a'><div class='b'><p class='c'>text</p></div></div></body></html>"
+    for engine in ["tree", "flat"]:
+        attribute_sketches = AttributeSketches()
+        get_clean_text_and_metadata(
+            html, consecutive_tags_to_fold=["div"], attribute_sketches=attribute_sketches, engine=engine
+        )
+        assert {pair: round(estimate) for pair, estimate in attribute_sketches.estimates().items()} == {
+            ("div", "class"): 2,
+            ("p", "class"): 1,
+        }
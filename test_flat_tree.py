@@ -0,0 +1,67 @@
+import pytest
+from lxml import etree
+from lxml.html import fromstring
+
+from flat_tree import FlatTree
+from html_parser import TagToRemoveWithContent, get_clean_text_and_metadata, get_clean_text_and_metadata_for_profiles
+
+HTML_DOCS = [
+    "<html><body><div><div>a <p>b<span>c</span> d</p></div></div> e<ul><li>one</li><li>two <b>2</b></li></ul></body>"
+    "</html>",
+    "<html><body><p>a<script>x</script> tail <b>b</b><script></script>c</p>d<p>e <i>f</i> g</p></body></html>",
+    "<html><body><div> a <div><div>bb <span> c </span></div> d</div></div><span><span>e</span></span> f</body>"
+    "</html>",
+    "<html><body><ul><li>a</li><li></li><li> b c </li></ul><table><tr><td>1</td><td>22</td></tr></table></body>"
+    "</html>",
+    # The comments are not represented in the arrays
+    "<html><body><p>a<!--[if IE]>b<![endif]--> c</p></body></html>",
+]
+
+CONFIGS = [
+    {},
+    {"consecutive_tags_to_fold": ["div", "span"]},
+    {"tags_to_remove_with_content": [TagToRemoveWithContent(tag="script"), TagToRemoveWithContent(tag="b")]},
+    {
+        "tags_to_remove_with_content": [
+            TagToRemoveWithContent(tag="li", content_max_char_length=2),
+            TagToRemoveWithContent(tag="p", content_max_char_length=6, method="bottom-up"),
+            TagToRemoveWithContent(tag="div", content_min_char_length=1, content_max_char_length=5, method="bottom-up"),
+        ],
+        "consecutive_tags_to_fold": ["div"],
+    },
+    {
+        "txt_max_chr_len_with_content": 2,
+        "txt_min_chr_len_with_content": 0,
+        "tags_exceptions_to_txt_max_min_chr_len_with_content": ["html", "body", "ul"],
+        "tags_to_remove_with_content": [TagToRemoveWithContent(tag="table", method="bottom-up")],
+    },
+]
+
+
+def test_flat_tree_arrays():
+    root = fromstring("<html><body><p>ab<b>c</b>de</p>f<br><ul><li>gh</li></ul></body></html>")
+    flat_tree = FlatTree(root)
+
+    assert [flat_tree.tags[tag_id] for tag_id in flat_tree.tag_ids] == ["html", "body", "p", "b", "br", "ul", "li"]
+    assert flat_tree.parents.tolist() == [-1, 0, 1, 2, 1, 1, 5]
+    assert flat_tree.first_children.tolist() == [1, 2, 3, -1, -1, 6, -1]
+    assert flat_tree.next_siblings.tolist() == [-1, -1, 4, -1, 5, -1, -1]
+    assert flat_tree.subtree_ends.tolist() == [7, 7, 4, 4, 5, 7, 7]
+    assert flat_tree.inside_subtrees(flat_tree.tag_ids == flat_tree.get_tag_id("p")).tolist() == [0, 0, 0, 1, 0, 0, 0]
+    expected_lengths = [len(etree.tostring(element, method="text", with_tail=False)) for element in root.iter()]
+    assert flat_tree.subtree_text_lengths().tolist() == expected_lengths
+    assert not flat_tree.has_special_nodes
+
+
+@pytest.mark.parametrize("config", CONFIGS)
+def test_flat_engine_gives_the_result_of_the_tree_engine(config):
+    with open("parse_scripts/data_test/raw_wiki_page.txt", "r") as f:
+        wiki_html = f.read()
+    for html_str in HTML_DOCS + [wiki_html]:
+        assert get_clean_text_and_metadata(html_str, engine="flat", **config) == get_clean_text_and_metadata(
+            html_str, **config
+        )
+
+    profiles = {"tree": config, "flat": {**config, "engine": "flat"}}
+    results = get_clean_text_and_metadata_for_profiles(wiki_html, profiles)
+    assert results["flat"] == results["tree"]
@@ -3,7 +3,21 @@ from typing import DefaultDict
 
 import pytest
 
-from html_parser import TagToRemove, TagToRemoveWithContent, get_clean_text_and_metadata
+import html_parser
+from html_parser import (
+    DocumentLimits,
+    DocumentStats,
+    HtmlExtractor,
+    LimitDecision,
+    StringVocabulary,
+    SubtreeCache,
+    TagToRemove,
+    TagToRemoveWithContent,
+    TextAndMetadataCleaner,
+    get_clean_text,
+    get_clean_text_and_metadata,
+    get_clean_text_and_metadata_for_profiles,
+)
 
 
 def check_content_parsing(
@@ -1148,3 +1162,413 @@ def test_convert_br_tag():
     )
     assert plain_text == "first line\nsecond line\n"
     assert "br" not in [html_tag.value.tag for html_tag in metadata]
+
+
+def test_document_limits():
+    html = (
+        "<html><body>"
+        "<div><div><div><p>deep text</p></div></div></div>"
+        "<p>first</p><p>second</p><script>var a = 1;</script>"
+        "</body></html>"
+    )
+    plain_text, metadata = get_clean_text_and_metadata(html)
+
+    # No limit reached: same output as without limits
+    limit_decisions = []
+    assert get_clean_text_and_metadata(
+        html, document_limits=DocumentLimits(max_input_bytes=10000), limit_decisions=limit_decisions
+    ) == (plain_text, metadata)
+    assert limit_decisions == []
+
+    limit_decisions = []
+    assert get_clean_text_and_metadata(
+        html,
+        document_limits=DocumentLimits(max_input_bytes=10, input_bytes_policy="skip"),
+        limit_decisions=limit_decisions,
+    ) == ("", [])
+    assert limit_decisions == [LimitDecision(limit="input_bytes", value=len(html), max_value=10, policy="skip")]
+
+    limit_decisions = []
+    plain_text, metadata = get_clean_text_and_metadata(
+        html,
+        tags_to_remove_with_content=[TagToRemoveWithContent(tag="script")],
+        document_limits=DocumentLimits(max_elements=5, elements_policy="text-only"),
+        limit_decisions=limit_decisions,
+    )
+    # The text of the cleaned tree, as without limits
+    assert plain_text == "deep text\nfirst\nsecond\n"
+    assert plain_text == get_clean_text(html, tags_to_remove_with_content=[TagToRemoveWithContent(tag="script")])
+    assert metadata == []
+    assert limit_decisions == [LimitDecision(limit="elements", value=8, max_value=5, policy="text-only")]
+
+    # Only the elements selected by the conditions of the rules are removed with their content
+    article = "<p>" + "long article text " * 10 + "</p><p>more</p>"
+    html_with_article = f"<html><body><div>{article}</div><div>ad</div></body></html>"
+    tags_to_remove_with_content = [TagToRemoveWithContent(tag="div", content_max_char_length=5)]
+    plain_text, metadata = get_clean_text_and_metadata(
+        html_with_article,
+        tags_to_remove_with_content=tags_to_remove_with_content,
+        document_limits=DocumentLimits(max_elements=2, elements_policy="text-only"),
+    )
+    assert plain_text == get_clean_text(html_with_article, tags_to_remove_with_content=tags_to_remove_with_content)
+    assert plain_text.startswith("long article text") and "ad" not in plain_text.split()
+
+    limit_decisions = []
+    plain_text, metadata = get_clean_text_and_metadata(
+        html,
+        document_limits=DocumentLimits(max_depth=2, depth_policy="truncate"),
+        limit_decisions=limit_decisions,
+    )
+    assert plain_text == "deep text\nfirst\nsecond\nvar a = 1;\n"
+    assert sorted(metadata_node.value.tag for metadata_node in metadata) == ["body", "div", "p", "p", "script"]
+    assert limit_decisions == [LimitDecision(limit="depth", value=5, max_value=2, policy="truncate")]
+
+    limit_decisions = []
+    plain_text, metadata = get_clean_text_and_metadata(
+        html,
+        document_limits=DocumentLimits(max_elements=6, elements_policy="truncate"),
+        limit_decisions=limit_decisions,
+    )
+    assert plain_text == "deep text\nfirst\n"
+    assert limit_decisions == [LimitDecision(limit="elements", value=8, max_value=6, policy="truncate")]
+
+    limit_decisions = []
+    plain_text, metadata = get_clean_text_and_metadata(
+        html,
+        document_limits=DocumentLimits(max_metadata=3, metadata_policy="truncate"),
+        limit_decisions=limit_decisions,
+    )
+    assert [metadata_node.value.tag for metadata_node in metadata] == ["div", "div", "body"]
+    assert sorted(metadata_node.relative_start_pos for metadata_node in metadata) == [0, 1, 2]
+    assert limit_decisions == [LimitDecision(limit="metadata", value=8, max_value=3, policy="truncate")]
+
+    with pytest.raises(ValueError):
+        get_clean_text_and_metadata(html, document_limits=DocumentLimits(depth_policy="drop"))
+
+
+def test_subtree_cache():
+    navbox = (
+        '<table class="navbox"><tr><th>Topics</th></tr><tr><td><ul><li><a href="/a">A</a></li><li><a href="/b">B'
+        '</a></li><li><a href="/c">C</a></li><li><b>D</b></li></ul></td></tr></table>'
+    )
+    html_docs = [
+        f"<html><body><p>First article</p>{navbox}<p>End</p></body></html>",
+        f"<html><body>{navbox}<div><p>Second article</p></div></body></html>",
+        f"<html><body><div><span>inline text </span>{navbox}</div>{navbox}</body></html>",
+        f"<html><body><p>First article</p>{navbox}<p>End</p></body></html>",
+    ]
+    subtree_cache = SubtreeCache(min_elements=8)
+    for html in html_docs:
+        expected_plain_text, expected_metadata = get_clean_text_and_metadata(html, attrs_to_keep=["class", "href"])
+        plain_text, metadata = get_clean_text_and_metadata(
+            html, attrs_to_keep=["class", "href"], subtree_cache=subtree_cache
+        )
+        assert plain_text == expected_plain_text
+        assert metadata == expected_metadata
+
+    stats = subtree_cache.stats()
+    assert stats["by_tag"]["table"]["hits"] > 0
+    assert stats["num_entries"] > 0
+
+
+def test_string_vocabulary():
+    html = '<html><body><div class="mw-headline" id="a">first</div><div class="mw-headline" id="b">second</div></body></html>'
+    vocabulary = StringVocabulary(intern_attr_values=True, max_value_length=16)
+    expected_plain_text, expected_metadata = get_clean_text_and_metadata(html)
+    plain_text, metadata = get_clean_text_and_metadata(html, vocabulary=vocabulary)
+    assert plain_text == expected_plain_text
+    assert metadata == expected_metadata
+
+    first_div, second_div = [metadata_node.value for metadata_node in metadata if metadata_node.value.tag == "div"]
+    assert first_div.tag is second_div.tag
+    assert first_div.attrs["attrs"][0] is second_div.attrs["attrs"][0]
+    assert first_div.attrs["values"][0] is second_div.attrs["values"][0]
+    assert vocabulary.get_string(vocabulary.get_id("mw-headline")) == "mw-headline"
+    assert "div" in vocabulary and "class" in vocabulary
+
+    vocabulary = StringVocabulary()
+    _, metadata = get_clean_text_and_metadata(html, vocabulary=vocabulary)
+    assert "mw-headline" not in vocabulary
+
+
+def test_byte_offsets():
+    html = (
+        "<html><body><h1>Café crème</h1><p>Ünïcödé <b>😀 emoji</b> and 中文</p>"
+        "<div><span>naïve</span><br>text</div></body></html>"
+    )
+    for convert_br_tag_to_breaking_line in [False, True]:
+        plain_text, metadata = get_clean_text_and_metadata(
+            html, convert_br_tag_to_breaking_line=convert_br_tag_to_breaking_line, track_byte_offsets=True
+        )
+        text_bytes = plain_text.encode("UTF-8")
+        for metadata_node in metadata:
+            assert (
+                text_bytes[metadata_node.byte_start_idx : metadata_node.byte_end_idx].decode("UTF-8")
+                == plain_text[metadata_node.char_start_idx : metadata_node.char_end_idx]
+            )
+
+        _, metadata_without_byte_offsets = get_clean_text_and_metadata(
+            html, convert_br_tag_to_breaking_line=convert_br_tag_to_breaking_line
+        )
+        assert all(metadata_node.byte_start_idx is None for metadata_node in metadata_without_byte_offsets)
+        assert len(metadata_without_byte_offsets) == len(metadata)
+
+    subtree_cache = SubtreeCache(min_elements=1)
+    for _ in range(2):
+        assert get_clean_text_and_metadata(html, track_byte_offsets=True, subtree_cache=subtree_cache) == (
+            get_clean_text_and_metadata(html, track_byte_offsets=True)
+        )
+    assert subtree_cache.stats()["hit_rate"] > 0
+
+
+def test_profiles_share_the_parsing():
+    with open("parse_scripts/data_test/raw_wiki_page.txt", "r") as f:
+        wiki_html = f.read()
+    tags_to_remove_with_content = [TagToRemoveWithContent(tag="script"), TagToRemoveWithContent(tag="style")]
+    profiles = {
+        "default": {},
+        "br": {"tags_to_remove_with_content": tags_to_remove_with_content, "convert_br_tag_to_breaking_line": True},
+        "no_br": {"tags_to_remove_with_content": tags_to_remove_with_content, "consecutive_tags_to_fold": ["div"]},
+        "alone": {
+            "tags_to_remove_with_content": tags_to_remove_with_content,
+            "tags_to_remove_alone": [TagToRemove(tag="span"), TagToRemove(tag="p", content_max_char_length=64)],
+            "attrs_to_keep": ["class"],
+        },
+        "limits": {"document_limits": DocumentLimits(max_depth=6, depth_policy="truncate", max_metadata=50)},
+        "skip": {"document_limits": DocumentLimits(max_input_bytes=10, input_bytes_policy="skip")},
+    }
+    for html in ["<html><body><p>a<br>b</p><div><div>c</div></div></body></html>", wiki_html]:
+        limit_decisions = {}
+        results = get_clean_text_and_metadata_for_profiles(html, profiles, limit_decisions=limit_decisions)
+        assert list(results) == list(profiles)
+        for profile_name, profile in profiles.items():
+            expected_limit_decisions = []
+            assert results[profile_name] == get_clean_text_and_metadata(
+                html, limit_decisions=expected_limit_decisions, **profile
+            )
+            assert limit_decisions.get(profile_name, []) == expected_limit_decisions
+    assert "br" not in {metadata_node.value.tag for metadata_node in results["br"][1]}
+    assert "br" in {metadata_node.value.tag for metadata_node in results["no_br"][1]}
+
+    with pytest.raises(ValueError):
+        get_clean_text_and_metadata_for_profiles(wiki_html, {"default": {"cache": None}})
+
+
+def test_html_extractor_threads():
+    with open("parse_scripts/data_test/raw_wiki_page.txt", "r") as f:
+        wiki_html = f.read()
+    html_strs = [
+        wiki_html,
+        "<html><body><p>a<br>b</p><div><div>c</div></div></body></html>",
+        "<body><span>Not wrapped</span></body>",
+    ] * 8
+    cleaner_kwargs = dict(
+        tags_to_remove_with_content=[TagToRemoveWithContent(tag="script"), TagToRemoveWithContent(tag="style")],
+        consecutive_tags_to_fold=["div"],
+        track_byte_offsets=True,
+    )
+    expected = [get_clean_text_and_metadata(html_str, **cleaner_kwargs) for html_str in html_strs]
+
+    extractor = HtmlExtractor(
+        subtree_cache=SubtreeCache(min_elements=2), vocabulary=StringVocabulary(), **cleaner_kwargs
+    )
+    assert list(extractor.map(html_strs, num_threads=4)) == expected
+    assert extractor.subtree_cache.stats()["hit_rate"] > 0
+    # The config of the extractor is left untouched by the documents
+    assert list(extractor.map(html_strs[::-1], num_threads=2)) == expected[::-1]
+
+    with pytest.raises(ValueError):
+        HtmlExtractor(document_limits=DocumentLimits(depth_policy="drop"))
+
+
+def test_parse_time_elision(monkeypatch):
+    with open("parse_scripts/data_test/raw_wiki_page.txt", "r") as f:
+        wiki_html = f.read()
+    html_strs = [
+        wiki_html,
+        "<html><body><p>a<script>x<b>y</b></script>tail<form><div><div>c</div></div></form></p></body></html>",
+        "<html><body><iframe><script>z</script></iframe>kept</body></html>",
+    ]
+    tags_to_remove_with_content = [
+        TagToRemoveWithContent(tag="script"),
+        TagToRemoveWithContent(tag="iframe"),
+        TagToRemoveWithContent(tag="form"),
+        TagToRemoveWithContent(tag="div", content_max_char_length=2, method="bottom-up"),
+    ]
+    cleaner = TextAndMetadataCleaner(
+        html_str=None, tags_to_remove_with_content=tags_to_remove_with_content, start_parsing_at_tag="body"
+    )
+    assert cleaner.tags_to_elide == {"script", "iframe", "form"}
+
+    results = [
+        get_clean_text_and_metadata(html_str, tags_to_remove_with_content=tags_to_remove_with_content)
+        for html_str in html_strs
+    ]
+    monkeypatch.setattr(TextAndMetadataCleaner, "_get_tags_to_elide", lambda self: set())
+    assert results == [
+        get_clean_text_and_metadata(html_str, tags_to_remove_with_content=tags_to_remove_with_content)
+        for html_str in html_strs
+    ]
+    monkeypatch.undo()
+
+    # The decision of a top-down rule with a length condition depends on the content of the tags inside it
+    cleaner = TextAndMetadataCleaner(
+        html_str=None,
+        tags_to_remove_with_content=tags_to_remove_with_content
+        + [TagToRemoveWithContent(tag="table", content_min_char_length=10, method="top-down")],
+    )
+    assert cleaner.tags_to_elide == set()
+    cleaner = TextAndMetadataCleaner(
+        html_str=None,
+        tags_to_remove_with_content=tags_to_remove_with_content,
+        consecutive_tags_to_fold=["form"],
+        document_limits=DocumentLimits(max_depth=100),
+    )
+    assert cleaner.tags_to_elide == set()
+    cleaner = TextAndMetadataCleaner(
+        html_str=None, tags_to_remove_with_content=tags_to_remove_with_content, consecutive_tags_to_fold=["form"]
+    )
+    assert cleaner.tags_to_elide == {"script", "iframe"}
+
+
+def test_event_engine():
+    with open("parse_scripts/data_test/raw_wiki_page.txt", "r") as f:
+        wiki_html = f.read()
+    html_strs = [
+        "<html><body><p>a<script>x</script> tail <b>b</b><script></script>c</p>d</body></html>",
+        "<html><body><p>a</p> b <script>x</script> c<div>d<style></style> e</div></body></html>",
+        "<html><body><pre>  a  b\n<script>x</script>  c</pre>  d   e <p pre>  f  g  </p></body></html>",
+        '<html lang="en"><body><div lang="en"><p lang="fr">a</p></div><a rel="x" href="h/">b</a></body></html>',
+        "<html><body><div><div>a<br>b</div></div><input checked><textarea>  c  </textarea></body></html>",
+        "<html><body><iframe>a<b>c</b></iframe><p>d &amp; e</p></body> after <p>f</p></html>",
+        # Handled by the tree engine
+        "<body><span>Not wrapped</span></body>",
+        "<html><body><p>a<!--[if IE]>b<![endif]--></p></body></html>",
+        "<html><body><ul><li></li><li>a</li></ul></body></html>",
+        "<html><body><p>a</p></body><body class='c'><p>b</p></body></html>",
+    ]
+    tags_to_remove_with_content = [
+        TagToRemoveWithContent(tag="script"),
+        TagToRemoveWithContent(tag="style"),
+        TagToRemoveWithContent(tag="iframe"),
+    ]
+    configs = [
+        {},
+        {"tags_to_remove_with_content": tags_to_remove_with_content, "consecutive_tags_to_fold": ["div"]},
+        {
+            "tags_to_remove_with_content": tags_to_remove_with_content,
+            "tags_to_remove_alone": [TagToRemove(tag="span"), TagToRemove(tag="p", content_max_char_length=64)],
+            "attrs_to_keep": ["class", "href"],
+            "convert_br_tag_to_breaking_line": True,
+            "track_byte_offsets": True,
+        },
+        {"document_limits": DocumentLimits(max_metadata=20)},
+    ]
+    for config in configs:
+        assert TextAndMetadataCleaner(html_str=None, **config).supports_event_engine()
+        expected = get_clean_text_and_metadata(wiki_html, **config)
+        cleaner = TextAndMetadataCleaner(html_str=wiki_html, start_parsing_at_tag="body", engine="events", **config)
+        assert cleaner._apply_events() == expected
+        for html_str in html_strs:
+            assert get_clean_text_and_metadata(html_str, engine="events", **config) == get_clean_text_and_metadata(
+                html_str, **config
+            )
+
+    for config in [
+        {"tags_to_remove_with_content": [TagToRemoveWithContent(tag="div", content_max_char_length=10)]},
+        {"txt_max_chr_len_with_content": 10},
+        {"document_limits": DocumentLimits(max_depth=6)},
+        {"consecutive_tags_to_fold": ["pre"]},
+    ]:
+        assert not TextAndMetadataCleaner(html_str=None, **config).supports_event_engine()
+        assert get_clean_text_and_metadata(wiki_html, engine="events", **config) == get_clean_text_and_metadata(
+            wiki_html, **config
+        )
+
+    with pytest.raises(ValueError):
+        get_clean_text_and_metadata(wiki_html, engine="sax")
+
+
+def test_event_engine_needs_a_supported_htmlmin_version(monkeypatch):
+    html = '<html><body><div class="a"><p>first  text</p><pre>  kept </pre></div></body></html>'
+    assert TextAndMetadataCleaner(html_str=None).supports_event_engine()
+
+    monkeypatch.setattr(html_parser.htmlmin, "__version__", "0.2.0")
+    assert not TextAndMetadataCleaner(html_str=None).supports_event_engine()
+    assert get_clean_text_and_metadata(html, engine="events") == get_clean_text_and_metadata(html)
+
+
+def test_get_clean_text():
+    with open("parse_scripts/data_test/raw_wiki_page.txt", "r") as f:
+        wiki_html = f.read()
+    html_strs = [
+        wiki_html,
+        "<html><body><p> a\u00a0 b\r\n<b> c </b></p>\t<pre>  d\n  e </pre> f <br>g<td>h</td><img> i</body></html>",
+        "<html><body><div><div>  </div></div><span>\x0b a</span>\n<li>b</li></body></html>",
+        "<html><body></body></html>",
+    ]
+    configs = [
+        {},
+        {
+            "tags_to_remove_with_content": [TagToRemoveWithContent(tag="b", method="bottom-up")],
+            "tags_to_remove_alone": [TagToRemove(tag="span")],
+            "attrs_to_keep": ["class"],
+            "consecutive_tags_to_fold": ["div"],
+            "convert_br_tag_to_breaking_line": True,
+        },
+        {
+            "txt_max_chr_len_with_content": 3,
+            "tags_exceptions_to_txt_max_min_chr_len_with_content": ["html", "body"],
+            "engine": "flat",
+        },
+        {"document_limits": DocumentLimits(max_elements=5), "engine": "events"},
+    ]
+    for config in configs:
+        for html_str in html_strs:
+            limit_decisions = []
+            expected_limit_decisions = []
+            assert get_clean_text(html_str, limit_decisions=limit_decisions, **config) == get_clean_text_and_metadata(
+                html_str, limit_decisions=expected_limit_decisions, **config
+            )[0]
+            assert limit_decisions == expected_limit_decisions
+
+
+def test_document_stats():
+    html = "<html><body><div><div><p>ab<br>cd</p><script>x</script></div></div><span>e</span><img></body></html>"
+    config = {
+        "tags_to_remove_with_content": [TagToRemoveWithContent(tag="script")],
+        "tags_to_remove_alone": [TagToRemove(tag="span")],
+        "consecutive_tags_to_fold": ["div"],
+    }
+    stats = DocumentStats()
+    plain_text, metadata = get_clean_text_and_metadata(html, stats=stats, **config)
+    assert (plain_text, metadata) == get_clean_text_and_metadata(html, **config)
+
+    assert stats.tag_counts == {
+        "html": 1,
+        "body": 1,
+        "div": 1,
+        "fake_tag_block": 1,
+        "p": 1,
+        "br": 1,
+        "span": 1,
+        "img": 1,
+    }
+    assert stats.text_lengths["body"] == len(plain_text)
+    assert stats.text_lengths["p"] == len("ab\ncd")
+    assert stats.void_element_counts == {"br": 1, "img": 1}
+    assert stats.depth_histogram == [1, 1, 3, 1, 1, 1]
+    assert stats.removed_with_content_counts == {"script": 1}
+    assert stats.dropped_alone_counts == {"fake_tag_block": 1, "span": 1}
+
+    for engine in ["flat", "events"]:
+        engine_stats = DocumentStats()
+        get_clean_text_and_metadata(html, stats=engine_stats, engine=engine, **config)
+        assert engine_stats == stats
+
+    total_stats = DocumentStats()
+    total_stats.update(stats)
+    total_stats.update(stats)
+    assert total_stats.tag_counts["div"] == 2
+    assert total_stats.depth_histogram == [2, 2, 6, 2, 2, 2]
+    assert total_stats.removed_with_content_counts == {"script": 2}
@@ -0,0 +1,95 @@
+import dataclasses
+import io
+
+import jsonlines
+import pytest
+
+import metadata_encoder
+from html_parser import HtmlTag, Metadata, StringVocabulary, TagToRemoveWithContent, get_clean_text_and_metadata
+from metadata_encoder import (
+    MetadataBinaryDecoder,
+    MetadataBinaryEncoder,
+    MetadataJsonEncoder,
+    iter_records,
+    write_record,
+)
+from parse_scripts.parse_natural_questions_Toy_v2 import convert_html_metadata_dataclass_to_dict
+
+
+def write_with_jsonlines(json_example):
+    fp = io.BytesIO()
+    jsonlines.Writer(fp).write(json_example)
+    return fp.getvalue()
+
+
+def metadata_dataclass_to_dict(metadata_node):
+    metadata_dict = dataclasses.asdict(metadata_node)
+    if metadata_dict["byte_start_idx"] is None:
+        del metadata_dict["byte_start_idx"], metadata_dict["byte_end_idx"]
+    return metadata_dict
+
+
+def get_documents():
+    with open("parse_scripts/data_test/raw_wiki_page.txt", "r") as f:
+        wiki_html = f.read()
+    documents = [
+        get_clean_text_and_metadata(wiki_html, tags_to_remove_with_content=[TagToRemoveWithContent(tag="script")]),
+        get_clean_text_and_metadata("<html><body><p>Empty</p><br></body></html>"),
+        get_clean_text_and_metadata("<html><body><p>Café <b>中文</b></p></body></html>", track_byte_offsets=True),
+        ("", []),
+    ]
+    tricky_metadata = Metadata(
+        char_start_idx=0,
+        relative_start_pos=0,
+        value=HtmlTag(tag="a", attrs={"attrs": ["title", "data-x"], "values": ['Quote " \\ é \x01', "\t😀"]}),
+        char_end_idx=None,
+        relative_end_pos=None,
+    )
+    documents.append(('Text with "quotes", \\ \n\t\x00 and unicode é 中文 😀', [tricky_metadata]))
+    return documents
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_json_encoder_is_byte_identical(use_orjson, monkeypatch):
+    if not use_orjson:
+        monkeypatch.setattr(metadata_encoder, "_encode_text", metadata_encoder._encode_str_stdlib)
+
+    dataclass_encoder = MetadataJsonEncoder(schema="dataclass")
+    flat_encoder = MetadataJsonEncoder(schema="flat")
+    for plain_text, metadata in get_documents():
+        expected = write_with_jsonlines(
+            {"text": plain_text, "metadata": [metadata_dataclass_to_dict(node) for node in metadata]}
+        )
+        assert dataclass_encoder.encode(plain_text, metadata) == expected
+        if metadata and metadata[0].byte_start_idx is None:
+            assert b"byte_start_idx" not in expected
+
+        extra_fields = {"limit_decisions": [{"limit": "depth", "value": 5, "max_value": float("inf")}]}
+        expected = write_with_jsonlines(
+            {
+                "text": plain_text,
+                "metadata": [convert_html_metadata_dataclass_to_dict(node) for node in metadata],
+                **extra_fields,
+            }
+        )
+        assert flat_encoder.encode(plain_text, metadata, extra_fields=extra_fields) == expected
+
+
+def test_json_encoder_invalid_schema():
+    with pytest.raises(ValueError):
+        MetadataJsonEncoder(schema="asdict")
+
+
+def test_binary_encoder_round_trip():
+    encoder = MetadataBinaryEncoder(StringVocabulary(intern_attr_values=True, max_value_length=8))
+    records = [encoder.encode(plain_text, metadata) for plain_text, metadata in get_documents()]
+
+    fp = io.BytesIO()
+    for record in records:
+        write_record(fp, record)
+    fp.seek(0)
+
+    decoder = MetadataBinaryDecoder()
+    for record, (plain_text, metadata) in zip(iter_records(fp), get_documents()):
+        assert decoder.decode(record) == (plain_text, metadata)
+    assert fp.read() == b""
@@ -0,0 +1,52 @@
+import random
+
+from html_parser import HtmlTag, Metadata, get_clean_text_and_metadata
+from metadata_index import MetadataIndex, _IntervalTree
+from parse_scripts.parse_natural_questions_Toy_v2 import convert_html_metadata_dataclass_to_dict
+
+
+def test_interval_tree_against_linear_scan():
+    random.seed(0)
+    for num_intervals in [0, 1, 2, 7, 16, 33, 200]:
+        intervals = sorted(
+            (start, start + random.randint(1, 50)) for start in (random.randint(0, 300) for _ in range(num_intervals))
+        )
+        tree = _IntervalTree([start for start, _ in intervals], [end for _, end in intervals])
+        for _ in range(100):
+            query_start = random.randint(0, 350)
+            query_end = query_start + random.randint(1, 40)
+            expected = [
+                position
+                for position, (start, end) in enumerate(intervals)
+                if start < query_end and end > query_start
+            ]
+            assert tree.overlapping(query_start, query_end) == expected
+
+
+def test_metadata_index_queries():
+    html = (
+        "<html><body><div><p>First <a href='/x'>link</a> and <b>bold <a href='/y'>text</a></b></p>"
+        "<p>Second<a href='/z'></a></p></div></body></html>"
+    )
+    plain_text, metadata = get_clean_text_and_metadata(html, attrs_to_keep=["href"])
+    index = MetadataIndex(metadata)
+    assert len(index) == len(metadata)
+
+    char_idx = plain_text.index("text")
+    assert [metadata_node.value.tag for metadata_node in index.covering(char_idx)] == ["body", "div", "p", "b", "a"]
+    assert [metadata_node.value.attrs["values"] for metadata_node in index.covering(char_idx, tag="a")] == [["/y"]]
+
+    first_paragraph, second_paragraph = index.covering(0, tag="p") + index.covering(plain_text.index("Second"), tag="p")
+    assert [metadata_node.value.attrs["values"] for metadata_node in index.inside(first_paragraph, tag="a")] == [
+        ["/x"],
+        ["/y"],
+    ]
+    # The empty link is positioned at the end of the second paragraph
+    assert [metadata_node.value.attrs["values"] for metadata_node in index.inside(second_paragraph, tag="a")] == [
+        ["/z"]
+    ]
+    assert len(index.overlapping(0, len(plain_text), tag="a")) == 3
+    assert index.covering(len(plain_text) + 10) == []
+
+    json_metadata = [convert_html_metadata_dataclass_to_dict(metadata_node) for metadata_node in metadata]
+    assert MetadataIndex.from_json_metadata(json_metadata).metadata == index.metadata
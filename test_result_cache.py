@@ -0,0 +1,106 @@
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+
+import htmlmin
+from lxml import etree
+
+from html_parser import DocumentLimits, TagToRemoveWithContent, get_clean_text_and_metadata
+from result_cache import ResultCache, hash_config
+
+
+def test_result_cache_hit_and_miss(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache.sqlite"))
+    html = "<html><body><div class='a'><p>some text</p><script>var a;</script></div></body></html>"
+    tags_to_remove_with_content = [TagToRemoveWithContent(tag="script")]
+
+    expected_result = get_clean_text_and_metadata(html, tags_to_remove_with_content=tags_to_remove_with_content)
+    assert (
+        get_clean_text_and_metadata(html, tags_to_remove_with_content=tags_to_remove_with_content, cache=cache)
+        == expected_result
+    )
+    assert (cache.hits, cache.misses) == (0, 1)
+    assert (
+        get_clean_text_and_metadata(html, tags_to_remove_with_content=tags_to_remove_with_content, cache=cache)
+        == expected_result
+    )
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # Another config or another document are other entries
+    get_clean_text_and_metadata(html, cache=cache)
+    get_clean_text_and_metadata(html.replace("some", "other"), cache=cache)
+    assert (cache.hits, cache.misses) == (1, 3)
+    assert cache.stats()["num_entries"] == 3
+
+    # The cache is shared between processes through its file
+    other_cache = pickle.loads(pickle.dumps(cache))
+    limit_decisions = []
+    get_clean_text_and_metadata(
+        html, document_limits=DocumentLimits(max_metadata=1), limit_decisions=limit_decisions, cache=other_cache
+    )
+    cached_limit_decisions = []
+    get_clean_text_and_metadata(
+        html, document_limits=DocumentLimits(max_metadata=1), limit_decisions=cached_limit_decisions, cache=cache
+    )
+    assert cached_limit_decisions == limit_decisions != []
+    assert cache.hits == 2
+    assert cache.stats()["hits"] == 2
+    assert cache.stats()["misses"] == 4
+
+
+def test_result_cache_lru_eviction(tmp_path):
+    html_template = "<html><body><p>{}</p></body></html>"
+    cache = ResultCache(str(tmp_path / "cache.sqlite"))
+    get_clean_text_and_metadata(html_template.format("0 " * 100), cache=cache)
+    entry_size = cache.stats()["size_bytes"]
+
+    cache = ResultCache(str(tmp_path / "small_cache.sqlite"), max_bytes=entry_size * 2.5)
+    for idx in range(3):
+        get_clean_text_and_metadata(html_template.format(f"{idx} " * 100), cache=cache)
+        if idx == 1:
+            # Reading the first entry makes the second one the least recently used
+            get_clean_text_and_metadata(html_template.format("0 " * 100), cache=cache)
+
+    assert cache.evictions == 1
+    assert cache.stats()["num_entries"] == 2
+    assert cache.stats()["size_bytes"] <= entry_size * 2.5
+    get_clean_text_and_metadata(html_template.format("0 " * 100), cache=cache)
+    get_clean_text_and_metadata(html_template.format("1 " * 100), cache=cache)
+    assert (cache.hits, cache.misses) == (2, 4)
+
+
+def test_result_cache_key_covers_the_library_versions(monkeypatch):
+    config = {"attrs_to_keep": ["class"]}
+    key = hash_config(config)
+    monkeypatch.setattr(htmlmin, "__version__", "0.0.0")
+    assert hash_config(config) != key
+    monkeypatch.undo()
+    monkeypatch.setattr(etree, "LXML_VERSION", (0, 0, 0, 0))
+    assert hash_config(config) != key
+    monkeypatch.undo()
+    assert hash_config(config) == key
+
+
+def test_result_cache_counters_with_threads(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache.sqlite"))
+    html = "<html><body><p>text</p></body></html>"
+    get_clean_text_and_metadata(html, cache=cache)
+
+    # Half of the documents are in the cache
+    documents = [html if idx % 2 else html + str(idx) for idx in range(400)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda document: get_clean_text_and_metadata(document, cache=cache), documents))
+    assert (cache.hits, cache.misses) == (200, 201)
+
+
+def test_result_cache_total_size_with_concurrent_replacements(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache.sqlite"))
+
+    def replace(idx):
+        # Results of different sizes for the same key
+        cache.put("key", ("x" * (idx % 37 * 50), [], []))
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(replace, range(400)))
+    connection = cache._connection()
+    (size,) = connection.execute("SELECT size FROM results WHERE key = 'key'").fetchone()
+    assert cache.stats()["size_bytes"] == size
@@ -0,0 +1,51 @@
+import pytest
+
+from html_parser import DocumentLimits, TagToRemove, TagToRemoveWithContent, get_clean_text_and_metadata
+from staged_metadata import StagedShard, extract_unfiltered
+
+HTML_DOCS = [
+    "<html><body><div><p>First <a href='/x' class='l'>link</a> and <b>bold <i>text</i></b></p>"
+    "<p>Second<a href='/z'></a></p><span id='s'>a span with more text</span></div></body></html>",
+    "<html><body><h1 class='t'>Title</h1><ul><li>one</li><li>two <b>bold</b></li></ul><br>tail"
+    "<script>var a = 1;</script></body></html>",
+    "<html><body></body></html>",
+]
+
+FILTER_CONFIGS = [
+    {},
+    {"tags_to_remove_alone": [TagToRemove("b"), TagToRemove("p", content_max_char_length=10)]},
+    {"txt_max_chr_len_alone": 4, "tags_exceptions_to_txt_max_min_chr_len_alone": ["a"]},
+    {"txt_min_chr_len_alone": 5, "txt_max_chr_len_alone": float("inf"), "attrs_to_keep": ["href"]},
+    {"attrs_to_keep": []},
+    {"tags_to_remove_alone": [TagToRemove("li")], "document_limits": DocumentLimits(max_metadata=4)},
+    {"document_limits": DocumentLimits(max_metadata=6, metadata_policy="skip")},
+]
+
+
+@pytest.mark.parametrize("convert_br_tag_to_breaking_line", [False, True])
+def test_staged_shard_filters_like_a_full_extraction(tmp_path, convert_br_tag_to_breaking_line):
+    extraction_kwargs = {
+        "tags_to_remove_with_content": [TagToRemoveWithContent(tag="script")],
+        "convert_br_tag_to_breaking_line": convert_br_tag_to_breaking_line,
+        "track_byte_offsets": True,
+    }
+    staged_shard = StagedShard.from_examples(extract_unfiltered(html, **extraction_kwargs) for html in HTML_DOCS)
+    staged_shard.save(tmp_path / "staged.npz")
+    staged_shard = StagedShard.load(tmp_path / "staged.npz")
+    assert len(staged_shard) == len(HTML_DOCS)
+
+    for filter_config in FILTER_CONFIGS:
+        results = staged_shard.apply_filters(**filter_config)
+        for html, (plain_text, metadata, limit_decisions) in zip(HTML_DOCS, results):
+            expected_limit_decisions = []
+            expected_plain_text, expected_metadata = get_clean_text_and_metadata(
+                html, limit_decisions=expected_limit_decisions, **extraction_kwargs, **filter_config
+            )
+            assert plain_text == expected_plain_text
+            assert metadata == expected_metadata
+            assert limit_decisions == expected_limit_decisions
+
+
+def test_extract_unfiltered_rejects_filter_params():
+    with pytest.raises(ValueError):
+        extract_unfiltered(HTML_DOCS[0], attrs_to_keep=["href"])